@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+import asyncio
+import inspect
+import json
+import logging
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Union
+
+from sqlalchemy.engine import make_url
+
+from .config import settings
+from .eventlog import eventlog
+from .events import Event, as_event
+from .realtime import manager
+
+log = logging.getLogger(__name__)
+
+Handler = Callable[[Dict[str, Any]], Optional[Awaitable[None]]]
+Hook = Callable[[], Optional[Awaitable[None]]]
+
+
+async def _call(fn: Callable[..., Any], *args: Any) -> None:
+	try:
+		res = fn(*args)
+		if inspect.isawaitable(res):
+			await res
+	except Exception:
+		log.exception("event bus handler %r failed", fn)
+
+
+class EventBus:
+	"""Bus degli eventi realtime, modalita' singolo processo (default, EVENT_BUS=memory).
+
+	publish() consegna l'evento ai socket locali. Le sottoclassi lo inoltrano anche agli altri
+	worker/nodi, che lo ripassano ai propri socket e agli handler registrati con subscribe()
+	(es. la proiezione degli ordini, che deve restare allineata tra i worker).
+	"""
+
+	def __init__(self) -> None:
+		self.node_id = uuid.uuid4().hex[:12]
+		self._handlers: List[Handler] = []
+		self._resync_hooks: List[Hook] = []
+		self.published = 0
+		self.received = 0
+
+	def subscribe(self, handler: Handler) -> None:
+		"""Handler chiamato per ogni evento arrivato da un altro worker (mai per quelli locali)."""
+		self._handlers.append(handler)
+
+	def on_resync(self, hook: Hook) -> None:
+		"""Hook chiamato quando possono essersi persi eventi remoti (riconnessione del listener)."""
+		self._resync_hooks.append(hook)
+
+	async def start(self) -> None:
+		pass
+
+	async def stop(self) -> None:
+		pass
+
+	async def publish(self, channels: Iterable[str], event: Union[Event, Dict[str, Any]]) -> Event:
+		"""Consegna l'evento ai socket locali; se ha canali prende un `seq` dal log (see eventlog.py).
+
+		Restituisce l'evento trasmesso (con seq), da inoltrare tale e quale agli altri worker.
+		"""
+		self.published += 1
+		channels = list(channels)
+		ev = as_event(event)
+		if not channels:
+			return ev
+		return await eventlog.append(channels, ev, manager.broadcast_many)
+
+	async def _deliver_remote(self, channels: List[str], payload: Dict[str, Any]) -> None:
+		self.received += 1
+		for h in self._handlers:
+			await _call(h, payload)
+		if channels:
+			ev = as_event(payload)
+			eventlog.record(channels, ev)
+			await manager.broadcast_many(channels, ev)
+
+	def stats(self) -> Dict[str, Any]:
+		return {"kind": "memory", "node_id": self.node_id, "published": self.published, "received": self.received}
+
+
+class PostgresBus(EventBus):
+	"""Fan-out tra worker e nodi con Postgres LISTEN/NOTIFY (EVENT_BUS=postgres).
+
+	Ogni evento e' consegnato subito ai socket locali e poi pubblicato con pg_notify su un
+	canale condiviso; ogni processo ascolta con una connessione asyncpg dedicata, scarta i
+	propri messaggi (node_id) e ripubblica gli altri in locale. NOTIFY accetta al massimo
+	~8000 byte: gli eventi piu' grandi (es. order_created con molte righe) vengono scritti in
+	`bus_events` e la notifica porta solo l'id, che i listener rileggono.
+	Le notifiche sono elaborate in ordine da un unico task. Se la connessione LISTEN cade, si
+	riconnette con backoff e chiama gli hook di resync (gli eventi nel frattempo sono persi).
+	"""
+
+	CLEANUP_EVERY_SEC = 60.0
+	RETENTION_SEC = 300
+
+	def __init__(
+		self,
+		dsn: str = settings.DATABASE_URL,
+		channel: str = settings.EVENT_BUS_CHANNEL,
+		max_notify: int = settings.EVENT_BUS_MAX_NOTIFY,
+	) -> None:
+		super().__init__()
+		url = make_url(dsn)
+		# asyncpg vuole il DSN "postgresql://", senza il driver di SQLAlchemy
+		self.dsn = url.set(drivername="postgresql").render_as_string(hide_password=False)
+		self.channel = channel
+		self.max_notify = max_notify
+		self._pub = None  # asyncpg.Connection per NOTIFY/INSERT
+		self._pub_lock = asyncio.Lock()
+		self._listen = None
+		self._lost: Optional[asyncio.Event] = None
+		self._inbox: asyncio.Queue[str] = asyncio.Queue()
+		self._tasks: List[asyncio.Task] = []
+		self._last_cleanup = 0.0
+		self.spilled = 0
+		self.reconnects = 0
+
+	async def start(self) -> None:
+		await self._connect_listener()
+		self._tasks = [
+			asyncio.create_task(self._consume(), name="bus-consume"),
+			asyncio.create_task(self._supervise(), name="bus-listen"),
+		]
+
+	async def stop(self) -> None:
+		for t in self._tasks:
+			t.cancel()
+		await asyncio.gather(*self._tasks, return_exceptions=True)
+		self._tasks = []
+		for conn in (self._listen, self._pub):
+			if conn is not None:
+				try:
+					await conn.close()
+				except Exception:
+					pass
+		self._listen = self._pub = None
+
+	async def _connect_listener(self) -> None:
+		import asyncpg
+
+		self._lost = asyncio.Event()
+		conn = await asyncpg.connect(self.dsn)
+		conn.add_termination_listener(lambda _c: self._lost.set())
+		await conn.add_listener(self.channel, self._on_notify)
+		self._listen = conn
+
+	def _on_notify(self, _conn: Any, _pid: int, _channel: str, payload: str) -> None:
+		self._inbox.put_nowait(payload)
+
+	async def _supervise(self) -> None:
+		delay = 1.0
+		while True:
+			await self._lost.wait()
+			log.warning("event bus: LISTEN connection lost, reconnecting")
+			while True:
+				try:
+					await self._connect_listener()
+					break
+				except Exception as e:
+					log.warning("event bus: reconnect failed: %s", e)
+					await asyncio.sleep(delay)
+					delay = min(30.0, delay * 2)
+			delay = 1.0
+			self.reconnects += 1
+			for hook in self._resync_hooks:
+				await _call(hook)
+
+	async def _consume(self) -> None:
+		while True:
+			raw = await self._inbox.get()
+			try:
+				msg = json.loads(raw)
+				if msg.get("o") == self.node_id:
+					continue
+				if "id" in msg:
+					msg = await self._fetch(msg["id"])
+					if msg is None:
+						continue
+				await self._deliver_remote(msg["c"], msg["e"])
+			except asyncio.CancelledError:
+				raise
+			except Exception:
+				log.exception("event bus: bad notification")
+
+	async def _fetch(self, event_id: int) -> Optional[Dict[str, Any]]:
+		raw = await self._pg("fetchval", "SELECT payload FROM bus_events WHERE id = $1", event_id)
+		if raw is None:
+			log.warning("event bus: event %s expired before being read", event_id)
+			return None
+		return json.loads(raw)
+
+	async def _pg(self, method: str, query: str, *args: Any) -> Any:
+		"""Esegue sulla connessione di pubblicazione, riaprendola una volta se e' caduta."""
+		import asyncpg
+
+		async with self._pub_lock:
+			for attempt in (1, 2):
+				if self._pub is None or self._pub.is_closed():
+					self._pub = await asyncpg.connect(self.dsn)
+				try:
+					return await getattr(self._pub, method)(query, *args)
+				except (asyncpg.PostgresConnectionError, ConnectionError, OSError):
+					self._pub = None
+					if attempt == 2:
+						raise
+
+	async def publish(self, channels: Iterable[str], event: Union[Event, Dict[str, Any]]) -> Event:
+		channels = list(channels)
+		ev = await super().publish(channels, event)
+		# riusa il JSON gia' prodotto per i socket locali invece di riserializzare l'evento
+		head = json.dumps({"o": self.node_id, "c": channels}, separators=(",", ":"))
+		data = head[:-1].encode() + b',"e":' + ev.data + b"}"
+		msg = data.decode("utf-8")
+		try:
+			if len(data) > self.max_notify:
+				self.spilled += 1
+				event_id = await self._pg("fetchval", "INSERT INTO bus_events (payload, created_at) VALUES ($1, now()) RETURNING id", msg)
+				msg = json.dumps({"o": self.node_id, "id": event_id})
+				await self._cleanup()
+			await self._pg("execute", "SELECT pg_notify($1, $2)", self.channel, msg)
+		except Exception:
+			# i socket locali l'hanno gia' ricevuto; gli altri worker si riallineano al resync dei client
+			log.exception("event bus: publish of %s failed", ev.type)
+		return ev
+
+	async def _cleanup(self) -> None:
+		now = time.monotonic()
+		if now - self._last_cleanup < self.CLEANUP_EVERY_SEC:
+			return
+		self._last_cleanup = now
+		await self._pg(
+			"execute", f"DELETE FROM bus_events WHERE created_at < now() - interval '{self.RETENTION_SEC} seconds'"
+		)
+
+	def stats(self) -> Dict[str, Any]:
+		return {
+			**super().stats(),
+			"kind": "postgres",
+			"channel": self.channel,
+			"spilled": self.spilled,
+			"reconnects": self.reconnects,
+			"inbox": self._inbox.qsize(),
+		}
+
+
+def make_bus(kind: str = settings.EVENT_BUS) -> EventBus:
+	kind = (kind or "memory").lower()
+	if kind in ("postgres", "pg", "notify"):
+		if make_url(settings.DATABASE_URL).get_backend_name() == "sqlite":
+			raise ValueError("EVENT_BUS=postgres needs a PostgreSQL DATABASE_URL (SQLite: use EVENT_BUS=memory)")
+		return PostgresBus()
+	if kind != "memory":
+		log.warning("unknown EVENT_BUS %r, using in-memory bus", kind)
+	return EventBus()
+
+
+bus = make_bus()
@@ -10,5 +10,62 @@ class Settings(BaseModel):
 	JWT_ALG: str = os.getenv("JWT_ALG", "HS256")
 	JWT_EXPIRE_MIN: int = int(os.getenv("JWT_EXPIRE_MIN", "720"))
 	CORS_ORIGINS: str = os.getenv("CORS_ORIGINS", "*")
+	# GET /metrics (formato Prometheus): se impostato serve "Authorization: Bearer <token>"
+	METRICS_TOKEN: str = os.getenv("METRICS_TOKEN", "")
+	# Profiler SQL per richiesta (see profiler.py): header Server-Timing, query lente, N+1
+	SQL_PROFILE: bool = os.getenv("SQL_PROFILE", "0").lower() in ("1", "true", "yes")
+	SQL_SLOW_MS: float = float(os.getenv("SQL_SLOW_MS", "100"))
+	SQL_N1_THRESHOLD: int = int(os.getenv("SQL_N1_THRESHOLD", "5"))
+	SQL_LOG_PARAMS_MAX: int = int(os.getenv("SQL_LOG_PARAMS_MAX", "500"))
+	# Pool connessioni DB (see db.py), per processo: con N worker uvicorn sono N pool.
+	# Con SQLite su file valgono solo SIZE/OVERFLOW/TIMEOUT; il resto e' ignorato.
+	DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "5"))
+	DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+	DB_POOL_TIMEOUT_SEC: float = float(os.getenv("DB_POOL_TIMEOUT_SEC", "30"))
+	DB_POOL_RECYCLE_SEC: int = int(os.getenv("DB_POOL_RECYCLE_SEC", "1800"))
+	# always | idle (solo connessioni ferme da piu' di DB_POOL_PING_IDLE_SEC) | never
+	DB_POOL_PRE_PING: str = os.getenv("DB_POOL_PRE_PING", "idle").lower()
+	DB_POOL_PING_IDLE_SEC: float = float(os.getenv("DB_POOL_PING_IDLE_SEC", "30"))
+	# Prepared statement asyncpg in cache per connessione; 0 dietro pgbouncer in transaction mode
+	DB_STATEMENT_CACHE_SIZE: int = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+	# Modalita' edge, DATABASE_URL=sqlite+aiosqlite:///... (see sqlite.py): WAL, pragma per connessione
+	SQLITE_SYNCHRONOUS: str = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+	SQLITE_BUSY_TIMEOUT_MS: int = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+	SQLITE_CACHE_MB: int = int(os.getenv("SQLITE_CACHE_MB", "32"))
+	SQLITE_MMAP_MB: int = int(os.getenv("SQLITE_MMAP_MB", "128"))
+	# Argon2 (password hash): i default sono quelli di passlib, gli hash esistenti restano validi
+	ARGON2_TIME_COST: int = int(os.getenv("ARGON2_TIME_COST", "3"))
+	ARGON2_MEMORY_KIB: int = int(os.getenv("ARGON2_MEMORY_KIB", "65536"))
+	ARGON2_PARALLELISM: int = int(os.getenv("ARGON2_PARALLELISM", "4"))
+	AUTH_HASH_THREADS: int = int(os.getenv("AUTH_HASH_THREADS", "2"))
+	# Cache degli utenti autenticati (see security.PrincipalCache); TTL 0 = disattivata
+	AUTH_CACHE_TTL_SEC: float = float(os.getenv("AUTH_CACHE_TTL_SEC", "60"))
+	AUTH_CACHE_SIZE: int = int(os.getenv("AUTH_CACHE_SIZE", "1024"))
+	# Ora (locale) in cui inizia la giornata di servizio: il numero comanda riparte da 1
+	ORDER_DAY_START_HOUR: int = int(os.getenv("ORDER_DAY_START_HOUR", "6"))
+	# Print spooler
+	PRINT_MAX_ATTEMPTS: int = int(os.getenv("PRINT_MAX_ATTEMPTS", "5"))
+	PRINT_RETRY_BASE_SEC: float = float(os.getenv("PRINT_RETRY_BASE_SEC", "1.0"))
+	PRINT_RETRY_MAX_SEC: float = float(os.getenv("PRINT_RETRY_MAX_SEC", "30.0"))
+	PRINT_THREADS: int = int(os.getenv("PRINT_THREADS", "4"))
+	# Un job in SENDING piu' vecchio di cosi' (crash durante l'invio) torna in QUEUED; rinnovato a
+	# ogni tentativo, quindi deve superare un invio piu' il backoff massimo
+	PRINT_LEASE_SEC: float = float(os.getenv("PRINT_LEASE_SEC", "120"))
+	# WebSocket fan-out (see realtime.ConnectionManager)
+	WS_QUEUE_SIZE: int = int(os.getenv("WS_QUEUE_SIZE", "256"))
+	WS_SEND_TIMEOUT_SEC: float = float(os.getenv("WS_SEND_TIMEOUT_SEC", "5.0"))
+	# Replay per /ws?since=<seq> (see eventlog.py): eventi tenuti in memoria, massimo rispedito
+	# dalla tabella ws_outbox (oltre: il client ricarica tutto) e per quanto restano in tabella
+	WS_REPLAY_BUFFER: int = int(os.getenv("WS_REPLAY_BUFFER", "1000"))
+	WS_REPLAY_MAX: int = int(os.getenv("WS_REPLAY_MAX", "500"))
+	WS_OUTBOX_RETENTION_SEC: int = int(os.getenv("WS_OUTBOX_RETENTION_SEC", "21600"))
+	# Printer connections (see printers.PrinterRegistry)
+	PRINTER_CONNECT_TIMEOUT_SEC: float = float(os.getenv("PRINTER_CONNECT_TIMEOUT_SEC", "5.0"))
+	PRINTER_KEEPALIVE_SEC: int = int(os.getenv("PRINTER_KEEPALIVE_SEC", "30"))
+	PRINTER_IDLE_CLOSE_SEC: float = float(os.getenv("PRINTER_IDLE_CLOSE_SEC", "300"))
+	# Event bus tra worker/nodi (see bus.py): memory | postgres
+	EVENT_BUS: str = os.getenv("EVENT_BUS", "memory")
+	EVENT_BUS_CHANNEL: str = os.getenv("EVENT_BUS_CHANNEL", "cassa_events")
+	EVENT_BUS_MAX_NOTIFY: int = int(os.getenv("EVENT_BUS_MAX_NOTIFY", "7900"))
 
 settings = Settings()
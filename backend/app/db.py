@@ -1,10 +1,153 @@
+from __future__ import annotations
+
+import logging
+import time
+from typing import Any, Dict
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
+from . import sqlite
 from .config import settings
+from .metrics import Counter, Gauge, Histogram, instrument_engine
+
+log = logging.getLogger("cassa.db")
+
+PRE_PING_POLICIES = ("always", "idle", "never")
+
+
+class PoolMetrics:
+	"""Contatori dei checkout dal pool; stanno fuori dal pool perche' engine.dispose() lo ricrea."""
+
+	def __init__(self) -> None:
+		self.checkouts = 0
+		self.waiting = 0  # checkout in corso (in coda o in connessione)
+		self.wait_total = 0.0
+		self.wait_max = 0.0
+		self.timeouts = 0
+		self.pings = 0
+		self.ping_failures = 0
+
+
+pool_metrics = PoolMetrics()
+pool_wait = Histogram("cassa_db_pool_wait_seconds", "Time to check a connection out of the pool.")
+
+
+class MeteredPool(AsyncAdaptedQueuePool):
+	"""AsyncAdaptedQueuePool che misura quante richieste aspettano una connessione e per quanto."""
 
-engine = create_async_engine(settings.DATABASE_URL, echo=False, pool_pre_ping=True)
+	def connect(self):
+		m = pool_metrics
+		m.waiting += 1
+		t0 = time.perf_counter()
+		try:
+			return super().connect()
+		except PoolTimeoutError:
+			m.timeouts += 1
+			raise
+		finally:
+			dt = time.perf_counter() - t0
+			m.waiting -= 1
+			m.checkouts += 1
+			m.wait_total += dt
+			if dt > m.wait_max:
+				m.wait_max = dt
+			pool_wait.observe(dt)
+
+
+def _engine_options(url: str) -> Dict[str, Any]:
+	policy = settings.DB_POOL_PRE_PING
+	if policy not in PRE_PING_POLICIES:
+		raise ValueError(f"DB_POOL_PRE_PING must be one of {', '.join(PRE_PING_POLICIES)}, got {policy!r}")
+	u = make_url(url)
+	if u.get_backend_name() == "sqlite":
+		if u.database in (None, "", ":memory:"):
+			return {}  # in memoria: il pool di default tiene in vita il DB
+		# file: niente recycle ne' ping (nessuna rete in mezzo), ma stesso pool misurato
+		return {
+			"poolclass": MeteredPool,
+			"pool_size": settings.DB_POOL_SIZE,
+			"max_overflow": settings.DB_MAX_OVERFLOW,
+			"pool_timeout": settings.DB_POOL_TIMEOUT_SEC,
+		}
+	opts: Dict[str, Any] = {
+		"poolclass": MeteredPool,
+		"pool_size": settings.DB_POOL_SIZE,
+		"max_overflow": settings.DB_MAX_OVERFLOW,
+		"pool_timeout": settings.DB_POOL_TIMEOUT_SEC,
+		"pool_recycle": settings.DB_POOL_RECYCLE_SEC,
+		"pool_pre_ping": policy == "always",
+	}
+	if u.get_driver_name() == "asyncpg":
+		opts["connect_args"] = {"prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE}
+	return opts
+
+
+engine = create_async_engine(settings.DATABASE_URL, echo=False, **_engine_options(settings.DATABASE_URL))
 SessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+instrument_engine(engine.sync_engine)
+IS_SQLITE = engine.dialect.name == "sqlite"
+
+if IS_SQLITE:
+	sqlite.configure(engine.sync_engine)
+elif settings.DB_POOL_PRE_PING == "idle" and isinstance(engine.sync_engine.pool, QueuePool):
+	# Ping solo delle connessioni ferme da un po' (quelle che un firewall/pgbouncer puo' aver chiuso):
+	# sul percorso caldo una connessione appena restituita non paga il round trip in piu'.
+	@event.listens_for(engine.sync_engine, "checkin")
+	def _on_checkin(dbapi_connection, record) -> None:
+		record.info["checked_in_at"] = time.monotonic()
+
+	@event.listens_for(engine.sync_engine, "checkout")
+	def _on_checkout(dbapi_connection, record, proxy) -> None:
+		since = record.info.get("checked_in_at")
+		if since is None or time.monotonic() - since < settings.DB_POOL_PING_IDLE_SEC:
+			return
+		pool_metrics.pings += 1
+		try:
+			engine.dialect.do_ping(dbapi_connection)
+		except Exception as e:
+			pool_metrics.ping_failures += 1
+			log.info("stale pooled connection discarded: %s", e)
+			raise DisconnectionError() from e  # il pool la scarta e ne apre un'altra
+
+
+def pool_stats() -> Dict[str, Any]:
+	pool = engine.sync_engine.pool
+	m = pool_metrics
+	out: Dict[str, Any] = {
+		"pool": type(pool).__name__,
+		"pre_ping": "never" if IS_SQLITE else settings.DB_POOL_PRE_PING,
+		"checkouts": m.checkouts,
+		"waiting": m.waiting,
+		"wait_avg_ms": round(m.wait_total / m.checkouts * 1000, 3) if m.checkouts else 0.0,
+		"wait_max_ms": round(m.wait_max * 1000, 3),
+		"timeouts": m.timeouts,
+		"pings": m.pings,
+		"ping_failures": m.ping_failures,
+	}
+	if isinstance(pool, QueuePool):
+		out.update(
+			size=pool.size(),
+			checked_out=pool.checkedout(),
+			checked_in=pool.checkedin(),
+			overflow=max(0, pool.overflow()),
+		)
+	if isinstance(pool, MeteredPool):
+		out["max_overflow"] = settings.DB_MAX_OVERFLOW
+	return out
+
+
+db_pool = Gauge(
+	"cassa_db_pool_connections", "Pool connections by state (waiting = checkouts in progress).", ["state"],
+	fn=lambda: {k: v for k, v in pool_stats().items() if k in ("checked_out", "checked_in", "overflow", "waiting")},
+)
+db_pool_timeouts = Counter("cassa_db_pool_timeouts_total", "Checkouts that hit DB_POOL_TIMEOUT_SEC.", fn=lambda: pool_metrics.timeouts)
+
 
 class Base(DeclarativeBase):
 	pass
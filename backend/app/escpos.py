@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import codecs
+import string
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# Comandi ESC/POS (sottoinsieme Epson TM supportato dalle termiche comuni).
+ESC = b"\x1b"
+GS = b"\x1d"
+INIT = ESC + b"@"
+CODEPAGE = ESC + b"t\x13"  # CP858: lettere accentate italiane + €
+ENCODING = "cp858"
+FEED_AND_CUT = ESC + b"d\x04" + GS + b"V\x42\x00"
+
+LEFT, CENTER, RIGHT = 0, 1, 2
+NORMAL, DOUBLE_HEIGHT, DOUBLE_WIDTH, DOUBLE = 0x00, 0x01, 0x10, 0x11
+WIDTH = 42  # colonne a font A su carta 80mm
+
+
+def _style(align: int, bold: bool, size: int) -> bytes:
+	return ESC + b"a" + bytes([align]) + ESC + b"E" + bytes([1 if bold else 0]) + GS + b"!" + bytes([size])
+
+
+RESET_STYLE = _style(LEFT, False, NORMAL)
+
+
+@dataclass(frozen=True)
+class Line:
+	"""Riga di template: `fmt` usa la sintassi di str.format con soli nomi di campo."""
+	fmt: str
+	align: int = LEFT
+	bold: bool = False
+	size: int = NORMAL
+	when: Optional[str] = None  # campo del contesto: la riga viene saltata se e' vuoto
+
+
+RULE = Line("-" * WIDTH)
+
+
+# Il codec cp858 della stdlib usa una mappa Python (lento): costruiamo la EncodingMap in C.
+_CP858_MAP = codecs.charmap_build(bytes(range(256)).decode(ENCODING))
+
+
+def _enc(s: str) -> bytes:
+	return s.encode("ascii") if s.isascii() else codecs.charmap_encode(s, "replace", _CP858_MAP)[0]
+
+
+_Fragment = Tuple[Optional[str], str, Tuple[str, ...]]
+
+
+def _compile(lines: Sequence[Line]) -> Tuple[_Fragment, ...]:
+	"""Compila le righe in frammenti `(when, template, campi)` con gli stili ESC/POS gia' inclusi.
+
+	Ogni frammento si riempie con un solo `template % valori`; le righe consecutive senza
+	condizione vengono fuse, e l'intero ticket viene codificato con un solo encode.
+	"""
+	out: List[_Fragment] = []
+	for line in lines:
+		tpl = _style(line.align, line.bold, line.size).decode("ascii")
+		fields: List[str] = []
+		for literal, field, _spec, _conv in string.Formatter().parse(line.fmt):
+			if literal:
+				tpl += literal.replace("%", "%%")
+			if field is not None:
+				tpl += "%s"
+				fields.append(field)
+		tpl += "\n" + RESET_STYLE.decode("ascii")
+		if line.when is None and out and out[-1][0] is None:
+			out[-1] = (None, out[-1][1] + tpl, out[-1][2] + tuple(fields))
+		else:
+			out.append((line.when, tpl, tuple(fields)))
+	return tuple(out)
+
+
+def _render(fragments: Tuple[_Fragment, ...], ctx: Dict[str, Any], out: List[str]) -> None:
+	for when, tpl, fields in fragments:
+		if when is None or ctx.get(when):
+			out.append(tpl % tuple([ctx[f] for f in fields]))
+
+
+class TicketTemplate:
+	"""Layout di uno scontrino compilato una volta in %-template `str`, con gli stili ESC/POS inclusi.
+
+	`header` e `footer` vengono resi col contesto dell'ordine, `item` una volta per riga d'ordine;
+	il ticket intero viene poi codificato in cp858 con un solo encode. Frammenti gia' in `bytes`
+	costringerebbero a codificare ogni valore a parte: misurato, e' piu' lento.
+	"""
+
+	def __init__(self, name: str, header: Sequence[Line], item: Sequence[Line], footer: Sequence[Line] = ()) -> None:
+		self.name = name
+		self._header = _compile(header)
+		self._item = _compile(item)
+		self._footer = _compile(footer)
+
+	def render(self, ctx: Dict[str, Any], items: Sequence[Dict[str, Any]]) -> bytes:
+		out: List[str] = []
+		_render(self._header, ctx, out)
+		for it in items:
+			_render(self._item, it, out)
+		_render(self._footer, ctx, out)
+		return INIT + CODEPAGE + _enc("".join(out))
+
+
+COMANDA = TicketTemplate(
+	"comanda",
+	header=[
+		Line("COMANDA #{public_id}", align=CENTER, bold=True, size=DOUBLE),
+		Line("TAVOLO {table_number}", align=CENTER, bold=True, size=DOUBLE_HEIGHT),
+		Line("CAMERIERE: {waiter_name}"),
+		Line("COPERTI: {covers}  APERICENA: {apericena}"),
+		Line("NOTE: {note}", bold=True, when="note"),
+		RULE,
+	],
+	item=[
+		Line("{check} {qty} {name}", bold=True, size=DOUBLE_HEIGHT),
+		Line("    ({note})", when="note"),
+	],
+	footer=[RULE],
+)
+
+
+def order_context(order, table_number: int, waiter_name: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+	ctx = {
+		"public_id": order.public_id,
+		"table_number": table_number,
+		"waiter_name": waiter_name,
+		"covers": order.covers,
+		"apericena": order.apericena,
+		"note": order.note or "",
+	}
+	items = [
+		{
+			"check": "[x]" if it.is_done else "[ ]",
+			"qty": f"x{it.qty}" if it.qty != 1 else "",
+			"name": it.name,
+			"note": it.note or "",
+		}
+		for it in order.items
+	]
+	return ctx, items
+
+
+class RenderCache:
+	"""LRU dei ticket gia' resi, per (template, order id, order version).
+
+	La versione dell'ordine cambia a ogni modifica, quindi una voce non va mai invalidata:
+	ristampe e copie multiple dello stesso stato riusano i byte senza ricaricare le righe.
+	"""
+
+	def __init__(self, maxsize: int = 512) -> None:
+		self.maxsize = maxsize
+		self._lock = threading.Lock()
+		self._data: "OrderedDict[Tuple[str, int, int], bytes]" = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, template: TicketTemplate, order_id: int, version: int) -> Optional[bytes]:
+		key = (template.name, order_id, version)
+		with self._lock:
+			body = self._data.get(key)
+			if body is None:
+				self.misses += 1
+				return None
+			self._data.move_to_end(key)
+			self.hits += 1
+			return body
+
+	def put(self, template: TicketTemplate, order_id: int, version: int, body: bytes) -> bytes:
+		with self._lock:
+			self._data[(template.name, order_id, version)] = body
+			self._data.move_to_end((template.name, order_id, version))
+			while len(self._data) > self.maxsize:
+				self._data.popitem(last=False)
+		return body
+
+
+cache = RenderCache()
+
+
+def render_order(order, table_number: int, waiter_name: str, template: TicketTemplate = COMANDA) -> bytes:
+	"""Rende il corpo del ticket (senza ora di stampa ne' taglio) e lo salva in cache.
+
+	Chi chiama controlla prima `cache.get(...)`: su hit non serve nemmeno caricare le righe.
+	"""
+	ctx, items = order_context(order, table_number, waiter_name)
+	return cache.put(template, order.id, order.version, template.render(ctx, items))
+
+
+def finish(body: bytes, copies: int = 1, printed_at: Optional[datetime] = None) -> bytes:
+	"""Aggiunge ora di stampa e taglio carta; ripete il ticket per `copies` copie."""
+	ts = (printed_at or datetime.utcnow()).strftime("%Y-%m-%d %H:%M:%S")
+	one = body + _style(CENTER, False, NORMAL) + _enc(ts) + b"\n" + RESET_STYLE + FEED_AND_CUT
+	return one * max(1, copies)
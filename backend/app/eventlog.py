@@ -0,0 +1,239 @@
+"""Log degli eventi WS con numero di sequenza, per riprendere dopo una disconnessione.
+
+Ogni evento trasmesso ai socket (bus.publish con canali) viene scritto in `ws_outbox`: l'id della
+riga e' il suo `seq`, crescente e condiviso tra worker. Gli ultimi WS_REPLAY_BUFFER eventi restano
+anche in memoria, in ordine di seq (compresi quelli arrivati dagli altri worker).
+Le scritture sono raggruppate: chi pubblica accoda l'evento e un solo task scrive in tabella tutti
+quelli arrivati nel frattempo (una INSERT, un round trip), poi li trasmette in ordine di seq.
+Un client che si riconnette con `/ws?since=<ultimo seq visto>` riceve solo gli eventi persi del
+suo canale: dalla memoria se bastano, altrimenti dalla tabella (fino a WS_REPLAY_MAX). Se la sua
+posizione e' gia' uscita dal log, o gli eventi persi sono troppi, l'hello porta `resync: true` e
+il client ricarica lo stato con le API REST.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Deque, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, func, insert, select
+
+from .config import settings
+from .db import engine
+from .events import Event, with_seq
+from .models import WsOutbox
+
+log = logging.getLogger(__name__)
+
+Entry = Tuple[int, FrozenSet[str], Event]
+Deliver = Callable[[List[str], Event], Awaitable[None]]
+_Pending = Tuple[List[str], Event, Deliver, "asyncio.Future[Event]"]
+
+
+class EventLog:
+	CLEANUP_EVERY_SEC = 60.0
+	BATCH_MAX = 256  # eventi per INSERT
+
+	def __init__(
+		self,
+		size: int = settings.WS_REPLAY_BUFFER,
+		replay_max: int = settings.WS_REPLAY_MAX,
+		retention: int = settings.WS_OUTBOX_RETENTION_SEC,
+	) -> None:
+		self.size = max(1, size)
+		self.replay_max = replay_max
+		self.retention = retention
+		self._ring: Deque[Entry] = deque()
+		self.floor = 0  # tutti gli eventi con seq > floor sono nel ring
+		self.last = 0
+		# eventi in attesa di seq; un solo task li scrive e li trasmette, in ordine di seq
+		self._pending: List[_Pending] = []
+		self._writer: Optional[asyncio.Task] = None
+		self._last_cleanup = 0.0
+		self.appended = 0
+		self.batches = 0
+		self.failed = 0
+		self.replays = 0
+		self.replayed = 0
+		self.resyncs = 0
+
+	async def load(self) -> None:
+		"""Riempie il ring dagli ultimi eventi in tabella (all'avvio e dopo un resync del bus)."""
+		async with engine.connect() as conn:
+			rows = (
+				await conn.execute(
+					select(WsOutbox.seq, WsOutbox.channels, WsOutbox.payload).order_by(WsOutbox.seq.desc()).limit(self.size)
+				)
+			).all()
+		self._ring = deque(_entry(seq, channels, payload) for seq, channels, payload in reversed(rows))
+		self.last = rows[0].seq if rows else 0
+		self.floor = rows[-1].seq - 1 if rows else 0
+
+	# ----------------------------- scrittura -----------------------------
+	async def append(self, channels: List[str], event: Event, deliver: Deliver) -> Event:
+		"""Scrive l'evento nel log, lo trasmette con deliver() e lo restituisce con il suo `seq`.
+
+		L'evento entra nel prossimo batch: la scrittura e' fuori dal percorso di chi pubblica, e i
+		socket locali ricevono gli eventi in ordine di seq. Se il DB fallisce parte senza seq.
+		"""
+		fut: asyncio.Future[Event] = asyncio.get_running_loop().create_future()
+		self._pending.append((channels, event, deliver, fut))
+		if self._writer is None or self._writer.done():
+			self._writer = asyncio.create_task(self._write_loop(), name="eventlog-writer")
+		return await fut
+
+	async def _write_loop(self) -> None:
+		while self._pending:
+			batch = self._pending[: self.BATCH_MAX]
+			del self._pending[: self.BATCH_MAX]
+			try:
+				seqs = await self._insert(batch)
+			except Exception:
+				# gli eventi partono comunque, senza seq: chi li perde li ritrova solo con un resync
+				self.failed += len(batch)
+				log.exception("event log: append of %d events failed", len(batch))
+				out = batch
+			else:
+				self.appended += len(batch)
+				self.batches += 1
+				out = []
+				# con piu' righe nella stessa INSERT i seq non sono garantiti in ordine di riga
+				for i in sorted(range(len(batch)), key=seqs.__getitem__):
+					channels, event, deliver, fut = batch[i]
+					ev = with_seq(event, seqs[i])
+					self.record(channels, ev)
+					out.append((channels, ev, deliver, fut))
+			for channels, ev, deliver, fut in out:
+				try:
+					await deliver(channels, ev)
+				except Exception:
+					log.exception("event log: delivery of %s failed", ev.type)
+				if not fut.done():
+					fut.set_result(ev)
+
+	async def _insert(self, batch: List[_Pending]) -> List[int]:
+		now = datetime.utcnow()
+		rows = [{"channels": ",".join(channels), "payload": event.text, "created_at": now} for channels, event, _, _ in batch]
+		async with engine.begin() as conn:
+			if len(rows) == 1:
+				seqs = [(await conn.execute(insert(WsOutbox).returning(WsOutbox.seq), rows[0])).scalar_one()]
+			else:
+				res = await conn.execute(insert(WsOutbox).returning(WsOutbox.seq, sort_by_parameter_order=True), rows)
+				seqs = list(res.scalars())
+			await self._cleanup(conn)
+		return seqs
+
+	def record(self, channels: Iterable[str], event: Event) -> None:
+		"""Aggiunge al ring un evento con seq (anche quelli arrivati da altri worker)."""
+		seq = event.seq
+		if seq is None or seq <= self.floor:
+			return
+		entry = (seq, frozenset(channels), event)
+		ring = self._ring
+		if not ring or seq > ring[-1][0]:
+			ring.append(entry)
+		else:
+			# in ritardo rispetto a un altro worker: di solito di pochi posti
+			i = len(ring)
+			while i > 0 and ring[i - 1][0] > seq:
+				i -= 1
+			if i > 0 and ring[i - 1][0] == seq:
+				return
+			ring.insert(i, entry)
+		if seq > self.last:
+			self.last = seq
+		while len(ring) > self.size:
+			self.floor = ring.popleft()[0]
+
+	async def _cleanup(self, conn: Any) -> None:
+		now = time.monotonic()
+		if now - self._last_cleanup < self.CLEANUP_EVERY_SEC:
+			return
+		self._last_cleanup = now
+		cutoff = datetime.utcnow() - timedelta(seconds=self.retention)
+		await conn.execute(delete(WsOutbox).where(WsOutbox.created_at < cutoff))
+
+	# ----------------------------- replay -----------------------------
+	def covers(self, since: int) -> bool:
+		return self.floor <= since <= self.last
+
+	def tail(self, since: int, channel: str) -> Optional[List[Event]]:
+		"""Eventi del canale con seq > since, dal ring; None se il ring non arriva fin li'."""
+		if not self.covers(since):
+			return None
+		out: List[Event] = []
+		for seq, channels, ev in reversed(self._ring):
+			if seq <= since:
+				break
+			if channel in channels:
+				out.append(ev)
+		out.reverse()
+		return out
+
+	async def fetch(self, since: int, channel: str) -> Optional[Tuple[List[Event], int]]:
+		"""Eventi persi letti da ws_outbox e il seq piu' alto letto (di qualsiasi canale).
+
+		None se la posizione e' persa o gli eventi sono troppi.
+		"""
+		async with engine.connect() as conn:
+			oldest = (await conn.execute(select(func.min(WsOutbox.seq)))).scalar()
+			if oldest is None or since < oldest - 1 or since > self.last:
+				return None
+			rows = (
+				await conn.execute(
+					select(WsOutbox.seq, WsOutbox.channels, WsOutbox.payload)
+					.where(WsOutbox.seq > since)
+					.order_by(WsOutbox.seq)
+					.limit(self.replay_max + 1)
+				)
+			).all()
+		if len(rows) > self.replay_max:
+			return None
+		upto = rows[-1].seq if rows else since
+		return [ev for seq, channels, ev in (_entry(*r) for r in rows) if channel in channels], upto
+
+	async def missed(self, since: int, channel: str) -> Tuple[Optional[List[Event]], int]:
+		"""Prima parte del replay, da chiamare prima di registrare il socket (puo' leggere il DB).
+
+		Restituisce gli eventi e il seq fin dove e' arrivata la lettura. Dopo la registrazione,
+		senza await in mezzo, va completato con tail() da quel seq: copre gli eventi arrivati
+		durante la lettura (non dall'ultimo evento del canale, che puo' essere molto piu' indietro).
+		"""
+		if self.covers(since):
+			return [], since
+		found = await self.fetch(since, channel)
+		return (None, since) if found is None else found
+
+	def note_replay(self, events: Optional[List[Event]]) -> None:
+		if events is None:
+			self.resyncs += 1
+		else:
+			self.replays += 1
+			self.replayed += len(events)
+
+	def stats(self) -> Dict[str, Any]:
+		return {
+			"buffered": len(self._ring),
+			"size": self.size,
+			"floor": self.floor,
+			"last": self.last,
+			"appended": self.appended,
+			"batches": self.batches,
+			"pending": len(self._pending),
+			"failed": self.failed,
+			"replays": self.replays,
+			"replayed": self.replayed,
+			"resyncs": self.resyncs,
+		}
+
+
+def _entry(seq: int, channels: str, payload: str) -> Entry:
+	ev = with_seq(Event(json.loads(payload), payload.encode("utf-8")), seq)
+	return seq, frozenset(channels.split(",")), ev
+
+
+eventlog = EventLog()
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import json
+import time
+from typing import Any, Dict, Optional
+
+# orjson e' opzionale (pip install .[fast]): ~5-10x piu' veloce di json e restituisce gia' bytes.
+try:
+	import orjson  # type: ignore
+except Exception:  # pragma: no cover
+	orjson = None
+
+# msgpack e' opzionale (pip install .[msgpack]): senza, i client che lo chiedono ricevono JSON.
+try:
+	import msgpack  # type: ignore
+except Exception:  # pragma: no cover
+	msgpack = None
+
+
+def dumps(obj: Any) -> bytes:
+	if orjson is not None:
+		return orjson.dumps(obj)
+	return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+# Chiavi per i filtri delle sottoscrizioni WS, oltre a `type`: nel payload o nel suo "order"
+ROUTING_KEYS = ("waiter_id", "table_number")
+
+
+class Event:
+	"""Evento WS serializzato una sola volta e condiviso da tutti i canali e le connessioni.
+
+	`payload` deve essere gia' JSON-compatibile (es. `model_dump(mode="json")`); `data`, se gia'
+	noto, e' il suo JSON. Gli eventi trasmessi ai socket hanno un `seq` (see eventlog.py).
+	"""
+
+	__slots__ = ("payload", "seq", "_data", "_text", "_packed", "_keys", "created")
+
+	def __init__(self, payload: Dict[str, Any], data: Optional[bytes] = None) -> None:
+		self.payload = payload
+		self.seq: Optional[int] = payload.get("seq")
+		self.created = time.perf_counter()  # per la latenza publish -> frame inviato (metrics)
+		self._data = data
+		self._text: Optional[str] = None
+		self._packed: Optional[bytes] = None
+		self._keys: Optional[Dict[str, Any]] = None
+
+	@property
+	def type(self) -> str:
+		return self.payload.get("type", "")
+
+	@property
+	def keys(self) -> Dict[str, Any]:
+		"""Valori su cui filtrano le sottoscrizioni (see realtime.ConnectionManager)."""
+		if self._keys is None:
+			p = self.payload
+			order = p.get("order")
+			keys: Dict[str, Any] = {"type": p.get("type")}
+			for k in ROUTING_KEYS:
+				v = p.get(k)
+				if v is None and isinstance(order, dict):
+					v = order.get(k)
+				if v is not None:
+					keys[k] = v
+			self._keys = keys
+		return self._keys
+
+	@property
+	def data(self) -> bytes:
+		if self._data is None:
+			self._data = dumps(self.payload)
+		return self._data
+
+	@property
+	def text(self) -> str:
+		# i frame WS di testo vogliono str: decodifica una volta sola, poi riusata per ogni socket
+		if self._text is None:
+			self._text = self.data.decode("utf-8")
+		return self._text
+
+	@property
+	def packed(self) -> bytes:
+		"""MessagePack per i socket con ?format=msgpack (frame binari); anche questo una volta sola."""
+		if self._packed is None:
+			self._packed = msgpack.packb(self.payload, use_bin_type=True)
+		return self._packed
+
+
+def as_event(event: "Event | Dict[str, Any]") -> Event:
+	return event if isinstance(event, Event) else Event(event)
+
+
+def with_seq(event: Event, seq: int) -> Event:
+	"""Copia dell'evento con `seq` in testa al payload, senza riserializzarlo."""
+	data = event.data
+	head = b'{"seq":%d' % seq
+	ev = Event({"seq": seq, **event.payload}, head + (b"," + data[1:] if len(data) > 2 else b"}"))
+	ev.created = event.created
+	return ev
@@ -1,23 +1,41 @@
 from __future__ import annotations
 
-import random
-import string
-from datetime import datetime
+import base64
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
 from typing import Any, Dict, List, Optional
 
-from fastapi import Depends, FastAPI, HTTPException, Query, WebSocket, WebSocketDisconnect
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy import select
+from sqlalchemy import and_, case, func, insert, literal, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 
+from . import escpos, events, profiler
+from .bus import bus
 from .config import settings
-from .db import Base, engine, get_db, SessionLocal
-from .models import CallEvent, CallType, MenuItem, Order, OrderItem, OrderStatus, Printer, PrintJob, Role, Table, User
-from .printers import get_adapter
-from .realtime import manager
-from .schemas import CallIn, CallOut, CreateOrderIn, MenuItemOut, OrderOut, Token, UpdateItemDoneIn, UserOut
-from .security import create_access_token, hash_password, verify_password, get_current_user
+from .db import engine, get_db, pool_stats
+from .eventlog import eventlog
+from .events import Event
+from .menu import menu_cache
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY, MetricsMiddleware, loop_monitor
+from .migrate import check_schema
+from .models import CallEvent, CallType, MenuItem, Order, OrderCounter, OrderItem, OrderStatus, Printer, PrintJob, Role, Table, User
+from .projection import live_orders, load_order_out, order_to_out
+from .realtime import manager, matches
+from .schemas import BulkItemDoneIn, CallIn, CallOut, CreateOrderIn, MenuItemOut, MenuItemUpdateIn, OrderOut, Token, UpdateItemDoneIn, UserOut, UserUpdateIn
+from .security import (
+	create_access_token,
+	get_current_user,
+	invalidate_principal,
+	principals,
+	user_from_token,
+	verify_password_async,
+)
+from .spooler import spooler
 
 app = FastAPI(title="Cassa Realtime Backend", version="0.1.0")
 
@@ -28,96 +46,78 @@ app.add_middleware(
 	allow_methods=["*"],
 	allow_headers=["*"],
 )
+if settings.SQL_PROFILE:
+	# aggiunto prima di MetricsMiddleware, quindi piu' interno: legge il DbUsage che quello apre
+	profiler.enable()
+	app.add_middleware(profiler.SqlProfilerMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 # Serve frontend static (dev-friendly)
 app.mount("/bar", StaticFiles(directory="../frontend/bar", html=True), name="bar")
 app.mount("/cameriere", StaticFiles(directory="../frontend/cameriere", html=True), name="cameriere")
 app.mount("/cassa", StaticFiles(directory="../frontend/cassa", html=True), name="cassa")
 app.mount("/admin", StaticFiles(directory="../frontend/admin", html=True), name="admin")
+app.mount("/shared", StaticFiles(directory="../frontend/shared"), name="shared")
 
 
-def _rand_public_id(n: int = 5) -> str:
-	return "".join(random.choice(string.digits) for _ in range(n))
-
-
-def _order_to_out(order: Order, table_number: int, waiter_name: str) -> OrderOut:
-	return OrderOut(
-		id=order.id,
-		public_id=order.public_id,
-		table_id=order.table_id,
-		table_number=table_number,
-		waiter_id=order.waiter_id,
-		waiter_name=waiter_name,
-		covers=order.covers,
-		apericena=order.apericena,
-		note=order.note,
-		status=order.status,
-		created_at=order.created_at,
-		ready_at=order.ready_at,
-		items=[
-			{
-				"id": it.id,
-				"line_no": it.line_no,
-				"menu_item_id": it.menu_item_id,
-				"name": it.name,
-				"note": it.note,
-				"qty": it.qty,
-				"is_done": it.is_done,
-			}
-			for it in order.items
-		],
+def _service_day() -> date:
+	return (datetime.now() - timedelta(hours=settings.ORDER_DAY_START_HOUR)).date()
+
+
+async def _next_public_id(db: AsyncSession) -> str:
+	"""Numero comanda "AAMMGG-NNN": contatore per giornata di servizio, senza collisioni.
+
+	L'upsert blocca la riga del giorno fino al commit, quindi due create_order concorrenti
+	prendono numeri diversi; in caso di rollback il numero puo' restare inutilizzato.
+	"""
+	day = _service_day()
+	ins = pg_insert if engine.dialect.name == "postgresql" else sqlite_insert
+	stmt = (
+		ins(OrderCounter)
+		.values(day=day, last=1)
+		.on_conflict_do_update(index_elements=[OrderCounter.day], set_={"last": OrderCounter.last + 1})
+		.returning(OrderCounter.last)
 	)
+	n = (await db.execute(stmt)).scalar_one()
+	return f"{day:%y%m%d}-{n:03d}"
 
 
-async def _ensure_seed(db: AsyncSession) -> None:
-	# Users
-	res = await db.execute(select(User).limit(1))
-	if res.scalar_one_or_none() is None:
-		users = [
-			User(username="admin", display_name="Admin", role=Role.ADMIN, password_hash=hash_password("admin")),
-			User(username="emma", display_name="Emma", role=Role.WAITER, password_hash=hash_password("1234")),
-			User(username="luca", display_name="Luca", role=Role.WAITER, password_hash=hash_password("1234")),
-			User(username="marco", display_name="Marco", role=Role.CASHIER, password_hash=hash_password("1234")),
-			User(username="bar", display_name="Bar", role=Role.BAR, password_hash=hash_password("1234")),
-		]
-		db.add_all(users)
-
-	# Tables 1..30
-	res = await db.execute(select(Table).limit(1))
-	if res.scalar_one_or_none() is None:
-		db.add_all([Table(number=i) for i in range(1, 31)])
-
-	# Menu demo
-	res = await db.execute(select(MenuItem).limit(1))
-	if res.scalar_one_or_none() is None:
-		db.add_all([
-			MenuItem(sku="spritz", name="Spritz", category="Drink", price=6.00),
-			MenuItem(sku="gin_tonic", name="Gin Tonic", category="Drink", price=8.00),
-			MenuItem(sku="negroni", name="Negroni", category="Drink", price=9.00),
-			MenuItem(sku="analcolico", name="Analcolico", category="Drink", price=5.00),
-			MenuItem(sku="caffe", name="Caffè", category="Caffetteria", price=1.20),
-			MenuItem(sku="cappuccino", name="Cappuccino", category="Caffetteria", price=1.80),
-			MenuItem(sku="cornetto", name="Cornetto", category="Caffetteria", price=1.50),
-			MenuItem(sku="tagliere", name="Tagliere", category="Apericena", price=12.00),
-			MenuItem(sku="nachos", name="Nachos", category="Apericena", price=7.50),
-			MenuItem(sku="patatine", name="Patatine", category="Apericena", price=4.00),
-		])
-
-	# Printer demo
-	res = await db.execute(select(Printer).limit(1))
-	if res.scalar_one_or_none() is None:
-		db.add(Printer(name="BAR_PRINTER", kind="dummy", connection="bar"))
+def _encode_cursor(created_at: datetime, order_id: int) -> str:
+	return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{order_id}".encode()).decode().rstrip("=")
 
-	await db.commit()
+
+def _decode_cursor(cursor: str) -> tuple[datetime, int]:
+	try:
+		raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+		ts, oid = raw.rsplit("|", 1)
+		return datetime.fromisoformat(ts), int(oid)
+	except Exception:
+		raise HTTPException(status_code=400, detail="Cursore non valido")
 
 
 @app.on_event("startup")
 async def on_startup() -> None:
-	async with engine.begin() as conn:
-		await conn.run_sync(Base.metadata.create_all)
-	# seed
-	async with SessionLocal() as db:
-		await _ensure_seed(db)
+	# Schema e dati demo non si toccano all'avvio: python -m app.migrate / python -m app.seed
+	await check_schema()
+	# Il bus parte prima del rebuild: gli eventi remoti arrivati nel frattempo vengono riapplicati
+	# sopra lo snapshot. Dopo una riconnessione del listener la proiezione si ricostruisce da DB.
+	bus.subscribe(live_orders.apply_event)
+	bus.subscribe(principals.apply_event)
+	bus.subscribe(menu_cache.apply_event)
+	bus.on_resync(live_orders.rebuild)
+	bus.on_resync(eventlog.load)
+	await eventlog.load()
+	await bus.start()
+	await live_orders.rebuild()
+	await spooler.start()
+	loop_monitor.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown() -> None:
+	await loop_monitor.stop()
+	await spooler.stop()
+	await bus.stop()
 
 
 # ----------------------------- AUTH -----------------------------
@@ -127,8 +127,15 @@ async def login(data: Dict[str, str], db: AsyncSession = Depends(get_db)):
 	password = data.get("password") or ""
 	res = await db.execute(select(User).where(User.username == username, User.is_active == True))
 	user = res.scalar_one_or_none()
-	if not user or not verify_password(password, user.password_hash):
+	if not user:
+		raise HTTPException(status_code=401, detail="Credenziali non valide")
+	ok, new_hash = await verify_password_async(password, user.password_hash)
+	if not ok:
 		raise HTTPException(status_code=401, detail="Credenziali non valide")
+	if new_hash:
+		# parametri Argon2 cambiati (Settings): aggiorna l'hash ora che abbiamo la password in chiaro
+		user.password_hash = new_hash
+		await db.commit()
 	return Token(access_token=create_access_token(user.username))
 
 
@@ -139,29 +146,117 @@ async def me(user: User = Depends(get_current_user)):
 
 # ----------------------------- MENU -----------------------------
 @app.get("/api/menu", response_model=List[MenuItemOut])
-async def list_menu(db: AsyncSession = Depends(get_db), user: User = Depends(get_current_user)):
-	res = await db.execute(select(MenuItem).where(MenuItem.is_active == True).order_by(MenuItem.category, MenuItem.name))
-	items = res.scalars().all()
-	return [MenuItemOut(id=i.id, sku=i.sku, name=i.name, category=i.category, price=float(i.price)) for i in items]
+async def list_menu(
+	if_none_match: Optional[str] = Header(default=None),
+	user: User = Depends(get_current_user),
+):
+	snap = await menu_cache.get()
+	# no-cache: il browser rivalida sempre con If-None-Match e riusa la sua copia sul 304
+	headers = {"ETag": snap.etag, "Cache-Control": "private, no-cache"}
+	if snap.matches(if_none_match):
+		return Response(status_code=304, headers=headers)
+	return Response(content=snap.body, media_type="application/json", headers=headers)
+
+
+async def _invalidate_menu() -> None:
+	menu_cache.invalidate()
+	await bus.publish([], {"type": "menu_invalidated"})
+
+
+@app.patch("/api/admin/menu/{item_id}", response_model=MenuItemOut)
+async def update_menu_item(
+	item_id: int,
+	data: MenuItemUpdateIn,
+	db: AsyncSession = Depends(get_db),
+	user: User = Depends(get_current_user),
+):
+	if user.role != Role.ADMIN:
+		raise HTTPException(status_code=403, detail="Solo ADMIN")
+	res = await db.execute(select(MenuItem).where(MenuItem.id == item_id))
+	mi = res.scalar_one_or_none()
+	if not mi:
+		raise HTTPException(status_code=404, detail="Articolo non trovato")
+	for field, value in data.model_dump(exclude_unset=True).items():
+		if value is not None:
+			setattr(mi, field, value)
+	await db.commit()
+	await _invalidate_menu()
+	return MenuItemOut(id=mi.id, sku=mi.sku, name=mi.name, category=mi.category, price=float(mi.price))
+
+
+@app.post("/api/admin/menu/invalidate")
+async def invalidate_menu(user: User = Depends(get_current_user)):
+	# per modifiche al listino fatte direttamente sul DB
+	if user.role != Role.ADMIN:
+		raise HTTPException(status_code=403, detail="Solo ADMIN")
+	await _invalidate_menu()
+	return {"ok": True}
 
 
 # ----------------------------- ORDERS -----------------------------
+ORDERS_PAGE_SIZE = 500  # pagina di default quando il client segue il cursore senza ?limit
+
+
 @app.get("/api/orders", response_model=List[OrderOut])
 async def list_orders(
+	response: Response,
 	status: Optional[OrderStatus] = Query(default=None),
+	live: bool = Query(default=False),
+	since: Optional[datetime] = Query(default=None),
+	until: Optional[datetime] = Query(default=None),
+	table_number: Optional[int] = Query(default=None),
+	waiter_id: Optional[int] = Query(default=None),
+	cursor: Optional[str] = Query(default=None),
+	limit: Optional[int] = Query(default=None, ge=1, le=1000),
 	db: AsyncSession = Depends(get_db),
 	user: User = Depends(get_current_user),
 ):
-	q = select(Order, Table.number, User.display_name).join(Table, Table.id == Order.table_id).join(User, User.id == Order.waiter_id)
+	# Senza ?limit ne' ?cursor la lista e' completa, come prima della paginazione (i client
+	# esistenti non seguono X-Next-Cursor)
+	if limit is None and cursor is not None:
+		limit = ORDERS_PAGE_SIZE
+	# ?live=1: solo ordini non CLOSED della giornata di servizio, cioe' il contenuto della proiezione
+	# in memoria. La prima pagina arriva da li', senza DB; le successive (cursore) dal DB con gli
+	# stessi filtri, quindi le pagine compongono un'unica lista. Senza live si legge sempre il DB.
+	if live and status == OrderStatus.CLOSED:
+		return []
+	if live and cursor is None and live_orders.ready:
+		body, last = live_orders.list_json(status, since, until, table_number, waiter_id, limit)
+		headers = {"X-Next-Cursor": _encode_cursor(last.created_at, last.id)} if last is not None else None
+		return Response(content=body, media_type="application/json", headers=headers)
+
+	# Paginazione keyset su (created_at, id) decrescente: la pagina successiva si chiede con
+	# ?cursor=<X-Next-Cursor>. Le righe arrivano con una sola query extra (selectinload).
+	q = (
+		select(Order, Table.number, User.display_name)
+		.join(Table, Table.id == Order.table_id)
+		.join(User, User.id == Order.waiter_id)
+		.options(selectinload(Order.items))
+	)
 	if status:
 		q = q.where(Order.status == status)
-	res = await db.execute(q.order_by(Order.created_at.desc()))
+	if live:
+		live_orders.roll()
+		q = q.where(Order.status != OrderStatus.CLOSED, Order.created_at >= live_orders.day_start)
+	if since:
+		q = q.where(Order.created_at >= since)
+	if until:
+		q = q.where(Order.created_at < until)
+	if table_number is not None:
+		q = q.where(Table.number == table_number)
+	if waiter_id is not None:
+		q = q.where(Order.waiter_id == waiter_id)
+	if cursor:
+		c_ts, c_id = _decode_cursor(cursor)
+		q = q.where(or_(Order.created_at < c_ts, and_(Order.created_at == c_ts, Order.id < c_id)))
+	q = q.order_by(Order.created_at.desc(), Order.id.desc())
+	res = await db.execute(q.limit(limit + 1) if limit is not None else q)
 	rows = res.all()
-	out: List[OrderOut] = []
-	for order, tnum, waiter_name in rows:
-		await db.refresh(order, attribute_names=["items"])  # ensure items
-		out.append(_order_to_out(order, tnum, waiter_name))
-	return out
+	if limit is not None and len(rows) > limit:
+		rows = rows[:limit]
+		last = rows[-1][0]
+		response.headers["X-Next-Cursor"] = _encode_cursor(last.created_at, last.id)
+	return [order_to_out(order, tnum, waiter_name) for order, tnum, waiter_name in rows]
 
 
 @app.post("/api/orders", response_model=OrderOut)
@@ -173,73 +268,170 @@ async def create_order(
 	if user.role not in (Role.WAITER, Role.CASHIER, Role.ADMIN):
 		raise HTTPException(status_code=403, detail="Ruolo non autorizzato")
 
-	res = await db.execute(select(Table).where(Table.number == data.table_number))
-	table = res.scalar_one_or_none()
-	if not table:
+	# Unifica le righe duplicate (stesso prodotto + stessa nota) sommando le quantita'.
+	# Questo evita che il BAR veda righe ripetute e garantisce che la quantita' sia sempre corretta.
+	agg: dict[tuple[int, str | None], int] = {}
+	for it in data.items:
+		key = (int(it.menu_item_id), (it.note or None))
+		agg[key] = agg.get(key, 0) + int(it.qty)
+
+	# Articoli attivi dallo snapshot del menu (invalidato a ogni modifica): nessuna query
+	menu_items = (await menu_cache.get()).items
+	missing = [mid for mid in sorted({mid for (mid, _note) in agg.keys()}) if mid not in menu_items]
+	if missing:
+		raise HTTPException(status_code=400, detail=f"Articolo non valido: {missing[0]}")
+
+	# Apre il tavolo e ne legge l'id in un solo statement (prima: SELECT + UPDATE al commit)
+	res = await db.execute(
+		update(Table)
+		.where(Table.number == data.table_number)
+		.values(is_open=True, opened_by_user_id=user.id, opened_at=func.coalesce(Table.opened_at, datetime.utcnow()))
+		.returning(Table.id)
+	)
+	table_id = res.scalar_one_or_none()
+	if table_id is None:
+		await db.rollback()
 		raise HTTPException(status_code=404, detail="Tavolo non trovato")
 
-	public_id = _rand_public_id()
-	# avoid collision (rare)
-	for _ in range(3):
-		res = await db.execute(select(Order).where(Order.public_id == public_id))
-		if res.scalar_one_or_none() is None:
-			break
-		public_id = _rand_public_id()
+	public_id = await _next_public_id(db)
+	res = await db.execute(
+		insert(Order)
+		.values(
+			public_id=public_id,
+			table_id=table_id,
+			waiter_id=user.id,
+			covers=data.covers,
+			apericena=data.apericena,
+			note=data.note,
+			status=OrderStatus.OPEN,
+			version=1,
+			items_total=len(agg),
+			items_done=0,
+			created_at=datetime.utcnow(),
+		)
+		.returning(Order.id, Order.created_at)
+	)
+	order_id, created_at = res.one()
+
+	lines = [
+		{
+			"order_id": order_id,
+			"line_no": line_no,
+			"menu_item_id": menu_item_id,
+			"name": menu_items[menu_item_id].name,
+			"note": note,
+			"qty": qty,
+			"is_done": False,
+		}
+		for line_no, ((menu_item_id, note), qty) in enumerate(agg.items(), start=1)
+	]
+	item_ids: Dict[int, int] = {}
+	if lines:
+		# un solo INSERT ... VALUES (...), (...) RETURNING; l'ordine delle righe restituite non e'
+		# garantito, quindi gli id si abbinano per line_no
+		res = await db.execute(insert(OrderItem).returning(OrderItem.id, OrderItem.line_no), lines)
+		item_ids = {row.line_no: row.id for row in res}
+	await db.commit()
 
-	order = Order(
+	out = OrderOut(
+		id=order_id,
 		public_id=public_id,
-		table_id=table.id,
+		table_id=table_id,
+		table_number=data.table_number,
 		waiter_id=user.id,
+		waiter_name=user.display_name,
 		covers=data.covers,
 		apericena=data.apericena,
 		note=data.note,
 		status=OrderStatus.OPEN,
+		version=1,
+		created_at=created_at,
+		ready_at=None,
+		items=[{**ln, "id": item_ids[ln["line_no"]]} for ln in lines],
 	)
-	db.add(order)
-	await db.flush()  # get order.id
+	live_orders.apply(out)
 
-	# Unifica le righe duplicate (stesso prodotto + stessa nota) sommando le quantita'.
-	# Questo evita che il BAR veda righe ripetute e garantisce che la quantita' sia sempre corretta.
-	agg: dict[tuple[int, str | None], int] = {}
-	for it in data.items:
-		key = (int(it.menu_item_id), (it.note or None))
-		agg[key] = agg.get(key, 0) + int(it.qty)
+	await bus.publish(["bar", "admin", "cassa", "waiter"], {"type": "order_created", "order": out.model_dump(mode="json")})
+	return out
 
-	# Carica i menu item una volta sola
-	menu_ids = sorted({mid for (mid, _note) in agg.keys()})
-	res = await db.execute(select(MenuItem).where(MenuItem.id.in_(menu_ids), MenuItem.is_active == True))
-	menu_items = {m.id: m for m in res.scalars().all()}
-	missing = [mid for mid in menu_ids if mid not in menu_items]
-	if missing:
-		raise HTTPException(status_code=400, detail=f"Articolo non valido: {missing[0]}")
 
-	line_no = 1
-	for (menu_item_id, note), qty in agg.items():
-		mi = menu_items[menu_item_id]
-		item = OrderItem(
-			order_id=order.id,
-			line_no=line_no,
-			menu_item_id=mi.id,
-			name=mi.name,
-			note=note,
-			qty=qty,
-			is_done=False,
-		)
-		db.add(item)
-		line_no += 1
+@dataclass
+class _OrderTicks:
+	order_id: int
+	public_id: str
+	changes: Dict[int, bool]  # item_id -> is_done
+	version: int = 0
+	status: OrderStatus = OrderStatus.OPEN
+	ready_at: Optional[datetime] = None
 
-	table.is_open = True
-	table.opened_by_user_id = user.id
-	if not table.opened_at:
-		table.opened_at = datetime.utcnow()
 
-	await db.commit()
-	await db.refresh(order)
-	await db.refresh(order, attribute_names=["items"]) 
-	out = _order_to_out(order, table.number, user.display_name)
+async def _apply_ticks(db: AsyncSession, ticks: Dict[int, bool]) -> Dict[int, _OrderTicks]:
+	"""Segna righe fatte/non fatte (anche di ordini diversi) con un numero fisso di statement.
+
+	Ogni ordine toccato prende una sola nuova versione; chi chiama fa commit e invia un evento
+	per ordine. 404 se una riga non esiste.
+	"""
+	res = await db.execute(
+		select(OrderItem.id, OrderItem.order_id, Order.public_id)
+		.join(Order, Order.id == OrderItem.order_id)
+		.where(OrderItem.id.in_(ticks))
+	)
+	by_order: Dict[int, _OrderTicks] = {}
+	for item_id, order_id, public_id in res.all():
+		t = by_order.setdefault(order_id, _OrderTicks(order_id, public_id, {}))
+		t.changes[item_id] = ticks[item_id]
+	missing = sorted(set(ticks) - {i for t in by_order.values() for i in t.changes})
+	if missing:
+		raise HTTPException(status_code=404, detail=f"Riga non trovata: {missing[0]}")
+
+	# Solo le righe che cambiano davvero stato tornano dal RETURNING: da qui il delta del contatore
+	# (un tick ripetuto o concorrente sulla stessa riga non conta due volte).
+	delta: Dict[int, int] = {}
+	for flag in (True, False):
+		ids = [item_id for item_id, done in ticks.items() if done is flag]
+		if not ids:
+			continue
+		res = await db.execute(
+			update(OrderItem)
+			.where(OrderItem.id.in_(ids), OrderItem.is_done != flag)
+			.values(is_done=flag)
+			.returning(OrderItem.order_id)
+		)
+		for (order_id,) in res.all():
+			delta[order_id] = delta.get(order_id, 0) + (1 if flag else -1)
+
+	# Un solo UPDATE per tutti gli ordini: versione, contatore e passaggio a READY. Le espressioni
+	# vedono la riga gia' bloccata, quindi con due tablet in concorrenza una sola vede completare
+	# l'ordine e fa la transizione (un ordine gia' READY mantiene il suo ready_at).
+	now = datetime.utcnow()
+	done_after = Order.items_done + case(delta, value=Order.id, else_=0) if delta else Order.items_done
+	becomes_ready = and_(
+		Order.items_total > 0,
+		done_after >= Order.items_total,
+		Order.status.in_([OrderStatus.OPEN, OrderStatus.PRINTED]),
+	)
+	res = await db.execute(
+		update(Order)
+		.where(Order.id.in_(by_order))
+		.values(
+			version=Order.version + 1,
+			items_done=done_after,
+			status=case((becomes_ready, literal(OrderStatus.READY, Order.status.type)), else_=Order.status),
+			ready_at=case((becomes_ready, literal(now, Order.ready_at.type)), else_=Order.ready_at),
+		)
+		.returning(Order.id, Order.version, Order.status, Order.ready_at)
+	)
+	for order_id, version, status, ready_at in res.all():
+		t = by_order[order_id]
+		t.version, t.status, t.ready_at = version, status, ready_at
+	return by_order
 
-	await manager.broadcast_many(["bar", "admin", "cassa"], {"type": "order_created", "order": out.model_dump(mode="json")})
-	await manager.broadcast("waiter", {"type": "order_created", "order": out.model_dump(mode="json")})
+
+async def _ticks_out(db: AsyncSession, t: _OrderTicks) -> OrderOut:
+	out = live_orders.patch_items(t.order_id, t.changes, t.version, t.status, t.ready_at)
+	if out is None:
+		out = await load_order_out(db, t.order_id)
+		live_orders.apply(out)
 	return out
 
 
@@ -254,44 +446,88 @@ async def set_item_done(
 	if user.role not in (Role.BAR, Role.ADMIN):
 		raise HTTPException(status_code=403, detail="Solo BAR/ADMIN")
 
-	res = await db.execute(select(Order).where(Order.public_id == public_id))
-	order = res.scalar_one_or_none()
-	if not order:
-		raise HTTPException(status_code=404, detail="Comanda non trovata")
-
-	res = await db.execute(select(OrderItem).where(OrderItem.id == item_id, OrderItem.order_id == order.id))
-	item = res.scalar_one_or_none()
-	if not item:
+	by_order = await _apply_ticks(db, {item_id: data.is_done})
+	t = next(iter(by_order.values()))
+	if t.public_id != public_id:
+		await db.rollback()
 		raise HTTPException(status_code=404, detail="Riga non trovata")
+	await db.commit()
+	out = await _ticks_out(db, t)
+	# Delta: i client applicano la patch se version == locale + 1, altrimenti fanno resync.
+	await bus.publish(
+		["bar", "admin", "cassa", "waiter"],
+		{
+			"type": "item_done",
+			"order_id": t.order_id,
+			"public_id": t.public_id,
+			"waiter_id": out.waiter_id,
+			"table_number": out.table_number,
+			"item_id": item_id,
+			"is_done": data.is_done,
+			"version": t.version,
+			"status": out.status.value,
+			"ready_at": out.ready_at.isoformat() if out.ready_at else None,
+		},
+	)
+	return out
 
-	item.is_done = data.is_done
 
-	# if all done => READY
-	res = await db.execute(select(OrderItem).where(OrderItem.order_id == order.id))
-	items = res.scalars().all()
-	if items and all(i.is_done for i in items):
-		order.status = OrderStatus.READY
-		order.ready_at = datetime.utcnow()
+@app.patch("/api/orders/items", response_model=List[OrderOut])
+async def set_items_done(
+	data: BulkItemDoneIn,
+	db: AsyncSession = Depends(get_db),
+	user: User = Depends(get_current_user),
+):
+	"""Spunta (o toglie la spunta a) piu' righe, anche di ordini diversi, in una transazione."""
+	if user.role not in (Role.BAR, Role.ADMIN):
+		raise HTTPException(status_code=403, detail="Solo BAR/ADMIN")
 
+	by_order = await _apply_ticks(db, {it.item_id: it.is_done for it in data.items})
 	await db.commit()
-	# reload with joins
-	row = await db.execute(
-		select(Order, Table.number, User.display_name)
-		.join(Table, Table.id == Order.table_id)
-		.join(User, User.id == Order.waiter_id)
-		.where(Order.id == order.id)
-	)
-	order2, tnum, waiter_name = row.one()
-	await db.refresh(order2, attribute_names=["items"])
-	out = _order_to_out(order2, tnum, waiter_name)
-	await manager.broadcast_many(["bar", "admin", "cassa", "waiter"], {"type": "order_updated", "order": out.model_dump(mode="json")})
-	return out
+	result: List[OrderOut] = []
+	for t in by_order.values():
+		out = await _ticks_out(db, t)
+		result.append(out)
+		# un evento per ordine con tutte le righe cambiate e una sola versione
+		await bus.publish(
+			["bar", "admin", "cassa", "waiter"],
+			{
+				"type": "items_done",
+				"order_id": t.order_id,
+				"public_id": t.public_id,
+				"waiter_id": out.waiter_id,
+				"table_number": out.table_number,
+				"items": [{"item_id": i, "is_done": d} for i, d in t.changes.items()],
+				"version": t.version,
+				"status": out.status.value,
+				"ready_at": out.ready_at.isoformat() if out.ready_at else None,
+			},
+		)
+	return result
+
+
+@app.get("/api/orders/{public_id}", response_model=OrderOut)
+async def get_order(
+	public_id: str,
+	db: AsyncSession = Depends(get_db),
+	user: User = Depends(get_current_user),
+):
+	# Resync di un singolo ordine (il client ha visto un salto di versione negli eventi WS).
+	out = live_orders.get_by_public_id(public_id)
+	if out is not None:
+		return out
+	res = await db.execute(select(Order.id).where(Order.public_id == public_id))
+	order_id = res.scalar_one_or_none()
+	if order_id is None:
+		raise HTTPException(status_code=404, detail="Comanda non trovata")
+	return await load_order_out(db, order_id)
 
 
 @app.post("/api/orders/{public_id}/print")
 async def print_order(
 	public_id: str,
 	printer_name: str = Query(default="BAR_PRINTER"),
+	copies: int = Query(default=1, ge=1, le=5),
 	db: AsyncSession = Depends(get_db),
 	user: User = Depends(get_current_user),
 ):
@@ -308,32 +544,107 @@ async def print_order(
 	if not one:
 		raise HTTPException(status_code=404, detail="Comanda non trovata")
 	order, tnum, waiter_name = one
-	await db.refresh(order, attribute_names=["items"])
 
 	pr = await db.execute(select(Printer).where(Printer.name == printer_name, Printer.is_active == True))
 	printer = pr.scalar_one_or_none()
 	if not printer:
 		raise HTTPException(status_code=404, detail="Stampante non trovata")
 
-	text = _format_print(order, tnum, waiter_name)
-	job = PrintJob(order_id=order.id, printer_id=printer.id, payload_text=text, status="QUEUED")
+	if (printer.kind or "").lower() == "escpos":
+		# Ristampe della stessa versione: byte dalla cache, senza ricaricare le righe.
+		body = escpos.cache.get(escpos.COMANDA, order.id, order.version)
+		if body is None:
+			await db.refresh(order, attribute_names=["items"])
+			body = escpos.render_order(order, tnum, waiter_name)
+		job = PrintJob(order_id=order.id, printer_id=printer.id, payload_text="", payload_bin=escpos.finish(body, copies), status="QUEUED")
+	else:
+		await db.refresh(order, attribute_names=["items"])
+		text = _format_print(order, tnum, waiter_name)
+		job = PrintJob(order_id=order.id, printer_id=printer.id, payload_text="\n\n".join([text] * copies), status="QUEUED")
 	db.add(job)
 	await db.commit()
 
-	adapter = get_adapter(printer.kind)
-	result = adapter.send(printer.connection, title=f"Comanda #{order.public_id}", text=text)
+	# L'invio vero e proprio avviene nel worker della stampante; l'esito arriva via WS ("print_job").
+	spooler.submit(job.id, printer.id)
+	return {"ok": True, "error": None, "job_id": job.id, "status": job.status}
 
-	if result.ok:
-		job.status = "SENT"
-		job.sent_at = datetime.utcnow()
-		order.status = OrderStatus.PRINTED if order.status != OrderStatus.CLOSED else order.status
-	else:
-		job.status = "ERROR"
-		job.error = result.error
+
+@app.post("/api/admin/live-orders/rebuild")
+async def rebuild_live_orders(user: User = Depends(get_current_user)):
+	if user.role != Role.ADMIN:
+		raise HTTPException(status_code=403, detail="Solo ADMIN")
+	live_orders.invalidate()
+	n = await live_orders.rebuild()
+	return {"ok": True, "orders": n}
+
+
+@app.patch("/api/admin/users/{user_id}", response_model=UserOut)
+async def update_user(
+	user_id: int,
+	data: UserUpdateIn,
+	db: AsyncSession = Depends(get_db),
+	user: User = Depends(get_current_user),
+):
+	if user.role != Role.ADMIN:
+		raise HTTPException(status_code=403, detail="Solo ADMIN")
+	res = await db.execute(select(User).where(User.id == user_id))
+	target = res.scalar_one_or_none()
+	if not target:
+		raise HTTPException(status_code=404, detail="Utente non trovato")
+	for field, value in data.model_dump(exclude_unset=True).items():
+		if value is not None:
+			setattr(target, field, value)
 	await db.commit()
+	# ruolo/attivazione cambiati: il token resta valido, quindi va tolto dalla cache di auth
+	await invalidate_principal(target.username)
+	return UserOut(id=target.id, username=target.username, display_name=target.display_name, role=target.role)
+
+
+@app.post("/api/admin/principals/invalidate")
+async def invalidate_principals(username: Optional[str] = Query(default=None), user: User = Depends(get_current_user)):
+	# per modifiche fatte direttamente sul DB; senza username svuota tutta la cache
+	if user.role != Role.ADMIN:
+		raise HTTPException(status_code=403, detail="Solo ADMIN")
+	await invalidate_principal(username)
+	return {"ok": True, **principals.stats()}
+
 
-	await manager.broadcast_many(["bar", "admin", "cassa", "waiter"], {"type": "print_job", "public_id": public_id, "ok": result.ok, "error": result.error})
-	return {"ok": result.ok, "error": result.error}
+@app.get("/api/admin/realtime")
+async def realtime_stats(user: User = Depends(get_current_user)):
+	if user.role != Role.ADMIN:
+		raise HTTPException(status_code=403, detail="Solo ADMIN")
+	return {**manager.stats(), "bus": bus.stats(), "eventlog": eventlog.stats()}
+
+
+@app.get("/api/admin/printers")
+async def printers_health(user: User = Depends(get_current_user)):
+	# health check delle stampanti attive: apre (o verifica) la connessione di ciascuna
+	if user.role != Role.ADMIN:
+		raise HTTPException(status_code=403, detail="Solo ADMIN")
+	return await spooler.check_printers()
+
+
+@app.post("/api/admin/printers/invalidate")
+async def invalidate_printers(user: User = Depends(get_current_user)):
+	# per stampanti modificate o cancellate direttamente sul DB (lo sweep lo fa comunque ogni 30 s)
+	if user.role != Role.ADMIN:
+		raise HTTPException(status_code=403, detail="Solo ADMIN")
+	await spooler.sync_printers()
+	return {"ok": True}
+
+
+@app.get("/api/admin/db")
+async def db_stats(user: User = Depends(get_current_user)):
+	if user.role != Role.ADMIN:
+		raise HTTPException(status_code=403, detail="Solo ADMIN")
+	return pool_stats()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(authorization: Optional[str] = Header(default=None)):
+	if settings.METRICS_TOKEN and authorization != f"Bearer {settings.METRICS_TOKEN}":
+		raise HTTPException(status_code=401, detail="Token non valido")
+	return Response(REGISTRY.render(), media_type=METRICS_CONTENT_TYPE)
 
 
 def _format_print(order: Order, table_number: int, waiter_name: str) -> str:
@@ -408,12 +719,15 @@ async def create_call(
 	else:
 		channels.append("bar")
 	# Compat: alcuni client piu' vecchi ascoltano "call.created".
-	await manager.broadcast_many(
+	await bus.publish(
 		channels,
 		{
 			"type": "call_created",
 			"event": "call.created",
 			"call": payload.model_dump(mode="json"),
+			# per i filtri WS: il cameriere chiamato (nessuno = tutti) e il tavolo
+			"waiter_id": to_user_id,
+			"table_number": data.table_number,
 		},
 	)
 	return payload
@@ -432,25 +746,41 @@ async def ack_call(
 	ce.is_ack = True
 	ce.acked_at = datetime.utcnow()
 	await db.commit()
-	await manager.broadcast_many(["admin", "bar", "waiter", "cassa"], {"type": "call_acked", "call_id": call_id})
+	await bus.publish(["admin", "bar", "waiter", "cassa"], {"type": "call_acked", "call_id": call_id})
 	return {"ok": True}
 
 
 # ----------------------------- WEBSOCKET -----------------------------
+def _ws_filters(user: Optional[User], waiter: str, tables: str, types: str) -> Dict[str, frozenset]:
+	filters: Dict[str, frozenset] = {}
+	if waiter:
+		if waiter == "me":
+			if user is None:
+				raise ValueError("waiter=me needs a token")
+			filters["waiter_id"] = frozenset([user.id])
+		else:
+			filters["waiter_id"] = frozenset(int(w) for w in waiter.split(","))
+	if tables:
+		filters["table_number"] = frozenset(int(t) for t in tables.split(","))
+	if types:
+		filters["type"] = frozenset(t.strip() for t in types.split(",") if t.strip())
+	return filters
+
+
 @app.websocket("/ws")
-async def ws_endpoint(ws: WebSocket, token: str = Query(default=""), channel: str = Query(default=""), db: AsyncSession = Depends(get_db)):
-	# very small auth: decode token and map to a channel, fallback to requested channel only for dev
-	user: Optional[User] = None
-	try:
-		# reuse oauth2 logic: expect Authorization header is not possible in browser WS easily
-		from jose import jwt
-		payload = jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALG])
-		username = payload.get("sub")
-		if username:
-			res = await db.execute(select(User).where(User.username == username))
-			user = res.scalar_one_or_none()
-	except Exception:
-		user = None
+async def ws_endpoint(
+	ws: WebSocket,
+	token: str = Query(default=""),
+	channel: str = Query(default=""),
+	since: Optional[int] = Query(default=None),
+	waiter: str = Query(default=""),
+	tables: str = Query(default=""),
+	types: str = Query(default=""),
+	fmt: str = Query(default="json", alias="format"),
+):
+	# niente Depends(get_db): la sessione vivrebbe quanto il socket (ore) tenendo una connessione del
+	# pool; l'utente arriva dalla cache dei principal o da una sessione chiusa subito dopo la lookup
+	user: Optional[User] = await user_from_token(token) if token else None
 
 	# derive channel
 	ch = "admin" if channel == "admin" else "public"
@@ -468,10 +798,45 @@ async def ws_endpoint(ws: WebSocket, token: str = Query(default=""), channel: st
 		if channel in ("bar", "waiter", "cassa", "admin"):
 			ch = channel
 
-	await manager.connect(ws, ch)
+	# filtri opzionali sul canale: ?waiter=<id>|me, ?tables=3,7, ?types=call_created,call_acked
+	try:
+		filters = _ws_filters(user, waiter, tables, types)
+	except ValueError:
+		await ws.close(code=1008)
+		return
+	# ?format=msgpack: frame binari MessagePack (il client li distingue dal tipo di frame); senza la
+	# libreria installata si resta su JSON e l'hello riporta il formato effettivo
+	if fmt not in ("json", "msgpack"):
+		await ws.close(code=1008)
+		return
+	binary = fmt == "msgpack" and events.msgpack is not None
+
+	# ?since=<ultimo seq ricevuto>: si rispediscono solo gli eventi persi (see eventlog.py). La parte
+	# letta dal DB arriva prima di registrare il socket, il resto dal ring subito dopo (niente await
+	# in mezzo), cosi' nessun evento va perso o arriva due volte.
+	missed: Optional[List[Event]] = None
+	if since is not None:
+		missed, upto = await eventlog.missed(since, ch)
+	await manager.connect(ws, ch, filters, binary)
+	if missed is not None:
+		tail = eventlog.tail(upto, ch)
+		missed = None if tail is None else [ev for ev in missed + tail if matches(filters, ev)]
+	if since is not None:
+		eventlog.note_replay(missed)
 	try:
-		# send hello
-		await ws.send_json({"type": "hello", "channel": ch, "user": user.username if user else None})
+		# send hello (accodato: passa dal writer della connessione come ogni altro evento)
+		manager.send(ws, {
+			"type": "hello",
+			"format": "msgpack" if binary else "json",
+			"channel": ch,
+			"user": user.username if user else None,
+			"filters": {dim: sorted(values) for dim, values in filters.items()},
+			"seq": eventlog.last,
+			"resync": since is not None and missed is None,
+			"replayed": len(missed) if missed else 0,
+		})
+		for ev in missed or ():
+			manager.send(ws, ev)
 		while True:
 			# We don't require client messages now; keep it open.
 			await ws.receive_text()
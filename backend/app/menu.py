@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+from typing import Any, Dict, Optional
+
+from sqlalchemy import select
+
+from .db import SessionLocal
+from .events import dumps
+from .models import MenuItem
+from .schemas import MenuItemOut
+
+
+class MenuSnapshot:
+	__slots__ = ("body", "etag", "items")
+
+	def __init__(self, body: bytes, items: Dict[int, MenuItemOut]) -> None:
+		self.body = body
+		self.etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+		self.items = items  # articoli attivi per id (usati anche da create_order)
+
+	def matches(self, if_none_match: Optional[str]) -> bool:
+		"""True se l'header If-None-Match del client contiene l'ETag corrente (o e' `*`)."""
+		if not if_none_match:
+			return False
+		for tag in if_none_match.split(","):
+			tag = tag.strip()
+			if tag.startswith("W/"):
+				tag = tag[2:]
+			if tag == "*" or tag == self.etag:
+				return True
+		return False
+
+
+class MenuCache:
+	"""Menu attivo gia' serializzato (il body di GET /api/menu) con ETag sul contenuto.
+
+	Caricato al primo uso e tenuto finche' non viene invalidato (modifica di un articolo, qui o in
+	un altro worker via bus). Una richiesta con If-None-Match valido riceve 304 senza DB ne' pydantic.
+	"""
+
+	def __init__(self) -> None:
+		self._snap: Optional[MenuSnapshot] = None
+		self._lock = asyncio.Lock()
+		self._gen = 0  # cambia a ogni invalidate: scarta un caricamento partito prima
+		self.loads = 0
+
+	async def get(self) -> MenuSnapshot:
+		snap = self._snap
+		if snap is not None:
+			return snap
+		async with self._lock:
+			if self._snap is None:
+				gen = self._gen
+				snap = await self._load()
+				if gen == self._gen:
+					self._snap = snap
+				return snap
+			return self._snap
+
+	async def _load(self) -> MenuSnapshot:
+		async with SessionLocal() as db:
+			res = await db.execute(
+				select(MenuItem).where(MenuItem.is_active == True).order_by(MenuItem.category, MenuItem.name)
+			)
+			items = res.scalars().all()
+		self.loads += 1
+		out = [MenuItemOut(id=i.id, sku=i.sku, name=i.name, category=i.category, price=float(i.price)) for i in items]
+		return MenuSnapshot(dumps([m.model_dump(mode="json") for m in out]), {m.id: m for m in out})
+
+	def invalidate(self) -> None:
+		self._gen += 1
+		self._snap = None
+
+	def apply_event(self, payload: Dict[str, Any]) -> None:
+		"""Invalidazioni arrivate da altri worker (see bus.EventBus.subscribe)."""
+		if payload.get("type") == "menu_invalidated":
+			self.invalidate()
+
+
+menu_cache = MenuCache()
@@ -0,0 +1,312 @@
+"""Metriche di processo in formato testo Prometheus (GET /metrics), senza dipendenze esterne.
+
+Contatori, gauge e istogrammi con label; le gauge/contatori con `fn` vengono letti al momento dello
+scrape (es. client WS per canale dal ConnectionManager). Ogni processo ha le sue: con piu' worker
+uvicorn ogni scrape vede il worker che risponde.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import math
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100, 250, 500)
+
+LabelValues = Tuple[str, ...]
+
+
+def _fmt(v: float) -> str:
+	if v == math.inf:
+		return "+Inf"
+	if float(v).is_integer():
+		return str(int(v))
+	return repr(float(v))
+
+
+def _escape(v: str) -> str:
+	return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+	parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+	if extra:
+		parts.append(extra)
+	return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+	kind = "untyped"
+
+	def __init__(
+		self,
+		name: str,
+		help: str,
+		labelnames: Sequence[str] = (),
+		fn: Optional[Callable[[], Any]] = None,
+		registry: Optional["Registry"] = None,
+	) -> None:
+		self.name = name
+		self.help = help
+		self.labelnames = tuple(labelnames)
+		# fn: valore letto allo scrape; un numero, o {label values: numero} se la metrica ha label
+		self.fn = fn
+		self._children: Dict[LabelValues, Any] = {}
+		(registry or REGISTRY).register(self)
+
+	def labels(self, *values: Any) -> Any:
+		key = tuple(str(v) for v in values)
+		child = self._children.get(key)
+		if child is None:
+			if len(key) != len(self.labelnames):
+				raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {key}")
+			child = self._children[key] = self._new_child()
+		return child
+
+	def _new_child(self) -> Any:
+		raise NotImplementedError
+
+	def _samples(self) -> List[Tuple[LabelValues, float]]:
+		if self.fn is None:
+			return [(k, c.value) for k, c in self._children.items()]
+		v = self.fn()
+		if isinstance(v, dict):
+			return [(k if isinstance(k, tuple) else (k,), float(x)) for k, x in v.items()]
+		return [((), float(v))]
+
+	def render(self) -> List[str]:
+		out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+		for key, v in self._samples():
+			out.append(f"{self.name}{_labels(self.labelnames, key)} {_fmt(v)}")
+		return out
+
+
+class _Value:
+	__slots__ = ("value",)
+
+	def __init__(self) -> None:
+		self.value = 0.0
+
+	def inc(self, amount: float = 1.0) -> None:
+		self.value += amount
+
+	def set(self, value: float) -> None:
+		self.value = value
+
+
+class Counter(_Metric):
+	kind = "counter"
+
+	def _new_child(self) -> _Value:
+		return _Value()
+
+	def inc(self, amount: float = 1.0) -> None:
+		self.labels().inc(amount)
+
+
+class Gauge(Counter):
+	kind = "gauge"
+
+	def set(self, value: float) -> None:
+		self.labels().set(value)
+
+
+class _HistogramChild:
+	__slots__ = ("bounds", "counts", "sum", "count")
+
+	def __init__(self, bounds: Tuple[float, ...]) -> None:
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)  # l'ultimo e' +Inf
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, v: float) -> None:
+		self.counts[bisect_left(self.bounds, v)] += 1
+		self.sum += v
+		self.count += 1
+
+
+class Histogram(_Metric):
+	kind = "histogram"
+
+	def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS, **kw: Any) -> None:
+		self.bounds = tuple(sorted(buckets))
+		super().__init__(name, help, labelnames, **kw)
+
+	def _new_child(self) -> _HistogramChild:
+		return _HistogramChild(self.bounds)
+
+	def observe(self, v: float) -> None:
+		self.labels().observe(v)
+
+	def render(self) -> List[str]:
+		out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+		les = ['le="' + _fmt(b) + '"' for b in self.bounds + (math.inf,)]
+		for key, h in self._children.items():
+			acc = 0
+			for le, n in zip(les, h.counts):
+				acc += n
+				out.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {acc}")
+			lbl = _labels(self.labelnames, key)
+			out.append(f"{self.name}_sum{lbl} {_fmt(h.sum)}")
+			out.append(f"{self.name}_count{lbl} {h.count}")
+		return out
+
+
+class Registry:
+	def __init__(self) -> None:
+		self._metrics: Dict[str, _Metric] = {}
+
+	def register(self, metric: _Metric) -> None:
+		if metric.name in self._metrics:
+			raise ValueError(f"metric {metric.name} already registered")
+		self._metrics[metric.name] = metric
+
+	def render(self) -> str:
+		lines: List[str] = []
+		for m in self._metrics.values():
+			lines.extend(m.render())
+		return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# ----------------------------- HTTP + DB -----------------------------
+http_requests = Histogram(
+	"cassa_http_request_duration_seconds", "HTTP request latency by route template.", ["method", "route", "status"]
+)
+http_db_queries = Histogram(
+	"cassa_http_request_db_queries", "SQL statements executed per HTTP request.", ["route"], buckets=COUNT_BUCKETS
+)
+http_db_seconds = Histogram("cassa_http_request_db_seconds", "Time spent in SQL per HTTP request.", ["route"])
+db_queries = Histogram("cassa_db_query_duration_seconds", "SQL statement latency (all callers).")
+
+
+class DbUsage:
+	"""Statement e tempo DB della richiesta corrente (see request_db_usage)."""
+
+	__slots__ = ("queries", "seconds", "shapes")
+
+	def __init__(self) -> None:
+		self.queries = 0
+		self.seconds = 0.0
+		self.shapes: Optional[Dict[str, int]] = None  # forma statement -> esecuzioni, solo col profiler SQL
+
+
+# I listener SQLAlchemy girano nello stesso contesto del task della richiesta (anche dentro il
+# greenlet dell'engine async), quindi il contesto arriva fino a loro senza passarlo a mano.
+request_db_usage: contextvars.ContextVar[Optional[DbUsage]] = contextvars.ContextVar("request_db_usage", default=None)
+
+
+# Osservatori di ogni statement (statement, parametri, secondi), es. il profiler SQL: riusano i
+# tempi misurati qui invece di installare altri listener. Chiamati anche fuori dalle richieste.
+StatementHook = Callable[[str, Any, float], None]
+_statement_hooks: List[StatementHook] = []
+
+
+def on_statement(hook: StatementHook) -> None:
+	if hook not in _statement_hooks:
+		_statement_hooks.append(hook)
+
+
+def instrument_engine(engine: Engine) -> None:
+	@event.listens_for(engine, "before_cursor_execute")
+	def _before(conn, cursor, statement, parameters, context, executemany) -> None:
+		conn.info.setdefault("metrics_t0", []).append(time.perf_counter())
+
+	@event.listens_for(engine, "after_cursor_execute")
+	def _after(conn, cursor, statement, parameters, context, executemany) -> None:
+		dt = time.perf_counter() - conn.info["metrics_t0"].pop()
+		db_queries.observe(dt)
+		usage = request_db_usage.get()
+		if usage is not None:
+			usage.queries += 1
+			usage.seconds += dt
+		for hook in _statement_hooks:
+			hook(statement, parameters, dt)
+
+	@event.listens_for(engine, "handle_error")
+	def _error(ctx) -> None:
+		stack = ctx.connection.info.get("metrics_t0") if ctx.connection is not None else None
+		if stack:
+			stack.pop()
+
+
+def route_template(scope: Dict[str, Any]) -> str:
+	route = scope.get("route")
+	path = getattr(route, "path", None)
+	# solo template di route (o mount), mai il path grezzo: le label restano poche
+	return path or "<unmatched>"
+
+
+class MetricsMiddleware:
+	"""Middleware ASGI puro (niente BaseHTTPMiddleware): latenza, status e uso del DB per route."""
+
+	def __init__(self, app: Any) -> None:
+		self.app = app
+
+	async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+		if scope["type"] != "http":
+			await self.app(scope, receive, send)
+			return
+		status = 500
+
+		async def _send(message: Dict[str, Any]) -> None:
+			nonlocal status
+			if message["type"] == "http.response.start":
+				status = message["status"]
+			await send(message)
+
+		usage = DbUsage()
+		token = request_db_usage.set(usage)
+		t0 = time.perf_counter()
+		try:
+			await self.app(scope, receive, _send)
+		finally:
+			dt = time.perf_counter() - t0
+			request_db_usage.reset(token)
+			route = route_template(scope)
+			http_requests.labels(scope["method"], route, status).observe(dt)
+			http_db_queries.labels(route).observe(usage.queries)
+			http_db_seconds.labels(route).observe(usage.seconds)
+
+
+# ----------------------------- EVENT LOOP -----------------------------
+loop_lag = Histogram("cassa_event_loop_lag_seconds", "How late a periodic asyncio.sleep wakes up.")
+
+
+class LoopLagMonitor:
+	"""Misura di quanto un asyncio.sleep(interval) sfora: e' il ritardo che vede ogni callback."""
+
+	def __init__(self, interval: float = 0.25) -> None:
+		self.interval = interval
+		self._task: Optional[asyncio.Task] = None
+
+	def start(self) -> None:
+		loop = asyncio.get_running_loop()
+		if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+			self._task = loop.create_task(self._run(), name="loop-lag-monitor")
+
+	async def stop(self) -> None:
+		task, self._task = self._task, None
+		if task is not None and task.get_loop() is asyncio.get_running_loop():
+			task.cancel()
+			await asyncio.gather(task, return_exceptions=True)
+
+	async def _run(self) -> None:
+		loop = asyncio.get_running_loop()
+		while True:
+			t0 = loop.time()
+			await asyncio.sleep(self.interval)
+			loop_lag.observe(max(0.0, loop.time() - t0 - self.interval))
+
+
+loop_monitor = LoopLagMonitor()
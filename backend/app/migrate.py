@@ -0,0 +1,302 @@
+"""Migrazioni dello schema, versionate. Si eseguono a parte, non all'avvio dell'app:
+
+    python -m app.migrate            # applica quelle mancanti
+    python -m app.migrate status     # versione attuale / mancanti
+
+Ogni migrazione gira nella sua transazione e viene registrata in `schema_migrations`; su
+Postgres un advisory lock evita che due processi (es. due container) migrino insieme.
+Le migrazioni sono idempotenti, quindi funzionano anche su DB creati dal vecchio create_all.
+Non leggono models.py: ogni migrazione descrive lo schema del suo momento (tabelle congelate qui
+sotto o DDL esplicito), cosi' un modello cambiato dopo non altera le migrazioni gia' scritte.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+from datetime import datetime
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+
+from sqlalchemy import (
+	BigInteger, Boolean, Column, Date, DateTime, Enum, ForeignKey, Integer, LargeBinary, MetaData, Numeric, String,
+	Table, Text, UniqueConstraint, inspect, text,
+)
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy.types import TypeEngine
+
+from .db import engine
+
+_meta = MetaData()
+schema_migrations = Table(
+	"schema_migrations",
+	_meta,
+	Column("version", Integer, primary_key=True),
+	Column("name", String(128), nullable=False),
+	Column("applied_at", DateTime(timezone=True), nullable=False),
+)
+
+_LOCK_ID = 4242_0016  # pg_advisory_xact_lock
+
+
+async def _columns(conn: AsyncConnection, table: str) -> Set[str]:
+	return await conn.run_sync(lambda c: {col["name"] for col in inspect(c).get_columns(table)})
+
+
+async def _add_column(
+	conn: AsyncConnection, table: str, column: str, type_: TypeEngine, default: Optional[str] = None
+) -> None:
+	"""ALTER TABLE ... ADD COLUMN se manca (SQLite non ha ADD COLUMN IF NOT EXISTS)."""
+	if column in await _columns(conn, table):
+		return
+	ddl = f"ALTER TABLE {table} ADD COLUMN {column} {type_.compile(dialect=conn.dialect)}"
+	if default is not None:
+		ddl += f" DEFAULT {default} NOT NULL"
+	await conn.execute(text(ddl))
+
+
+# ----------------------------- SCHEMA DI BASE -----------------------------
+# models.py della prima versione (lo schema che l'app creava con create_all prima di ogni
+# ottimizzazione), congelato. Colonne, tabelle e indici venuti dopo li aggiungono 0002-0005, che
+# quindi girano anche su un DB nuovo. Non va aggiornato: le modifiche passano da una nuova migrazione.
+_baseline = MetaData()
+
+Table(
+	"users",
+	_baseline,
+	Column("id", Integer, primary_key=True),
+	Column("username", String(64), nullable=False, unique=True, index=True),
+	Column("display_name", String(128), nullable=False),
+	Column("role", Enum("ADMIN", "BAR", "WAITER", "CASHIER", name="role"), nullable=False, index=True),
+	Column("password_hash", String(255), nullable=False),
+	Column("is_active", Boolean, nullable=False),
+	Column("created_at", DateTime(timezone=True), nullable=False),
+)
+Table(
+	"tables",
+	_baseline,
+	Column("id", Integer, primary_key=True),
+	Column("number", Integer, nullable=False, unique=True, index=True),
+	Column("name", String(128)),
+	Column("is_open", Boolean, nullable=False),
+	Column("opened_by_user_id", ForeignKey("users.id")),
+	Column("opened_at", DateTime(timezone=True)),
+	Column("closed_at", DateTime(timezone=True)),
+)
+Table(
+	"menu_items",
+	_baseline,
+	Column("id", Integer, primary_key=True),
+	Column("sku", String(64), nullable=False, unique=True, index=True),
+	Column("name", String(255), nullable=False),
+	Column("category", String(128), nullable=False, index=True),
+	Column("price", Numeric(10, 2), nullable=False),
+	Column("is_active", Boolean, nullable=False),
+)
+Table(
+	"orders",
+	_baseline,
+	Column("id", Integer, primary_key=True),
+	Column("public_id", String(16), nullable=False, unique=True, index=True),
+	Column("table_id", ForeignKey("tables.id"), nullable=False, index=True),
+	Column("waiter_id", ForeignKey("users.id"), nullable=False, index=True),
+	Column("covers", Integer, nullable=False),
+	Column("apericena", Integer, nullable=False),
+	Column("note", Text),
+	Column("status", Enum("OPEN", "READY", "PRINTED", "CLOSED", name="orderstatus"), nullable=False, index=True),
+	Column("created_at", DateTime(timezone=True), nullable=False),
+	Column("ready_at", DateTime(timezone=True)),
+	Column("closed_at", DateTime(timezone=True)),
+)
+Table(
+	"order_items",
+	_baseline,
+	Column("id", Integer, primary_key=True),
+	Column("order_id", ForeignKey("orders.id"), nullable=False, index=True),
+	Column("line_no", Integer, nullable=False),
+	Column("menu_item_id", ForeignKey("menu_items.id"), nullable=False, index=True),
+	Column("name", String(255), nullable=False),
+	Column("note", String(255)),
+	Column("qty", Integer, nullable=False),
+	Column("is_done", Boolean, nullable=False),
+	UniqueConstraint("order_id", "line_no", name="uq_order_line"),
+)
+Table(
+	"call_events",
+	_baseline,
+	Column("id", Integer, primary_key=True),
+	Column("call_type", Enum("CALL_WAITER", "CALL_BARMAN", name="calltype"), nullable=False, index=True),
+	Column("from_user_id", ForeignKey("users.id")),
+	Column("to_user_id", ForeignKey("users.id")),
+	Column("table_id", ForeignKey("tables.id")),
+	Column("order_id", ForeignKey("orders.id")),
+	Column("message", Text),
+	Column("is_ack", Boolean, nullable=False),
+	Column("created_at", DateTime(timezone=True), nullable=False),
+	Column("acked_at", DateTime(timezone=True)),
+)
+Table(
+	"printers",
+	_baseline,
+	Column("id", Integer, primary_key=True),
+	Column("name", String(128), nullable=False, unique=True),
+	Column("kind", String(32), nullable=False),
+	Column("connection", String(255), nullable=False),
+	Column("is_active", Boolean, nullable=False),
+)
+Table(
+	"print_jobs",
+	_baseline,
+	Column("id", Integer, primary_key=True),
+	Column("order_id", ForeignKey("orders.id"), nullable=False, index=True),
+	Column("printer_id", ForeignKey("printers.id"), nullable=False, index=True),
+	Column("payload_text", Text, nullable=False),
+	Column("status", String(32), nullable=False, index=True),
+	Column("error", Text),
+	Column("created_at", DateTime(timezone=True), nullable=False),
+	Column("sent_at", DateTime(timezone=True)),
+)
+
+# Tabelle di 0002, com'erano allora
+_m0002 = MetaData()
+Table(
+	"order_counters",
+	_m0002,
+	Column("day", Date, primary_key=True),
+	Column("last", Integer, nullable=False),
+)
+Table(
+	"bus_events",
+	_m0002,
+	Column("id", Integer, primary_key=True),
+	Column("payload", Text, nullable=False),
+	Column("created_at", DateTime(timezone=True), nullable=False, index=True),
+)
+
+# Tabella di 0004, com'era allora
+_ws_outbox = Table(
+	"ws_outbox",
+	MetaData(),
+	Column("seq", BigInteger().with_variant(Integer, "sqlite"), primary_key=True),
+	Column("channels", String(255), nullable=False),
+	Column("payload", Text, nullable=False),
+	Column("created_at", DateTime(timezone=True), nullable=False, index=True),
+)
+
+
+# ----------------------------- MIGRAZIONI -----------------------------
+async def m0001_baseline(conn: AsyncConnection) -> None:
+	# Lo schema della prima versione, come lo creava create_all (crea solo le tabelle mancanti).
+	await conn.run_sync(_baseline.create_all)
+
+
+async def m0002_order_versions_and_print_retries(conn: AsyncConnection) -> None:
+	# Colonne e tabelle aggiunte dopo il baseline (numeri comanda giornalieri, bus Postgres).
+	await conn.run_sync(lambda c: _m0002.create_all(c, checkfirst=True))
+	await _add_column(conn, "orders", "version", Integer(), "1")
+	await _add_column(conn, "orders", "items_total", Integer(), "0")
+	await _add_column(conn, "orders", "items_done", Integer(), "0")
+	await _add_column(conn, "print_jobs", "payload_bin", LargeBinary())
+	await _add_column(conn, "print_jobs", "attempts", Integer(), "0")
+	await conn.execute(
+		text(
+			"UPDATE orders SET "
+			"items_total = (SELECT count(*) FROM order_items i WHERE i.order_id = orders.id), "
+			"items_done = (SELECT count(*) FROM order_items i WHERE i.order_id = orders.id AND i.is_done = true)"
+		)
+	)
+
+
+async def m0003_hot_path_indexes(conn: AsyncConnection) -> None:
+	# Allineati con i __table_args__ di models.py.
+	for ddl in (
+		"CREATE INDEX IF NOT EXISTS ix_orders_created_at_id ON orders (created_at, id)",
+		"CREATE INDEX IF NOT EXISTS ix_orders_status_created_at ON orders (status, created_at DESC)",
+		"CREATE INDEX IF NOT EXISTS ix_orders_live ON orders (created_at DESC, id DESC) WHERE status <> 'CLOSED'",
+		"CREATE INDEX IF NOT EXISTS ix_call_events_pending ON call_events (created_at) WHERE is_ack = false",
+		"CREATE INDEX IF NOT EXISTS ix_print_jobs_status_id ON print_jobs (status, id)",
+		# coperti dagli indici composti qui sopra
+		"DROP INDEX IF EXISTS ix_orders_status",
+		"DROP INDEX IF EXISTS ix_print_jobs_status",
+	):
+		await conn.execute(text(ddl))
+
+
+async def m0004_ws_outbox(conn: AsyncConnection) -> None:
+	await conn.run_sync(lambda c: _ws_outbox.create(c, checkfirst=True))
+
+
+async def m0005_print_job_lease(conn: AsyncConnection) -> None:
+	# Lease dei job in SENDING (see spooler.PrintSpooler.requeue_expired)
+	await _add_column(conn, "print_jobs", "claimed_at", DateTime(timezone=True))
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[AsyncConnection], Awaitable[None]]]] = [
+	(1, "baseline", m0001_baseline),
+	(2, "order_versions_and_print_retries", m0002_order_versions_and_print_retries),
+	(3, "hot_path_indexes", m0003_hot_path_indexes),
+	(4, "ws_outbox", m0004_ws_outbox),
+	(5, "print_job_lease", m0005_print_job_lease),
+]
+HEAD = MIGRATIONS[-1][0]
+
+
+# ----------------------------- RUNNER -----------------------------
+async def _lock(conn: AsyncConnection) -> None:
+	if conn.dialect.name == "postgresql":
+		await conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": _LOCK_ID})
+
+
+async def _applied(conn: AsyncConnection) -> Set[int]:
+	res = await conn.execute(schema_migrations.select().with_only_columns(schema_migrations.c.version))
+	return {v for (v,) in res.all()}
+
+
+async def upgrade() -> List[int]:
+	async with engine.begin() as conn:
+		await _lock(conn)
+		await conn.run_sync(_meta.create_all)
+	done: List[int] = []
+	for version, name, fn in MIGRATIONS:
+		async with engine.begin() as conn:
+			await _lock(conn)
+			if version in await _applied(conn):
+				continue
+			await fn(conn)
+			await conn.execute(schema_migrations.insert().values(version=version, name=name, applied_at=datetime.utcnow()))
+		done.append(version)
+	return done
+
+
+async def current_version() -> int:
+	"""Ultima migrazione applicata, 0 se il DB non e' mai stato migrato."""
+	async with engine.connect() as conn:
+		try:
+			res = await conn.execute(text("SELECT max(version) FROM schema_migrations"))
+		except Exception:
+			return 0
+		return res.scalar() or 0
+
+
+async def check_schema() -> None:
+	"""Controllo all'avvio (una query): fallisce subito se mancano migrazioni."""
+	version = await current_version()
+	if version < HEAD:
+		raise RuntimeError(f"database schema is at version {version}, expected {HEAD}: run `python -m app.migrate`")
+
+
+async def _main(cmd: str) -> None:
+	try:
+		if cmd == "status":
+			version = await current_version()
+			missing = [f"{v:04d}_{n}" for v, n, _ in MIGRATIONS if v > version]
+			print(f"schema version {version}/{HEAD}" + (f", missing: {', '.join(missing)}" if missing else ""))
+		else:
+			done = await upgrade()
+			print(f"applied: {', '.join(map(str, done))}" if done else "schema already up to date")
+	finally:
+		await engine.dispose()
+
+
+if __name__ == "__main__":
+	ap = argparse.ArgumentParser(prog="python -m app.migrate")
+	ap.add_argument("command", nargs="?", default="upgrade", choices=["upgrade", "status"])
+	asyncio.run(_main(ap.parse_args().command))
@@ -1,11 +1,32 @@
 import enum
-from datetime import datetime
+from datetime import date, datetime, timezone
 
-from sqlalchemy import Boolean, DateTime, Enum, ForeignKey, Integer, Numeric, String, Text, UniqueConstraint
+from sqlalchemy import BigInteger, Boolean, Date, DateTime, Enum, ForeignKey, Index, Integer, LargeBinary, Numeric, String, Text, UniqueConstraint, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy.types import TypeDecorator
 
 from .db import Base
 
+class UTCDateTime(TypeDecorator):
+	"""timestamptz su Postgres; su SQLite (che non ha fuso) salva l'ora UTC e la rilegge aware.
+
+	I valori naive sono UTC (datetime.utcnow()), come gia' li interpreta asyncpg.
+	"""
+
+	impl = DateTime(timezone=True)
+	cache_ok = True
+
+	def process_bind_param(self, value, dialect):
+		if value is None:
+			return None
+		value = value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+		return value.replace(tzinfo=None) if dialect.name == "sqlite" else value
+
+	def process_result_value(self, value, dialect):
+		if value is not None and value.tzinfo is None:
+			return value.replace(tzinfo=timezone.utc)
+		return value
+
 class Role(str, enum.Enum):
 	ADMIN = "ADMIN"
 	BAR = "BAR"
@@ -31,7 +52,7 @@ class User(Base):
 	role: Mapped[Role] = mapped_column(Enum(Role), index=True)
 	password_hash: Mapped[str] = mapped_column(String(255))
 	is_active: Mapped[bool] = mapped_column(Boolean, default=True)
-	created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
+	created_at: Mapped[datetime] = mapped_column(UTCDateTime, default=datetime.utcnow)
 
 class Table(Base):
 	__tablename__ = "tables"
@@ -41,8 +62,8 @@ class Table(Base):
 	name: Mapped[str | None] = mapped_column(String(128), nullable=True)
 	is_open: Mapped[bool] = mapped_column(Boolean, default=False)
 	opened_by_user_id: Mapped[int | None] = mapped_column(ForeignKey("users.id"), nullable=True)
-	opened_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
-	closed_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+	opened_at: Mapped[datetime | None] = mapped_column(UTCDateTime, nullable=True)
+	closed_at: Mapped[datetime | None] = mapped_column(UTCDateTime, nullable=True)
 
 	orders: Mapped[list["Order"]] = relationship(back_populates="table")
 
@@ -58,6 +79,19 @@ class MenuItem(Base):
 
 class Order(Base):
 	__tablename__ = "orders"
+	# Indici dei percorsi caldi (creati da app.migrate, 0003): tenerli allineati
+	__table_args__ = (
+		Index("ix_orders_created_at_id", "created_at", "id"),  # keyset di list_orders
+		Index("ix_orders_status_created_at", "status", text("created_at DESC")),  # filtro per stato
+		# ordini vivi (rebuild della proiezione): indice parziale, resta piccolo col passare dei giorni
+		Index(
+			"ix_orders_live",
+			text("created_at DESC"),
+			text("id DESC"),
+			postgresql_where=text("status <> 'CLOSED'"),
+			sqlite_where=text("status <> 'CLOSED'"),
+		),
+	)
 
 	id: Mapped[int] = mapped_column(Integer, primary_key=True)
 	public_id: Mapped[str] = mapped_column(String(16), unique=True, index=True)
@@ -66,13 +100,24 @@ class Order(Base):
 	covers: Mapped[int] = mapped_column(Integer, default=0)
 	apericena: Mapped[int] = mapped_column(Integer, default=0)
 	note: Mapped[str | None] = mapped_column(Text, nullable=True)
-	status: Mapped[OrderStatus] = mapped_column(Enum(OrderStatus), default=OrderStatus.OPEN, index=True)
-	created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
-	ready_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
-	closed_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+	status: Mapped[OrderStatus] = mapped_column(Enum(OrderStatus), default=OrderStatus.OPEN)
+	version: Mapped[int] = mapped_column(Integer, default=1)  # +1 a ogni modifica (righe, stato)
+	# Contatori delle righe: READY si decide nello stesso UPDATE che li aggiorna (see main._apply_ticks)
+	items_total: Mapped[int] = mapped_column(Integer, default=0)
+	items_done: Mapped[int] = mapped_column(Integer, default=0)
+	created_at: Mapped[datetime] = mapped_column(UTCDateTime, default=datetime.utcnow)
+	ready_at: Mapped[datetime | None] = mapped_column(UTCDateTime, nullable=True)
+	closed_at: Mapped[datetime | None] = mapped_column(UTCDateTime, nullable=True)
 
 	table: Mapped[Table] = relationship(back_populates="orders")
-	items: Mapped[list["OrderItem"]] = relationship(back_populates="order", cascade="all, delete-orphan")
+	items: Mapped[list["OrderItem"]] = relationship(back_populates="order", cascade="all, delete-orphan", order_by="OrderItem.line_no")
+
+# Contatore per giornata di servizio da cui nasce Order.public_id (see main._next_public_id)
+class OrderCounter(Base):
+	__tablename__ = "order_counters"
+
+	day: Mapped[date] = mapped_column(Date, primary_key=True)
+	last: Mapped[int] = mapped_column(Integer, default=0)
 
 class OrderItem(Base):
 	__tablename__ = "order_items"
@@ -92,6 +137,14 @@ class OrderItem(Base):
 
 class CallEvent(Base):
 	__tablename__ = "call_events"
+	__table_args__ = (
+		Index(
+			"ix_call_events_pending",
+			"created_at",
+			postgresql_where=text("is_ack = false"),
+			sqlite_where=text("is_ack = false"),
+		),
+	)
 
 	id: Mapped[int] = mapped_column(Integer, primary_key=True)
 	call_type: Mapped[CallType] = mapped_column(Enum(CallType), index=True)
@@ -101,26 +154,48 @@ class CallEvent(Base):
 	order_id: Mapped[int | None] = mapped_column(ForeignKey("orders.id"), nullable=True)
 	message: Mapped[str | None] = mapped_column(Text, nullable=True)
 	is_ack: Mapped[bool] = mapped_column(Boolean, default=False)
-	created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
-	acked_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+	created_at: Mapped[datetime] = mapped_column(UTCDateTime, default=datetime.utcnow)
+	acked_at: Mapped[datetime | None] = mapped_column(UTCDateTime, nullable=True)
 
 class Printer(Base):
 	__tablename__ = "printers"
 
 	id: Mapped[int] = mapped_column(Integer, primary_key=True)
 	name: Mapped[str] = mapped_column(String(128), unique=True)
-	kind: Mapped[str] = mapped_column(String(32))  # cups | escpos | dummy
+	kind: Mapped[str] = mapped_column(String(32))  # cups | socket | escpos | dummy
 	connection: Mapped[str] = mapped_column(String(255))  # e.g. CUPS queue name or ip:port
 	is_active: Mapped[bool] = mapped_column(Boolean, default=True)
 
 class PrintJob(Base):
 	__tablename__ = "print_jobs"
+	__table_args__ = (Index("ix_print_jobs_status_id", "status", "id"),)  # job da riprendere, in ordine
 
 	id: Mapped[int] = mapped_column(Integer, primary_key=True)
 	order_id: Mapped[int] = mapped_column(ForeignKey("orders.id"), index=True)
 	printer_id: Mapped[int] = mapped_column(ForeignKey("printers.id"), index=True)
 	payload_text: Mapped[str] = mapped_column(Text)
-	status: Mapped[str] = mapped_column(String(32), default="QUEUED", index=True)  # QUEUED|SENT|ERROR
+	payload_bin: Mapped[bytes | None] = mapped_column(LargeBinary, nullable=True)  # ESC/POS gia' reso
+	status: Mapped[str] = mapped_column(String(32), default="QUEUED")  # QUEUED|SENDING|SENT|ERROR
 	error: Mapped[str | None] = mapped_column(Text, nullable=True)
-	created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
-	sent_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+	attempts: Mapped[int] = mapped_column(Integer, default=0)
+	created_at: Mapped[datetime] = mapped_column(UTCDateTime, default=datetime.utcnow)
+	sent_at: Mapped[datetime | None] = mapped_column(UTCDateTime, nullable=True)
+	# lease dello spooler in SENDING (rinnovato a ogni tentativo): scaduto = job da riprendere
+	claimed_at: Mapped[datetime | None] = mapped_column(UTCDateTime, nullable=True)
+
+# Eventi troppo grandi per NOTIFY: la notifica porta solo l'id (see bus.PostgresBus)
+class BusEvent(Base):
+	__tablename__ = "bus_events"
+
+	id: Mapped[int] = mapped_column(Integer, primary_key=True)
+	payload: Mapped[str] = mapped_column(Text)
+	created_at: Mapped[datetime] = mapped_column(UTCDateTime, default=datetime.utcnow, index=True)
+
+# Log degli eventi trasmessi ai socket: l'id e' il `seq` degli eventi, per il replay (see eventlog.py)
+class WsOutbox(Base):
+	__tablename__ = "ws_outbox"
+
+	seq: Mapped[int] = mapped_column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+	channels: Mapped[str] = mapped_column(String(255))
+	payload: Mapped[str] = mapped_column(Text)
+	created_at: Mapped[datetime] = mapped_column(UTCDateTime, default=datetime.utcnow, index=True)
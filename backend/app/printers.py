@@ -1,31 +1,74 @@
 from __future__ import annotations
 
+import socket
+import threading
+import time
 from dataclasses import dataclass
-from typing import Optional
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+from .config import settings
 
 # NOTE: per default usiamo una stampa "dummy" (log).
 # Puoi attivare CUPS installando pycups e usando kind="cups".
+# I payload `bytes` (ESC/POS, vedi escpos.py) vengono inviati RAW, senza conversioni.
+
+Payload = Union[str, bytes]
 
 @dataclass
 class PrintResult:
 	ok: bool
 	error: Optional[str] = None
+	# False se il job potrebbe essere gia' (in parte) stampato: ritentarlo rischia il doppio scontrino
+	retry: bool = True
 
 class PrinterAdapter:
-	def send(self, connection: str, title: str, text: str) -> PrintResult:
+	"""Adapter legato a una singola riga `Printer` (una istanza per stampante, vedi PrinterRegistry).
+
+	I metodi sono bloccanti: vengono chiamati dai worker dello spooler su un thread pool.
+	"""
+
+	def __init__(self, connection: str) -> None:
+		self.connection = connection
+		self.last: Optional[PrintResult] = None  # esito dell'ultimo invio o health check (spooler)
+
+	def send(self, title: str, text: Payload) -> PrintResult:
 		raise NotImplementedError
 
+	def check(self) -> PrintResult:
+		self.last = self.health()
+		return self.last
+
+	def health(self) -> PrintResult:
+		return PrintResult(ok=True)
+
+	def close(self) -> None:
+		pass
+
+	def close_if_idle(self, idle_sec: float) -> None:
+		pass
+
 class DummyPrinter(PrinterAdapter):
-	def send(self, connection: str, title: str, text: str) -> PrintResult:
+	def send(self, title: str, text: Payload) -> PrintResult:
 		print("\n----- PRINT JOB (DUMMY) -----")
-		print(f"TO: {connection}")
+		print(f"TO: {self.connection}")
 		print(f"TITLE: {title}")
-		print(text)
+		print(text if isinstance(text, str) else f"<{len(text)} byte ESC/POS>")
 		print("----- END PRINT JOB -----\n")
 		return PrintResult(ok=True)
 
 class CupsPrinter(PrinterAdapter):
-	def __init__(self) -> None:
+	"""Coda CUPS (connection = nome coda). Una `cups.Connection` per stampante, riaperta su errore.
+
+	Il job viene inviato dalla memoria (createJob/startDocument/writeRequestData) senza file temporanei.
+	Si riprova (una volta, su una connessione nuova) solo se il job CUPS non e' partito: errore di
+	connessione o di createJob, oppure un job creato a meta' e annullato con successo. Se fallisce
+	finishDocument, o l'annullamento, il job potrebbe stampare: l'errore non e' ritentabile.
+	"""
+
+	def __init__(self, connection: str) -> None:
+		super().__init__(connection)
+		self._lock = threading.Lock()
+		self._conn = None
 		try:
 			import cups  # type: ignore
 			self._cups = cups
@@ -33,21 +76,77 @@ class CupsPrinter(PrinterAdapter):
 			self._cups = None
 			self._err = str(e)
 
-	def send(self, connection: str, title: str, text: str) -> PrintResult:
-		if self._cups is None:
-			return PrintResult(ok=False, error=f"pycups non disponibile: {getattr(self, '_err', 'unknown')}")
+	def _connect(self):
+		if self._conn is None:
+			self._conn = self._cups.Connection()
+		return self._conn
+
+	def _submit(self, title: str, payload: bytes, fmt: str) -> PrintResult:
 		try:
-			conn = self._cups.Connection()
-			# connection = nome coda CUPS
-			# inviamo come raw text (CUPS puo' richiedere filtro). In caso reale: genera PDF o ESC/POS.
-			import tempfile
-			with tempfile.NamedTemporaryFile(mode="w", suffix=".txt", delete=False, encoding="utf-8") as f:
-				f.write(text)
-				path = f.name
-			conn.printFile(connection, path, title, {})
-			return PrintResult(ok=True)
+			conn = self._connect()
+			job_id = conn.createJob(self.connection, title, {})
 		except Exception as e:
+			# nessun job creato: si puo' ritentare
+			self._conn = None
 			return PrintResult(ok=False, error=str(e))
+		try:
+			conn.startDocument(self.connection, job_id, title, fmt, 1)
+			conn.writeRequestData(payload, len(payload))
+		except Exception as e:
+			return self._abort(conn, job_id, str(e))
+		try:
+			conn.finishDocument(self.connection)
+		except Exception as e:
+			# il documento e' completo: CUPS potrebbe averlo gia' accodato
+			return self._abort(conn, job_id, str(e), retry=False)
+		return PrintResult(ok=True)
+
+	def _abort(self, conn, job_id: int, error: str, retry: bool = True) -> PrintResult:
+		try:
+			conn.cancelJob(job_id)
+		except Exception:
+			retry = False  # stato del job sconosciuto
+		self._conn = None
+		return PrintResult(ok=False, error=error, retry=retry)
+
+	def send(self, title: str, text: Payload) -> PrintResult:
+		if self._cups is None:
+			return PrintResult(ok=False, error=f"pycups non disponibile: {getattr(self, '_err', 'unknown')}")
+		if isinstance(text, bytes):
+			payload, fmt = text, self._cups.CUPS_FORMAT_RAW
+		else:
+			payload, fmt = text.encode("utf-8", errors="replace"), self._cups.CUPS_FORMAT_TEXT
+		with self._lock:
+			result = self._submit(title, payload, fmt)
+			if not result.ok and result.retry:
+				# Connessione scaduta (es. riavvio di cupsd): riapri e riprova una volta.
+				result = self._submit(title, payload, fmt)
+			return result
+
+	def health(self) -> PrintResult:
+		if self._cups is None:
+			return PrintResult(ok=False, error=f"pycups non disponibile: {getattr(self, '_err', 'unknown')}")
+		with self._lock:
+			try:
+				self._connect().getPrinterAttributes(self.connection, requested_attributes=["printer-state"])
+				return PrintResult(ok=True)
+			except Exception as e:
+				self._conn = None
+				return PrintResult(ok=False, error=str(e))
+
+	def close(self) -> None:
+		with self._lock:
+			self._conn = None
+
+
+def parse_socket_connection(connection: str) -> Tuple[str, int]:
+	conn = (connection or "").strip()
+	if conn.startswith("tcp://"):
+		conn = conn[len("tcp://"):]
+	if ":" not in conn:
+		raise ValueError("Formato connection non valido. Usa IP:PORT (es. 192.168.1.50:9100)")
+	host, port_s = conn.rsplit(":", 1)
+	return host, int(port_s)
 
 
 class SocketPrinter(PrinterAdapter):
@@ -57,31 +156,191 @@ class SocketPrinter(PrinterAdapter):
 	- "192.168.1.50:9100"
 	- "tcp://192.168.1.50:9100"
 
-	NOTA: molte termiche accettano testo plain; per ESC/POS completo usa un generatore ESC/POS.
+	La connessione TCP resta aperta tra un job e l'altro (SO_KEEPALIVE), viene verificata prima
+	di ogni invio e riaperta se la stampante l'ha chiusa. Dopo PRINTER_IDLE_CLOSE_SEC senza job
+	viene chiusa, perche' molte stampanti accettano un solo client alla volta sulla 9100.
+	Se l'invio fallisce prima di aver scritto un byte si riapre la connessione e si riprova una
+	volta; dopo un invio parziale no: la stampante ha gia' ricevuto parte dello scontrino.
+
+	NOTA: molte termiche accettano testo plain; con kind="escpos" il payload arriva gia' in ESC/POS.
 	"""
 
-	def send(self, connection: str, title: str, text: str) -> PrintResult:
+	def __init__(
+		self,
+		connection: str,
+		timeout: float = settings.PRINTER_CONNECT_TIMEOUT_SEC,
+		keepalive_sec: int = settings.PRINTER_KEEPALIVE_SEC,
+	) -> None:
+		super().__init__(connection)
+		self.timeout = timeout
+		self.keepalive_sec = keepalive_sec
+		self._lock = threading.Lock()
+		self._sock: Optional[socket.socket] = None
+		self._last_used = 0.0
+		self.connects = 0
+
+	def _open(self) -> socket.socket:
+		host, port = parse_socket_connection(self.connection)
+		s = socket.create_connection((host, port), timeout=self.timeout)
+		s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+		for opt, val in (("TCP_KEEPIDLE", self.keepalive_sec), ("TCP_KEEPINTVL", max(1, self.keepalive_sec // 3)), ("TCP_KEEPCNT", 3)):
+			if hasattr(socket, opt):
+				s.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), val)
+		self.connects += 1
+		return s
+
+	def _drop(self) -> None:
+		if self._sock is not None:
+			try:
+				self._sock.close()
+			except OSError:
+				pass
+			self._sock = None
+
+	def _is_alive(self) -> bool:
+		# Peek non bloccante: b"" = chiusa dal peer, nessun dato = viva.
+		s = self._sock
+		if s is None:
+			return False
 		try:
-			import socket
-			conn = (connection or "").strip()
-			if conn.startswith("tcp://"):
-				conn = conn[len("tcp://"):]
-			if ":" not in conn:
-				return PrintResult(ok=False, error="Formato connection non valido. Usa IP:PORT (es. 192.168.1.50:9100)")
-			host, port_s = conn.rsplit(":", 1)
-			port = int(port_s)
-			payload = (text + "\n\n").encode("utf-8", errors="replace")
-			with socket.create_connection((host, port), timeout=5) as s:
-				s.sendall(payload)
-			return PrintResult(ok=True)
-		except Exception as e:
-			return PrintResult(ok=False, error=str(e))
+			s.setblocking(False)
+			try:
+				return s.recv(1, socket.MSG_PEEK) != b""
+			finally:
+				s.settimeout(self.timeout)
+		except BlockingIOError:
+			return True
+		except OSError:
+			return False
 
+	def _ensure(self) -> socket.socket:
+		if self._sock is not None and not self._is_alive():
+			self._drop()
+		if self._sock is None:
+			self._sock = self._open()
+		return self._sock
 
-def get_adapter(kind: str) -> PrinterAdapter:
+	@staticmethod
+	def _write(sock: socket.socket, payload: bytes) -> int:
+		# come sendall, ma sa quanti byte sono partiti prima di un errore
+		view = memoryview(payload)
+		sent = 0
+		while sent < len(view):
+			try:
+				sent += sock.send(view[sent:])
+			except OSError as e:
+				e.sent = sent  # type: ignore[attr-defined]
+				raise
+		return sent
+
+	def send(self, title: str, text: Payload) -> PrintResult:
+		payload = text if isinstance(text, bytes) else (text + "\n\n").encode("utf-8", errors="replace")
+		with self._lock:
+			error = ""
+			for _attempt in (1, 2):
+				try:
+					self._write(self._ensure(), payload)
+					self._last_used = time.monotonic()
+					return PrintResult(ok=True)
+				except Exception as e:
+					self._drop()
+					sent = getattr(e, "sent", 0)
+					if sent:
+						return PrintResult(ok=False, error=f"{e} (sent {sent}/{len(payload)} bytes)", retry=False)
+					error = str(e)
+			return PrintResult(ok=False, error=error)
+
+	def health(self) -> PrintResult:
+		with self._lock:
+			try:
+				self._ensure()
+				return PrintResult(ok=True)
+			except Exception as e:
+				self._drop()
+				return PrintResult(ok=False, error=str(e))
+
+	def close(self) -> None:
+		with self._lock:
+			self._drop()
+
+	def close_if_idle(self, idle_sec: float) -> None:
+		if not self._lock.acquire(blocking=False):
+			return
+		try:
+			if self._sock is not None and (time.monotonic() - self._last_used > idle_sec or not self._is_alive()):
+				self._drop()
+		finally:
+			self._lock.release()
+
+
+def _make_adapter(kind: str, connection: str) -> PrinterAdapter:
 	k = (kind or "").lower()
 	if k == "cups":
-		return CupsPrinter()
-	if k in ("socket", "tcp", "net"):
-		return SocketPrinter()
-	return DummyPrinter()
+		return CupsPrinter(connection)
+	if k in ("socket", "tcp", "net", "escpos"):
+		return SocketPrinter(connection)
+	return DummyPrinter(connection)
+
+
+class PrinterRegistry:
+	"""Un adapter (e quindi una connessione persistente) per ogni riga `Printer`.
+
+	Se kind/connection della riga cambiano, il vecchio adapter viene chiuso e ricreato. Lo sweep
+	dello spooler chiama sync() con le stampanti attive: gli adapter di righe cancellate o
+	disattivate vengono chiusi subito, non al job successivo.
+	"""
+
+	def __init__(self) -> None:
+		self._lock = threading.Lock()
+		self._adapters: Dict[int, Tuple[str, str, PrinterAdapter]] = {}
+
+	def get(self, printer_id: int, kind: str, connection: str) -> PrinterAdapter:
+		with self._lock:
+			cur = self._adapters.get(printer_id)
+			if cur is not None and cur[0] == kind and cur[1] == connection:
+				return cur[2]
+			if cur is not None:
+				cur[2].close()
+			adapter = _make_adapter(kind, connection)
+			self._adapters[printer_id] = (kind, connection, adapter)
+			return adapter
+
+	def discard(self, printer_id: int) -> None:
+		with self._lock:
+			cur = self._adapters.pop(printer_id, None)
+		if cur is not None:
+			cur[2].close()
+
+	def sync(self, active: Dict[int, Tuple[str, str]]) -> None:
+		"""Scarta gli adapter che non corrispondono piu' a una stampante attiva (id -> kind, connection)."""
+		with self._lock:
+			stale = [pid for pid, (k, c, _a) in self._adapters.items() if active.get(pid) != (k, c)]
+		for pid in stale:
+			self.discard(pid)
+
+	def sweep(self, idle_sec: float = settings.PRINTER_IDLE_CLOSE_SEC) -> None:
+		with self._lock:
+			adapters = [a for (_k, _c, a) in self._adapters.values()]
+		for a in adapters:
+			a.close_if_idle(idle_sec)
+
+	def health(self, printers: Iterable[Tuple[int, str, str]]) -> Dict[int, PrintResult]:
+		"""Health check (bloccante) delle stampanti indicate come (id, kind, connection)."""
+		return {pid: self.get(pid, kind, conn).check() for pid, kind, conn in printers}
+
+	def status(self) -> Dict[int, Optional[PrintResult]]:
+		"""Ultimo esito noto per stampante, senza contattarle."""
+		with self._lock:
+			return {pid: a.last for pid, (_k, _c, a) in self._adapters.items()}
+
+	def close_all(self) -> None:
+		with self._lock:
+			adapters = [a for (_k, _c, a) in self._adapters.values()]
+			self._adapters.clear()
+		for a in adapters:
+			a.close()
+
+
+registry = PrinterRegistry()
+
@@ -0,0 +1,97 @@
+"""Profiler SQL per richiesta (opt-in, SQL_PROFILE=1): per lo sviluppo e per caccia ai round trip.
+
+Mette negli header della risposta statement e tempo DB della richiesta
+(`Server-Timing: db;dur=..;desc="N queries"`, `X-DB-Queries`), logga le query piu' lente di
+SQL_SLOW_MS con i parametri e avvisa quando la stessa forma di statement (parametri e liste IN
+normalizzati) gira piu' di SQL_N1_THRESHOLD volte nella stessa richiesta: il classico N+1.
+Non ha listener propri: usa i tempi e il DbUsage per richiesta di metrics.instrument_engine e
+MetricsMiddleware (metrics.on_statement). Spento non costa nulla: hook e middleware vengono
+installati solo se attivo.
+"""
+from __future__ import annotations
+
+import logging
+import re
+from functools import lru_cache
+from typing import Any, Dict, List, Tuple
+
+from .config import settings
+from .metrics import on_statement, request_db_usage, route_template
+
+log = logging.getLogger("cassa.sql")
+
+_PLACEHOLDER = re.compile(r"\$\d+|%\(\w+\)s|%s|\?")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_ROWS = re.compile(r"\(\?\)(?:\s*,\s*\(\?\))+")
+_SPACES = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=2048)
+def statement_shape(statement: str) -> str:
+	"""Forma dello statement: placeholder uniformati e liste IN/VALUES collassate a un solo `?`."""
+	s = _PLACEHOLDER.sub("?", statement)
+	s = _ROWS.sub("(?)", _IN_LIST.sub("(?)", s))
+	return _SPACES.sub(" ", s).strip()
+
+
+def _params(statement: str, parameters: Any) -> str:
+	if "password_hash" in statement:
+		return "<redacted>"
+	r = repr(parameters)
+	return r if len(r) <= settings.SQL_LOG_PARAMS_MAX else r[: settings.SQL_LOG_PARAMS_MAX] + "..."
+
+
+def repeated(shapes: Dict[str, int], threshold: int) -> List[Tuple[str, int]]:
+	return sorted(((s, n) for s, n in shapes.items() if n > threshold), key=lambda x: -x[1])
+
+
+def _observe(statement: str, parameters: Any, seconds: float) -> None:
+	usage = request_db_usage.get()
+	if usage is not None:
+		shapes = usage.shapes
+		if shapes is None:
+			shapes = usage.shapes = {}
+		shape = statement_shape(statement)
+		shapes[shape] = shapes.get(shape, 0) + 1
+	if seconds * 1000 >= settings.SQL_SLOW_MS:
+		log.warning(
+			"slow query %.1f ms: %s | params=%s", seconds * 1000, _SPACES.sub(" ", statement), _params(statement, parameters)
+		)
+
+
+def enable() -> None:
+	"""Aggancia il profiler ai listener di metrics.instrument_engine (una volta sola)."""
+	on_statement(_observe)
+
+
+class SqlProfilerMiddleware:
+	"""Middleware ASGI: scrive gli header all'avvio della risposta e cerca gli N+1 a fine richiesta.
+
+	Va montato dentro MetricsMiddleware, che apre il DbUsage della richiesta.
+	"""
+
+	def __init__(self, app: Any) -> None:
+		self.app = app
+
+	async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+		usage = request_db_usage.get()
+		if scope["type"] != "http" or usage is None:
+			await self.app(scope, receive, send)
+			return
+
+		async def _send(message: Dict[str, Any]) -> None:
+			if message["type"] == "http.response.start":
+				headers = list(message.get("headers", []))
+				headers.append((b"server-timing", f'db;dur={usage.seconds * 1000:.2f};desc="{usage.queries} queries"'.encode()))
+				headers.append((b"x-db-queries", str(usage.queries).encode()))
+				message = {**message, "headers": headers}
+			await send(message)
+
+		try:
+			await self.app(scope, receive, _send)
+		finally:
+			found = repeated(usage.shapes or {}, settings.SQL_N1_THRESHOLD)
+			if found:
+				route = f"{scope['method']} {route_template(scope)}"
+				for shape, n in found:
+					log.warning("possible N+1 in %s: same statement ran %d times: %s", route, n, shape)
@@ -0,0 +1,301 @@
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime, time, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from .config import settings
+from .db import SessionLocal
+from .models import Order, OrderStatus, Table, User
+from .schemas import OrderOut
+
+
+def order_to_out(order: Order, table_number: int, waiter_name: str) -> OrderOut:
+	return OrderOut(
+		id=order.id,
+		public_id=order.public_id,
+		table_id=order.table_id,
+		table_number=table_number,
+		waiter_id=order.waiter_id,
+		waiter_name=waiter_name,
+		covers=order.covers,
+		apericena=order.apericena,
+		note=order.note,
+		status=order.status,
+		version=order.version,
+		created_at=order.created_at,
+		ready_at=order.ready_at,
+		items=[
+			{
+				"id": it.id,
+				"line_no": it.line_no,
+				"menu_item_id": it.menu_item_id,
+				"name": it.name,
+				"note": it.note,
+				"qty": it.qty,
+				"is_done": it.is_done,
+			}
+			for it in order.items
+		],
+	)
+
+
+async def load_order_out(db: AsyncSession, order_id: int) -> OrderOut:
+	row = await db.execute(
+		select(Order, Table.number, User.display_name)
+		.join(Table, Table.id == Order.table_id)
+		.join(User, User.id == Order.waiter_id)
+		.where(Order.id == order_id)
+		.options(selectinload(Order.items))
+	)
+	order, tnum, waiter_name = row.one()
+	return order_to_out(order, tnum, waiter_name)
+
+
+def _align(dt: Optional[datetime], ref: datetime) -> Optional[datetime]:
+	# Postgres restituisce datetime aware, i parametri di query possono essere naive (UTC).
+	if dt is None or (dt.tzinfo is None) == (ref.tzinfo is None):
+		return dt
+	if dt.tzinfo is None:
+		return dt.replace(tzinfo=timezone.utc)
+	return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def service_day_start(now: Optional[datetime] = None) -> datetime:
+	"""Inizio (UTC naive, come created_at) della giornata di servizio in corso.
+
+	La giornata inizia alle ORDER_DAY_START_HOUR locali, come il contatore dei numeri comanda.
+	"""
+	local = (now or datetime.utcnow()).replace(tzinfo=timezone.utc).astimezone()
+	day = (local - timedelta(hours=settings.ORDER_DAY_START_HOUR)).date()
+	start = datetime.combine(day, time(settings.ORDER_DAY_START_HOUR), tzinfo=local.tzinfo)
+	return start.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+class _Entry:
+	__slots__ = ("out", "json", "sort_key")
+
+	def __init__(self, out: OrderOut) -> None:
+		self.out = out
+		self.json = out.model_dump_json().encode()
+		self.sort_key = (out.created_at, out.id)
+
+
+class LiveOrders:
+	"""Proiezione in memoria degli ordini "live": non CLOSED e della giornata di servizio in corso
+	(con righe, numero tavolo e cameriere).
+
+	Viene ricostruita all'avvio (o su richiesta admin) e poi aggiornata incrementalmente dagli
+	endpoint che modificano gli ordini. Ogni ordine e' tenuto gia' serializzato in JSON, e la
+	lista completa (il caso di tutti i client al login/riconnessione) e' memorizzata come un
+	unico body: una lettura non tocca ne' Postgres ne' pydantic.
+
+	Un ordine esce quando passa a CLOSED o, al piu' tardi, al cambio di giornata (roll(), chiamato
+	da letture e aggiornamenti): la proiezione non cresce per tutta la vita del processo.
+	"""
+
+	def __init__(self) -> None:
+		self.day_start = service_day_start()
+		self._next_day = self.day_start + timedelta(days=1)
+		self.evicted = 0
+		self._entries: Dict[int, _Entry] = {}
+		self._by_public: Dict[str, int] = {}
+		self._sorted: Optional[List[_Entry]] = None
+		self._body: Optional[bytes] = None
+		self._ready = False
+		self._rebuild_lock = asyncio.Lock()
+		# aggiornamenti arrivati durante un rebuild: riapplicati sopra lo snapshot caricato
+		self._pending: Optional[List[OrderOut]] = None
+
+	@property
+	def ready(self) -> bool:
+		return self._ready
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	def roll(self, now: Optional[datetime] = None) -> int:
+		"""Al cambio di giornata toglie gli ordini dei giorni precedenti; restituisce quanti."""
+		now = now or datetime.utcnow()
+		if now < self._next_day:
+			return 0
+		self.day_start = service_day_start(now)
+		self._next_day = self.day_start + timedelta(days=1)
+		old = [oid for oid, e in self._entries.items() if not self._today(e.out)]
+		for oid in old:
+			e = self._entries.pop(oid)
+			self._by_public.pop(e.out.public_id, None)
+		if old:
+			self.evicted += len(old)
+			self._changed()
+		return len(old)
+
+	def _today(self, out: OrderOut) -> bool:
+		return out.created_at >= _align(self.day_start, out.created_at)
+
+	async def rebuild(self) -> int:
+		async with self._rebuild_lock:
+			self._pending = []
+			try:
+				self.roll()
+				async with SessionLocal() as db:
+					res = await db.execute(
+						select(Order, Table.number, User.display_name)
+						.join(Table, Table.id == Order.table_id)
+						.join(User, User.id == Order.waiter_id)
+						.where(Order.status != OrderStatus.CLOSED, Order.created_at >= self.day_start)
+						.options(selectinload(Order.items))
+					)
+					entries = {o.id: _Entry(order_to_out(o, tnum, wname)) for o, tnum, wname in res.all()}
+				self._entries = entries
+				self._by_public = {e.out.public_id: oid for oid, e in entries.items()}
+				for out in self._pending:
+					self._apply(out)
+				self._ready = True
+			finally:
+				self._pending = None
+				self._changed()
+			return len(self._entries)
+
+	def invalidate(self) -> None:
+		self._ready = False
+		self._entries = {}
+		self._by_public = {}
+		self._changed()
+
+	def _changed(self) -> None:
+		self._sorted = None
+		self._body = None
+
+	def _apply(self, out: OrderOut) -> None:
+		cur = self._entries.get(out.id)
+		if cur is not None and cur.out.version > out.version:
+			return  # aggiornamento vecchio arrivato in ritardo
+		if out.status == OrderStatus.CLOSED or not self._today(out):
+			self._entries.pop(out.id, None)
+			self._by_public.pop(out.public_id, None)
+		else:
+			self._entries[out.id] = _Entry(out)
+			self._by_public[out.public_id] = out.id
+
+	def apply(self, out: OrderOut) -> None:
+		self.roll()
+		if self._pending is not None:
+			self._pending.append(out)
+		self._apply(out)
+		self._changed()
+
+	def set_status(self, order_id: int, status: OrderStatus, version: int) -> Optional[OrderOut]:
+		"""Cambia lo stato di un ordine gia' in proiezione alla versione data (None se non c'e')."""
+		e = self._entries.get(order_id)
+		if e is None:
+			return None
+		out = e.out.model_copy(update={"status": status, "version": max(version, e.out.version)})
+		self.apply(out)
+		return out
+
+	def patch_items(
+		self,
+		order_id: int,
+		changes: Dict[int, bool],
+		version: int,
+		status: OrderStatus,
+		ready_at: Optional[datetime],
+	) -> Optional[OrderOut]:
+		"""Applica i tick di una o piu' righe (item_id -> is_done) senza ricaricare l'ordine.
+
+		None se l'ordine non e' in proiezione.
+		"""
+		e = self._entries.get(order_id)
+		if e is None:
+			return None
+		items = [
+			it.model_copy(update={"is_done": changes[it.id]}) if it.id in changes else it for it in e.out.items
+		]
+		out = e.out.model_copy(
+			update={"items": items, "version": max(version, e.out.version), "status": status, "ready_at": ready_at}
+		)
+		self.apply(out)
+		return out
+
+	def apply_event(self, payload: Dict[str, Any]) -> None:
+		"""Applica un evento arrivato da un altro worker (see bus.EventBus.subscribe)."""
+		kind = payload.get("type")
+		if kind in ("order_created", "order_updated"):
+			self.apply(OrderOut.model_validate(payload["order"]))
+		elif kind in ("item_done", "items_done"):
+			if kind == "item_done":
+				changes = {payload["item_id"]: payload["is_done"]}
+			else:
+				changes = {it["item_id"]: it["is_done"] for it in payload["items"]}
+			ready_at = payload.get("ready_at")
+			self.patch_items(
+				payload["order_id"],
+				changes,
+				payload["version"],
+				OrderStatus(payload["status"]),
+				datetime.fromisoformat(ready_at) if ready_at else None,
+			)
+
+	def _ordered(self) -> List[_Entry]:
+		if self._sorted is None:
+			self._sorted = sorted(self._entries.values(), key=lambda e: e.sort_key, reverse=True)
+		return self._sorted
+
+	def get(self, order_id: int) -> Optional[OrderOut]:
+		self.roll()
+		e = self._entries.get(order_id)
+		return e.out if e is not None else None
+
+	def get_by_public_id(self, public_id: str) -> Optional[OrderOut]:
+		order_id = self._by_public.get(public_id)
+		return self.get(order_id) if order_id is not None else None
+
+	def list_json(
+		self,
+		status: Optional[OrderStatus] = None,
+		since: Optional[datetime] = None,
+		until: Optional[datetime] = None,
+		table_number: Optional[int] = None,
+		waiter_id: Optional[int] = None,
+		limit: Optional[int] = None,
+	) -> tuple[bytes, Optional[OrderOut]]:
+		"""Body JSON (array di OrderOut) e, se la lista e' stata troncata a `limit`, l'ultimo ordine incluso."""
+		self.roll()
+		ordered = self._ordered()
+		unfiltered = status is None and since is None and until is None and table_number is None and waiter_id is None
+		if unfiltered and (limit is None or len(ordered) <= limit):
+			if self._body is None:
+				self._body = b"[" + b",".join(e.json for e in ordered) + b"]"
+			return self._body, None
+		if ordered:
+			since = _align(since, ordered[0].out.created_at)
+			until = _align(until, ordered[0].out.created_at)
+		picked: List[_Entry] = []
+		for e in ordered:
+			o = e.out
+			if status is not None and o.status != status:
+				continue
+			if since is not None and o.created_at < since:
+				continue
+			if until is not None and o.created_at >= until:
+				continue
+			if table_number is not None and o.table_number != table_number:
+				continue
+			if waiter_id is not None and o.waiter_id != waiter_id:
+				continue
+			picked.append(e)
+			if limit is not None and len(picked) > limit:
+				break
+		last = None
+		if limit is not None and len(picked) > limit:
+			picked = picked[:limit]
+			last = picked[-1].out
+		return b"[" + b",".join(e.json for e in picked) + b"]", last
+
+
+live_orders = LiveOrders()
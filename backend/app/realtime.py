@@ -1,38 +1,303 @@
-import json
-from collections import defaultdict
-from typing import Any, Dict, Set
+import asyncio
+import logging
+import time
+from collections import defaultdict, deque
+from typing import Any, Dict, FrozenSet, Iterable, Mapping, Optional, Set, Tuple, Union
 
 from fastapi import WebSocket
 
+from .config import settings
+from .events import Event, as_event
+from .metrics import COUNT_BUCKETS, Counter, Gauge, Histogram
+
+log = logging.getLogger(__name__)
+
+_EMPTY: FrozenSet[Any] = frozenset()
+
+ws_clients = Gauge(
+	"cassa_ws_clients", "Connected WebSocket clients per channel.", ["channel"],
+	fn=lambda: {ch: len(s) for ch, s in manager._by_channel.items()},
+)
+ws_sent = Counter("cassa_ws_messages_sent_total", "WebSocket frames sent.", fn=lambda: manager.sent)
+ws_dropped = Counter("cassa_ws_messages_dropped_total", "WebSocket messages dropped (slow clients).", fn=lambda: manager.dropped)
+ws_bytes = Counter(
+	"cassa_ws_bytes_sent_total", "WebSocket payload bytes sent per frame format (before permessage-deflate).", ["format"],
+	fn=lambda: dict(manager.bytes_sent),
+)
+ws_evicted = Counter("cassa_ws_clients_evicted_total", "WebSocket clients disconnected for being slow.", fn=lambda: manager.evicted)
+broadcast_seconds = Histogram("cassa_ws_broadcast_duration_seconds", "Time to serialize and enqueue one broadcast.")
+broadcast_fanout = Histogram("cassa_ws_broadcast_fanout", "Connections reached by one broadcast.", buckets=COUNT_BUCKETS)
+ws_delivery = Histogram(
+	"cassa_ws_delivery_seconds", "Time from event publish to the frame being written, per channel.", ["channel"]
+)
+
+
+# Filtri di sottoscrizione: dimensione -> valori ammessi (see events.Event.keys)
+Filters = Mapping[str, FrozenSet[Any]]
+
+
+def matches(filters: Filters, event: Event) -> bool:
+	"""Controllo per un singolo socket (replay); il broadcast usa l'indice del ConnectionManager."""
+	keys = event.keys
+	return all(keys.get(dim) is None or keys[dim] in values for dim, values in filters.items())
+
+
+class _Client:
+	"""Una connessione WS con la sua coda di uscita limitata e il task che la svuota.
+
+	La coda e' una deque con un future di risveglio: costa meno di asyncio.Queue, e con 100+
+	tablet l'accodamento e' tutto il lavoro che broadcast fa sul percorso della richiesta.
+	Il writer svuota tutta la coda a ogni risveglio; `progress` conta i frame inviati e basta al
+	watchdog per riconoscere un invio bloccato, senza leggere l'orologio a ogni frame.
+	"""
+
+	__slots__ = ("ws", "channel", "filters", "binary", "queue", "waiter", "task", "progress", "stall", "delivery")
+
+	def __init__(self, ws: WebSocket, channel: str, filters: Filters, binary: bool = False) -> None:
+		self.ws = ws
+		self.channel = channel
+		self.filters = filters
+		self.binary = binary  # frame binari MessagePack invece di testo JSON
+		self.queue: deque[Event] = deque()
+		self.waiter: Optional[asyncio.Future] = None
+		self.task: Optional[asyncio.Task] = None
+		self.progress = 0  # frame inviati da questo writer
+		self.stall: Optional[Tuple[int, float]] = None  # (progress, loop.time()) visto dal watchdog
+		self.delivery = ws_delivery.labels(channel)
+
+
 class ConnectionManager:
-	def __init__(self) -> None:
+	"""Fan-out WS non bloccante.
+
+	Ogni evento viene serializzato una volta (events.Event) e lo stesso buffer finisce nella coda
+	di tutte le connessioni destinatarie, deduplicate tra canali.
+	broadcast() si limita ad accodare il messaggio su ogni connessione (put_nowait); un writer
+	task per connessione lo invia. Un client lento che riempie la coda o resta bloccato in un invio
+	oltre `send_timeout` (controllato da un unico watchdog, senza un timer per ogni frame) viene
+	disconnesso (close 1013) e il client si riconnette: gli altri tablet non aspettano.
+
+	Un socket puo' restringere il suo canale con dei filtri (es. solo il proprio cameriere, alcuni
+	tavoli, alcuni tipi di evento). Per canale e dimensione c'e' un indice valore -> socket: un
+	evento esclude i socket che filtrano quella dimensione su altri valori, senza valutare i filtri
+	socket per socket; i socket senza filtri non costano nulla. Un evento senza quella chiave
+	(es. call_acked non ha tavolo) arriva a tutti.
+
+	Ogni socket sceglie il formato dei frame: testo JSON o binario MessagePack. Un evento viene
+	codificato al piu' una volta per formato, e solo se c'e' almeno un socket che lo usa.
+	"""
+
+	def __init__(
+		self,
+		queue_size: int = settings.WS_QUEUE_SIZE,
+		send_timeout: float = settings.WS_SEND_TIMEOUT_SEC,
+	) -> None:
+		self.queue_size = max(1, queue_size)
+		self.send_timeout = send_timeout
 		self._by_channel: Dict[str, Set[WebSocket]] = defaultdict(set)
+		self._clients: Dict[WebSocket, _Client] = {}
+		# canale -> dimensione -> socket che la filtrano / valore -> socket
+		self._filtered: Dict[str, Dict[str, Set[WebSocket]]] = {}
+		self._index: Dict[str, Dict[str, Dict[Any, Set[WebSocket]]]] = {}
+		self.binary_clients = 0
+		self.sent = 0
+		self.bytes_sent: Dict[str, int] = {"json": 0, "msgpack": 0}
+		self.dropped = 0
+		self.evicted = 0
+		self._watchdog: Optional[asyncio.Task] = None
 
-	async def connect(self, ws: WebSocket, channel: str) -> None:
+	async def connect(self, ws: WebSocket, channel: str, filters: Optional[Filters] = None, binary: bool = False) -> None:
 		await ws.accept()
+		if self._watchdog is None or self._watchdog.done():
+			self._watchdog = asyncio.create_task(self._watch())
+		filters = {dim: frozenset(v) for dim, v in (filters or {}).items() if v}
+		client = _Client(ws, channel, filters, binary)
+		client.task = asyncio.create_task(self._writer(client))
+		self._clients[ws] = client
+		self.binary_clients += binary
 		self._by_channel[channel].add(ws)
+		for dim, values in filters.items():
+			self._filtered.setdefault(channel, {}).setdefault(dim, set()).add(ws)
+			index = self._index.setdefault(channel, {}).setdefault(dim, {})
+			for v in values:
+				index.setdefault(v, set()).add(ws)
 
 	def disconnect(self, ws: WebSocket) -> None:
-		for ch in list(self._by_channel.keys()):
-			self._by_channel[ch].discard(ws)
-			if not self._by_channel[ch]:
-				del self._by_channel[ch]
+		client = self._clients.pop(ws, None)
+		if client is None:
+			return
+		self.binary_clients -= client.binary
+		chans = self._by_channel.get(client.channel)
+		if chans is not None:
+			chans.discard(ws)
+			if not chans:
+				del self._by_channel[client.channel]
+		if client.filters:
+			self._unindex(client)
+		if client.task is not None and client.task is not asyncio.current_task():
+			client.task.cancel()
 
-	async def broadcast(self, channel: str, event: Dict[str, Any]) -> None:
-		if channel not in self._by_channel:
+	def _unindex(self, client: _Client) -> None:
+		ch = client.channel
+		filtered, index = self._filtered[ch], self._index[ch]
+		for dim, values in client.filters.items():
+			filtered[dim].discard(client.ws)
+			if not filtered[dim]:
+				del filtered[dim]
+			for v in values:
+				sockets = index[dim][v]
+				sockets.discard(client.ws)
+				if not sockets:
+					del index[dim][v]
+			if not index[dim]:
+				del index[dim]
+		if not filtered:
+			del self._filtered[ch], self._index[ch]
+
+	def _evict(self, client: _Client, reason: str) -> None:
+		if client.ws not in self._clients:
 			return
-		data = json.dumps(event, ensure_ascii=False)
-		dead: Set[WebSocket] = set()
-		for ws in self._by_channel[channel]:
+		self.evicted += 1
+		self.dropped += len(client.queue)
+		log.warning("ws client on %s evicted: %s", client.channel, reason)
+		self.disconnect(client.ws)
+		asyncio.create_task(self._close(client.ws))
+
+	@staticmethod
+	async def _close(ws: WebSocket) -> None:
+		try:
+			await ws.close(code=1013)
+		except Exception:
+			pass
+
+	async def _watch(self) -> None:
+		loop = asyncio.get_running_loop()
+		interval = min(1.0, self.send_timeout / 2)
+		while self._clients:
+			await asyncio.sleep(interval)
+			now = loop.time()
+			for client in list(self._clients.values()):
+				if client.waiter is not None or client.task is None:
+					client.stall = None  # writer in attesa di eventi: niente in volo
+					continue
+				mark = client.stall
+				if mark is None or mark[0] != client.progress:
+					client.stall = (client.progress, now)
+				elif now - mark[1] > self.send_timeout:
+					self.dropped += 1  # il messaggio in volo
+					self._evict(client, "send timeout")
+
+	async def _writer(self, client: _Client) -> None:
+		loop = asyncio.get_running_loop()
+		q = client.queue
+		ws = client.ws
+		fmt = "msgpack" if client.binary else "json"
+		while True:
+			if not q:
+				client.waiter = loop.create_future()
+				await client.waiter
+				client.waiter = None
+			# svuota la coda senza tornare sul future: un risveglio per raffica, non per frame.
+			# La latenza di consegna si osserva sul primo frame, il piu' vecchio della raffica.
+			first = True
+			n = nbytes = 0
 			try:
-				await ws.send_text(data)
+				while q:
+					event = q.popleft()
+					if client.binary:
+						data = event.packed
+						await ws.send_bytes(data)
+						nbytes += len(data)
+					else:
+						await ws.send_text(event.text)
+						nbytes += len(event.data)
+					n += 1
+					client.progress += 1
+					if first:
+						client.delivery.observe(time.perf_counter() - event.created)
+						first = False
 			except Exception:
-				dead.add(ws)
-		for ws in dead:
-			self._by_channel[channel].discard(ws)
+				self.disconnect(ws)
+				return
+			finally:
+				self.sent += n
+				self.bytes_sent[fmt] += nbytes
 
-	async def broadcast_many(self, channels: list[str], event: Dict[str, Any]) -> None:
+	def _enqueue(self, client: _Client, event: Event) -> None:
+		if len(client.queue) >= self.queue_size:
+			self.dropped += 1
+			self._evict(client, "queue full")
+			return
+		client.queue.append(event)
+		w = client.waiter
+		if w is not None and not w.done():
+			w.set_result(None)
+
+	def send(self, ws: WebSocket, event: Union[Event, Dict[str, Any]]) -> None:
+		client = self._clients.get(ws)
+		if client is not None:
+			self._enqueue(client, as_event(event))
+
+	def _targets(self, channels: Iterable[str], event: Event) -> Set[WebSocket]:
+		targets: Set[WebSocket] = set()
 		for ch in channels:
-			await self.broadcast(ch, event)
+			sockets = self._by_channel.get(ch)
+			if not sockets:
+				continue
+			filtered = self._filtered.get(ch)
+			if filtered:
+				keys = event.keys
+				index = self._index[ch]
+				excluded: Set[WebSocket] = set()
+				for dim, fsockets in filtered.items():
+					v = keys.get(dim)
+					if v is not None:
+						excluded |= fsockets - index[dim].get(v, _EMPTY)
+				if excluded:
+					sockets = sockets - excluded
+			targets |= sockets
+		return targets
+
+	async def broadcast(self, channel: str, event: Union[Event, Dict[str, Any]]) -> None:
+		await self.broadcast_many([channel], event)
+
+	async def broadcast_many(self, channels: Iterable[str], event: Union[Event, Dict[str, Any]]) -> None:
+		ev = as_event(event)
+		targets = self._targets(channels, ev)
+		if not targets:
+			return
+		t0 = time.perf_counter()
+		# serializza qui, una volta per formato in uso, non nei writer
+		if self.binary_clients < len(self._clients):
+			ev.text
+		if self.binary_clients:
+			ev.packed
+		for ws in targets:
+			client = self._clients.get(ws)
+			if client is not None:
+				self._enqueue(client, ev)
+		broadcast_seconds.observe(time.perf_counter() - t0)
+		broadcast_fanout.observe(len(targets))
+
+	def stats(self) -> Dict[str, Any]:
+		channels: Dict[str, Dict[str, int]] = {}
+		for ch, sockets in self._by_channel.items():
+			depths = [len(self._clients[ws].queue) for ws in sockets if ws in self._clients]
+			channels[ch] = {
+				"clients": len(depths),
+				"filtered": sum(1 for ws in sockets if ws in self._clients and self._clients[ws].filters),
+				"queue_depth": sum(depths),
+				"queue_depth_max": max(depths, default=0),
+			}
+		return {
+			"clients": len(self._clients),
+			"binary_clients": self.binary_clients,
+			"channels": channels,
+			"sent": self.sent,
+			"bytes_sent": dict(self.bytes_sent),
+			"dropped": self.dropped,
+			"evicted": self.evicted,
+			"queue_size": self.queue_size,
+			"send_timeout": self.send_timeout,
+		}
 
 manager = ConnectionManager()
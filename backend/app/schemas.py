@@ -15,6 +15,11 @@ class UserOut(BaseModel):
 	display_name: str
 	role: Role
 
+class UserUpdateIn(BaseModel):
+	display_name: Optional[str] = None
+	role: Optional[Role] = None
+	is_active: Optional[bool] = None
+
 class LoginIn(BaseModel):
 	username: str
 	password: str
@@ -26,6 +31,12 @@ class MenuItemOut(BaseModel):
 	category: str
 	price: float
 
+class MenuItemUpdateIn(BaseModel):
+	name: Optional[str] = None
+	category: Optional[str] = None
+	price: Optional[float] = Field(default=None, ge=0)
+	is_active: Optional[bool] = None
+
 class OrderItemOut(BaseModel):
 	id: int
 	line_no: int
@@ -46,6 +57,7 @@ class OrderOut(BaseModel):
 	apericena: int
 	note: Optional[str] = None
 	status: OrderStatus
+	version: int = 1
 	created_at: datetime
 	ready_at: Optional[datetime] = None
 	items: List[OrderItemOut]
@@ -65,6 +77,13 @@ class CreateOrderIn(BaseModel):
 class UpdateItemDoneIn(BaseModel):
 	is_done: bool
 
+class ItemDoneIn(BaseModel):
+	item_id: int
+	is_done: bool = True
+
+class BulkItemDoneIn(BaseModel):
+	items: List[ItemDoneIn] = Field(min_length=1, max_length=500)
+
 class CallIn(BaseModel):
 	call_type: CallType
 	to_user_id: Optional[int] = None
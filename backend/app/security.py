@@ -1,21 +1,36 @@
+import asyncio
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import Any, Dict, Optional, Tuple
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
 
+from .bus import bus
 from .config import settings
-from .db import get_db
+from .db import SessionLocal
 from .models import User
 
 # Argon2 is robust and avoids bcrypt wheel/backend edge-cases on Windows.
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+pwd_context = CryptContext(
+	schemes=["argon2"],
+	deprecated="auto",
+	argon2__rounds=settings.ARGON2_TIME_COST,
+	argon2__memory_cost=settings.ARGON2_MEMORY_KIB,
+	argon2__parallelism=settings.ARGON2_PARALLELISM,
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
+# Un hash Argon2 costa decine/centinaia di ms di CPU: dall'event loop bloccherebbe i push WS.
+# argon2-cffi rilascia il GIL, quindi basta un pool di thread; la sua dimensione limita quanti
+# hash girano insieme (gli altri login aspettano in coda senza bloccare il loop).
+_hash_pool = ThreadPoolExecutor(max_workers=max(1, settings.AUTH_HASH_THREADS), thread_name_prefix="argon2")
+
 
 def hash_password(password: str) -> str:
 	return pwd_context.hash(password)
@@ -25,6 +40,17 @@ def verify_password(password: str, password_hash: str) -> bool:
 	return pwd_context.verify(password, password_hash)
 
 
+async def hash_password_async(password: str) -> str:
+	return await asyncio.get_running_loop().run_in_executor(_hash_pool, hash_password, password)
+
+
+async def verify_password_async(password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+	"""(ok, nuovo hash) - il nuovo hash e' valorizzato se i parametri Argon2 sono cambiati."""
+	return await asyncio.get_running_loop().run_in_executor(
+		_hash_pool, pwd_context.verify_and_update, password, password_hash
+	)
+
+
 def create_access_token(sub: str) -> str:
 	now = datetime.now(timezone.utc)
 	exp = now + timedelta(minutes=settings.JWT_EXPIRE_MIN)
@@ -32,25 +58,97 @@ def create_access_token(sub: str) -> str:
 	return jwt.encode(payload, settings.JWT_SECRET, algorithm=settings.JWT_ALG)
 
 
-async def get_current_user(
-	token: str = Depends(oauth2_scheme),
-	db: AsyncSession = Depends(get_db),
-) -> User:
-	cred_exc = HTTPException(
-		status_code=status.HTTP_401_UNAUTHORIZED,
-		detail="Could not validate credentials",
-		headers={"WWW-Authenticate": "Bearer"},
-	)
+class PrincipalCache:
+	"""Utenti autenticati per `sub` del JWT, con TTL e dimensione massima (LRU).
+
+	Gli oggetti User in cache sono staccati dalla sessione: vanno solo letti. Va invalidata
+	(invalidate_principal) quando un utente viene disattivato o cambia ruolo; il TTL limita
+	comunque quanto a lungo una modifica fatta a mano sul DB resta invisibile.
+	Chi carica un utente dal DB prende `gen` prima della lettura e lo passa a put(): se nel
+	frattempo c'e' stata un'invalidazione, il valore letto puo' essere vecchio e non entra in cache.
+	"""
+
+	def __init__(self, ttl: float = settings.AUTH_CACHE_TTL_SEC, max_size: int = settings.AUTH_CACHE_SIZE) -> None:
+		self.ttl = ttl
+		self.max_size = max(1, max_size)
+		self._entries: "OrderedDict[str, Tuple[float, User]]" = OrderedDict()
+		self.gen = 0  # cambia a ogni invalidate: scarta un caricamento partito prima
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, sub: str) -> Optional[User]:
+		e = self._entries.get(sub)
+		if e is None or e[0] < time.monotonic():
+			self.misses += 1
+			return None
+		self._entries.move_to_end(sub)
+		self.hits += 1
+		return e[1]
+
+	def put(self, sub: str, user: User, gen: Optional[int] = None) -> None:
+		if self.ttl <= 0 or (gen is not None and gen != self.gen):
+			return
+		self._entries[sub] = (time.monotonic() + self.ttl, user)
+		self._entries.move_to_end(sub)
+		while len(self._entries) > self.max_size:
+			self._entries.popitem(last=False)
+
+	def invalidate(self, sub: Optional[str] = None) -> None:
+		self.gen += 1
+		if sub is None:
+			self._entries.clear()
+		else:
+			self._entries.pop(sub, None)
+
+	def apply_event(self, payload: Dict[str, Any]) -> None:
+		"""Invalidazioni arrivate da altri worker (see bus.EventBus.subscribe)."""
+		if payload.get("type") == "principal_invalidated":
+			self.invalidate(payload.get("username"))
+
+	def stats(self) -> Dict[str, Any]:
+		return {"size": len(self._entries), "max_size": self.max_size, "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+
+principals = PrincipalCache()
+
+
+async def invalidate_principal(username: Optional[str] = None) -> None:
+	"""Invalida l'utente (o tutti, se None) in questo worker e negli altri."""
+	principals.invalidate(username)
+	await bus.publish([], {"type": "principal_invalidated", "username": username})
+
+
+async def user_from_token(token: str) -> Optional[User]:
+	"""Utente attivo del JWT, o None. Prima la cache; in caso di miss una sessione aperta e chiusa
+	subito, cosi' chi resta connesso a lungo (i WebSocket) non tiene occupata una connessione del pool."""
 	try:
 		payload = jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALG])
-		sub: Optional[str] = payload.get("sub")
-		if not sub:
-			raise cred_exc
 	except JWTError:
-		raise cred_exc
+		return None
+	sub: Optional[str] = payload.get("sub")
+	if not sub:
+		return None
+
+	user = principals.get(sub)
+	if user is not None:
+		return user
+	gen = principals.gen
+	async with SessionLocal() as db:
+		res = await db.execute(select(User).where(User.username == sub, User.is_active == True))
+		user = res.scalar_one_or_none()
+		if not user:
+			return None
+		db.expunge(user)
+	principals.put(sub, user, gen)
+	return user
+
 
-	res = await db.execute(select(User).where(User.username == sub, User.is_active == True))
-	user = res.scalar_one_or_none()
-	if not user:
-		raise cred_exc
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
+	user = await user_from_token(token)
+	if user is None:
+		raise HTTPException(
+			status_code=status.HTTP_401_UNAUTHORIZED,
+			detail="Could not validate credentials",
+			headers={"WWW-Authenticate": "Bearer"},
+		)
 	return user
@@ -1,33 +1,77 @@
+"""Dati iniziali/demo, da eseguire a parte dopo le migrazioni:
+
+    python -m app.seed
+
+Inserisce solo nelle tabelle vuote, quindi si puo' rilanciare senza duplicati.
+"""
+from __future__ import annotations
+
+import asyncio
+
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from .models import User, Table, Printer
-from .security import hash_password
+from .db import SessionLocal, engine
+from .models import MenuItem, Printer, Role, Table, User
+from .security import hash_password_async
+
 
 async def seed_if_empty(db: AsyncSession) -> None:
-    # Users
-    res = await db.execute(select(User).limit(1))
-    if res.scalar_one_or_none() is None:
-        users = [
-            User(username="emma",  password_hash=hash_password("1234"), display_name="Emma", role="waiter"),
-            User(username="luca",  password_hash=hash_password("1234"), display_name="Luca", role="waiter"),
-            User(username="marco", password_hash=hash_password("1234"), display_name="Marco", role="cashier"),
-            User(username="bar",   password_hash=hash_password("1234"), display_name="Bar", role="bar"),
-            User(username="admin", password_hash=hash_password("admin"), display_name="Admin", role="admin"),
-        ]
-        db.add_all(users)
-
-    # Tables 1..30
-    res2 = await db.execute(select(Table).limit(1))
-    if res2.scalar_one_or_none() is None:
-        db.add_all([Table(number=i, name=None) for i in range(1, 31)])
-
-    # Printers (demo)
-    res3 = await db.execute(select(Printer).limit(1))
-    if res3.scalar_one_or_none() is None:
-        db.add_all([
-            Printer(name="BAR_PRINTER", kind="cups", connection="BAR_PRINTER", station="BAR"),
-            Printer(name="CASSA_PRINTER", kind="cups", connection="CASSA_PRINTER", station="CASSA"),
-        ])
-
-    await db.commit()
+	"""Dati demo (utenti, tavoli 1..30, menu, stampante) nelle tabelle ancora vuote."""
+	# Users
+	res = await db.execute(select(User).limit(1))
+	if res.scalar_one_or_none() is None:
+		demo = [
+			("admin", "Admin", Role.ADMIN, "admin"),
+			("emma", "Emma", Role.WAITER, "1234"),
+			("luca", "Luca", Role.WAITER, "1234"),
+			("marco", "Marco", Role.CASHIER, "1234"),
+			("bar", "Bar", Role.BAR, "1234"),
+		]
+		hashes = await asyncio.gather(*(hash_password_async(pw) for *_, pw in demo))
+		users = [
+			User(username=u, display_name=name, role=role, password_hash=h)
+			for (u, name, role, _), h in zip(demo, hashes)
+		]
+		db.add_all(users)
+
+	# Tables 1..30
+	res = await db.execute(select(Table).limit(1))
+	if res.scalar_one_or_none() is None:
+		db.add_all([Table(number=i) for i in range(1, 31)])
+
+	# Menu demo
+	res = await db.execute(select(MenuItem).limit(1))
+	if res.scalar_one_or_none() is None:
+		db.add_all([
+			MenuItem(sku="spritz", name="Spritz", category="Drink", price=6.00),
+			MenuItem(sku="gin_tonic", name="Gin Tonic", category="Drink", price=8.00),
+			MenuItem(sku="negroni", name="Negroni", category="Drink", price=9.00),
+			MenuItem(sku="analcolico", name="Analcolico", category="Drink", price=5.00),
+			MenuItem(sku="caffe", name="Caffè", category="Caffetteria", price=1.20),
+			MenuItem(sku="cappuccino", name="Cappuccino", category="Caffetteria", price=1.80),
+			MenuItem(sku="cornetto", name="Cornetto", category="Caffetteria", price=1.50),
+			MenuItem(sku="tagliere", name="Tagliere", category="Apericena", price=12.00),
+			MenuItem(sku="nachos", name="Nachos", category="Apericena", price=7.50),
+			MenuItem(sku="patatine", name="Patatine", category="Apericena", price=4.00),
+		])
+
+	# Printer demo
+	res = await db.execute(select(Printer).limit(1))
+	if res.scalar_one_or_none() is None:
+		db.add(Printer(name="BAR_PRINTER", kind="dummy", connection="bar"))
+
+	await db.commit()
+
+
+async def _main() -> None:
+	try:
+		async with SessionLocal() as db:
+			await seed_if_empty(db)
+		print("seed ok")
+	finally:
+		await engine.dispose()
+
+
+if __name__ == "__main__":
+	asyncio.run(_main())
@@ -0,0 +1,335 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import or_, select, update
+
+from .bus import bus
+from .config import settings
+from .db import SessionLocal
+from .metrics import Counter, Gauge, Histogram
+from .models import Order, OrderStatus, Printer, PrintJob, Table
+from .printers import Payload, PrintResult, registry
+from .projection import live_orders, load_order_out
+
+log = logging.getLogger(__name__)
+
+PRINT_CHANNELS = ["bar", "admin", "cassa", "waiter"]
+
+print_latency = Histogram(
+	"cassa_print_job_duration_seconds", "Time from job submit to final outcome, retries included.", ["printer"]
+)
+print_send = Histogram("cassa_print_send_duration_seconds", "Duration of one send attempt to the printer.", ["printer"])
+print_jobs = Counter("cassa_print_jobs_total", "Print jobs completed, by outcome (SENT/ERROR).", ["printer", "status"])
+print_errors = Counter("cassa_print_attempt_errors_total", "Failed send attempts (retried or not).", ["printer"])
+
+
+@dataclass
+class _Job:
+	id: int
+	printer_id: int
+	printer_name: str
+	order_id: int
+	public_id: str
+	waiter_id: int
+	table_number: int
+	kind: str
+	connection: str
+	payload: Payload
+
+
+class PrintSpooler:
+	"""Spooler di stampa: una coda FIFO e un worker asyncio per ogni stampante.
+
+	Le richieste HTTP registrano solo il PrintJob (QUEUED) e chiamano submit().
+	Il worker invia i job in ordine di arrivo su un thread pool dedicato, cosi' una
+	stampante offline non blocca l'event loop. In caso di errore il job viene ritentato
+	con backoff esponenziale; i job successivi della stessa stampante aspettano, per
+	garantire la consegna in ordine. Un errore non ritentabile (job forse gia' stampato in
+	parte, see PrintResult.retry) chiude subito il job in ERROR: meglio una ristampa manuale
+	che uno scontrino doppio.
+
+	Il job in invio resta in SENDING con un lease (`claimed_at`, rinnovato a ogni tentativo). Se lo
+	spooler muore a meta' invio il lease scade e il job torna in QUEUED, all'avvio o nello sweep
+	periodico di uno spooler qualsiasi: dopo un crash si preferisce una possibile ristampa a una
+	comanda persa.
+	"""
+
+	def __init__(
+		self,
+		max_attempts: int = settings.PRINT_MAX_ATTEMPTS,
+		retry_base: float = settings.PRINT_RETRY_BASE_SEC,
+		retry_max: float = settings.PRINT_RETRY_MAX_SEC,
+		threads: int = settings.PRINT_THREADS,
+		lease: float = settings.PRINT_LEASE_SEC,
+	) -> None:
+		self.max_attempts = max(1, max_attempts)
+		self.lease = lease
+		self.retry_base = retry_base
+		self.retry_max = retry_max
+		self.threads = max(1, threads)
+		self._queues: Dict[int, asyncio.Queue[int]] = {}
+		self._workers: Dict[int, asyncio.Task] = {}
+		self._executor: Optional[ThreadPoolExecutor] = None
+		self._sweeper: Optional[asyncio.Task] = None
+		self._submitted: Dict[int, float] = {}  # job id -> perf_counter() del submit
+		self._names: Dict[int, str] = {}  # printer id -> nome, per le label delle metriche
+
+	async def start(self) -> None:
+		self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="print")
+		# Riprende i job rimasti in coda da un riavvio precedente (e quelli interrotti a meta' invio,
+		# col lease scaduto), nell'ordine originale.
+		await self.requeue_expired()
+		async with SessionLocal() as db:
+			res = await db.execute(
+				select(PrintJob.id, PrintJob.printer_id).where(PrintJob.status == "QUEUED").order_by(PrintJob.id)
+			)
+			pending = res.all()
+		for job_id, printer_id in pending:
+			self.submit(job_id, printer_id)
+		self._sweeper = asyncio.create_task(self._sweep_loop(), name="printer-sweeper")
+
+	async def stop(self) -> None:
+		workers = list(self._workers.values())
+		if self._sweeper is not None:
+			workers.append(self._sweeper)
+			self._sweeper = None
+		for t in workers:
+			t.cancel()
+		await asyncio.gather(*workers, return_exceptions=True)
+		self._workers.clear()
+		self._queues.clear()
+		self._submitted.clear()
+		registry.close_all()
+		if self._executor is not None:
+			self._executor.shutdown(wait=False, cancel_futures=True)
+			self._executor = None
+
+	def submit(self, job_id: int, printer_id: int) -> None:
+		q = self._queues.get(printer_id)
+		if q is None:
+			q = self._queues[printer_id] = asyncio.Queue()
+			self._workers[printer_id] = asyncio.create_task(self._worker(q), name=f"print-worker-{printer_id}")
+		self._submitted[job_id] = time.perf_counter()
+		q.put_nowait(job_id)
+
+	def queue_depth(self, printer_id: int) -> int:
+		q = self._queues.get(printer_id)
+		return q.qsize() if q is not None else 0
+
+	def queue_depths(self) -> Dict[str, int]:
+		return {self._names.get(pid, str(pid)): q.qsize() for pid, q in self._queues.items()}
+
+	async def requeue_expired(self) -> List[Tuple[int, int]]:
+		"""Rimette in QUEUED i job in SENDING col lease scaduto; ritorna (job id, printer id)."""
+		cutoff = datetime.utcnow() - timedelta(seconds=self.lease)
+		async with SessionLocal() as db:
+			res = await db.execute(
+				update(PrintJob)
+				.where(PrintJob.status == "SENDING", or_(PrintJob.claimed_at.is_(None), PrintJob.claimed_at < cutoff))
+				.values(status="QUEUED", claimed_at=None)
+				.returning(PrintJob.id, PrintJob.printer_id)
+			)
+			rows = sorted(tuple(r) for r in res.all())
+			await db.commit()
+		if rows:
+			log.warning("requeued %d print jobs left in SENDING: %s", len(rows), [job_id for job_id, _ in rows])
+		return rows
+
+	def _backoff(self, attempt: int) -> float:
+		return min(self.retry_max, self.retry_base * (2 ** (attempt - 1)))
+
+	async def _active_printers(self) -> List[Any]:
+		async with SessionLocal() as db:
+			res = await db.execute(
+				select(Printer.id, Printer.name, Printer.kind, Printer.connection).where(Printer.is_active == True)
+			)
+			rows = res.all()
+		for pid, name, _kind, _conn in rows:
+			self._names[pid] = name
+		return rows
+
+	async def sync_printers(self) -> None:
+		"""Allinea gli adapter alla tabella printers (righe cancellate, disattivate o modificate)."""
+		rows = await self._active_printers()
+		active = {pid: (kind, conn) for pid, _name, kind, conn in rows}
+		await asyncio.get_running_loop().run_in_executor(self._executor, registry.sync, active)
+
+	async def check_printers(self) -> List[Dict[str, Any]]:
+		"""Health check delle stampanti attive (apre la connessione se serve), per l'admin."""
+		rows = await self._active_printers()
+		loop = asyncio.get_running_loop()
+		results = await loop.run_in_executor(
+			self._executor, registry.health, [(pid, kind, conn) for pid, _name, kind, conn in rows]
+		)
+		return [
+			{
+				"id": pid, "name": name, "kind": kind, "connection": conn,
+				"ok": results[pid].ok, "error": results[pid].error, "queue_depth": self.queue_depth(pid),
+			}
+			for pid, name, kind, conn in rows
+		]
+
+	def printers_up(self) -> Dict[str, int]:
+		return {self._names.get(pid, str(pid)): int(r.ok) for pid, r in registry.status().items() if r is not None}
+
+	async def _sweep_loop(self) -> None:
+		# Chiude le connessioni inattive o cadute (la riconnessione avviene al job successivo) e gli
+		# adapter di stampanti cancellate o modificate sul DB; riprende i job col lease scaduto.
+		loop = asyncio.get_running_loop()
+		while True:
+			await asyncio.sleep(30)
+			try:
+				await self.sync_printers()
+			except Exception:
+				log.exception("printer sync failed")
+			try:
+				for job_id, printer_id in await self.requeue_expired():
+					self.submit(job_id, printer_id)
+			except Exception:
+				log.exception("print job requeue failed")
+			await loop.run_in_executor(self._executor, registry.sweep)
+
+	async def _worker(self, q: asyncio.Queue[int]) -> None:
+		while True:
+			job_id = await q.get()
+			try:
+				await self._process(job_id)
+			except asyncio.CancelledError:
+				raise
+			except Exception:
+				log.exception("print job %s failed", job_id)
+			finally:
+				q.task_done()
+
+	async def _load(self, job_id: int) -> Optional[_Job]:
+		async with SessionLocal() as db:
+			row = await db.execute(
+				select(PrintJob, Printer.name, Printer.kind, Printer.connection, Order.public_id, Order.waiter_id, Table.number)
+				.join(Printer, Printer.id == PrintJob.printer_id)
+				.join(Order, Order.id == PrintJob.order_id)
+				.join(Table, Table.id == Order.table_id)
+				.where(PrintJob.id == job_id)
+			)
+			one = row.first()
+			if not one or one[0].status != "QUEUED":
+				return None
+			# Con piu' worker uvicorn/nodi ogni spooler riprende i QUEUED all'avvio: il passaggio
+			# atomico QUEUED -> SENDING fa si' che un job venga stampato da uno solo.
+			claimed = await db.execute(
+				update(PrintJob)
+				.where(PrintJob.id == job_id, PrintJob.status == "QUEUED")
+				.values(status="SENDING", claimed_at=datetime.utcnow())
+				.returning(PrintJob.id)
+			)
+			if claimed.first() is None:
+				return None
+			await db.commit()
+		job, printer_name, kind, connection, public_id, waiter_id, table_number = one
+		self._names[job.printer_id] = printer_name
+		return _Job(
+			id=job.id, printer_id=job.printer_id, printer_name=printer_name, order_id=job.order_id, public_id=public_id,
+			waiter_id=waiter_id, table_number=table_number, kind=kind, connection=connection,
+			payload=job.payload_bin or job.payload_text,
+		)
+
+	async def _send(self, job: _Job) -> PrintResult:
+		adapter = registry.get(job.printer_id, job.kind, job.connection)
+		loop = asyncio.get_running_loop()
+		t0 = time.perf_counter()
+		try:
+			result = await loop.run_in_executor(
+				self._executor, lambda: adapter.send(title=f"Comanda #{job.public_id}", text=job.payload)
+			)
+		except Exception as e:
+			result = PrintResult(ok=False, error=str(e))
+		adapter.last = result
+		print_send.labels(job.printer_name).observe(time.perf_counter() - t0)
+		if not result.ok:
+			print_errors.labels(job.printer_name).inc()
+		return result
+
+	async def _process(self, job_id: int) -> None:
+		submitted = self._submitted.pop(job_id, None)
+		job = await self._load(job_id)
+		if job is None:
+			return
+
+		attempt = 0
+		while True:
+			attempt += 1
+			result = await self._send(job)
+			if result.ok or not result.retry or attempt >= self.max_attempts:
+				break
+			async with SessionLocal() as db:
+				await db.execute(
+					update(PrintJob)
+					.where(PrintJob.id == job.id)
+					.values(attempts=attempt, error=result.error, claimed_at=datetime.utcnow())
+				)
+				await db.commit()
+			await asyncio.sleep(self._backoff(attempt))
+
+		status = "SENT" if result.ok else "ERROR"
+		order = None
+		async with SessionLocal() as db:
+			values = {"status": status, "attempts": attempt, "error": result.error}
+			version = None
+			if result.ok:
+				values["sent_at"] = datetime.utcnow()
+				# PRINTED e' un cambio di stato come gli altri: nuova versione, cosi' i client
+				# che applicano i delta (version == locale + 1) non restano indietro.
+				version = (
+					await db.execute(
+						update(Order)
+						.where(Order.id == job.order_id, Order.status != OrderStatus.CLOSED)
+						.values(status=OrderStatus.PRINTED, version=Order.version + 1)
+						.returning(Order.version)
+					)
+				).scalar_one_or_none()
+				if version is not None and live_orders.get(job.order_id) is None:
+					# fuori proiezione: si carica nella stessa transazione, dopo il commit niente query
+					order = await load_order_out(db, job.order_id)
+			await db.execute(update(PrintJob).where(PrintJob.id == job.id).values(**values))
+			await db.commit()
+		if version is not None:
+			out = live_orders.set_status(job.order_id, OrderStatus.PRINTED, version)
+			if out is None and order is not None:
+				live_orders.apply(order)
+				out = order
+			order = out
+		print_jobs.labels(job.printer_name, status).inc()
+		if submitted is not None:
+			print_latency.labels(job.printer_name).observe(time.perf_counter() - submitted)
+
+		if order is not None:
+			await bus.publish(PRINT_CHANNELS, {"type": "order_updated", "order": order.model_dump(mode="json")})
+		await bus.publish(
+			PRINT_CHANNELS,
+			{
+				"type": "print_job",
+				"order_id": job.order_id,
+				"public_id": job.public_id,
+				"waiter_id": job.waiter_id,
+				"table_number": job.table_number,
+				"job_id": job.id,
+				"status": status,
+				"attempts": attempt,
+				"ok": result.ok,
+				"error": result.error,
+			},
+		)
+
+
+spooler = PrintSpooler()
+
+printer_up = Gauge(
+	"cassa_printer_up", "1 if the last send or health check of the printer succeeded.", ["printer"], fn=spooler.printers_up
+)
+print_queue = Gauge("cassa_print_queue_depth", "Jobs waiting in the spooler queue per printer.", ["printer"], fn=spooler.queue_depths)
@@ -0,0 +1,104 @@
+"""Modalita' SQLite (edge: un locale, un mini-PC): WAL, pragma e scritture serializzate.
+
+Il driver lavora in autocommit e la transazione SQL parte solo alla prima scrittura, con
+`BEGIN IMMEDIATE`: le letture non aprono transazioni (come READ COMMITTED su Postgres: ogni SELECT
+vede l'ultimo commit) e non tengono snapshot aperti, e una transazione non deve mai "promuovere"
+un lock di lettura a scrittura, che in WAL fallisce subito con `database is locked`.
+Nel processo le transazioni di scrittura si mettono in fila su un lock asyncio (FIFO, senza il
+polling del busy handler); tra processi diversi aspetta `busy_timeout`.
+"""
+from __future__ import annotations
+
+import asyncio
+import re
+import weakref
+from typing import Any, Dict
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.util import await_only
+
+from .config import settings
+
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+_WRITE = re.compile(r"\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b", re.IGNORECASE)
+
+# un lock per event loop (test e script possono usarne piu' d'uno nello stesso processo)
+_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = weakref.WeakKeyDictionary()
+
+
+def _write_lock() -> asyncio.Lock:
+	loop = asyncio.get_running_loop()
+	lock = _locks.get(loop)
+	if lock is None:
+		lock = _locks[loop] = asyncio.Lock()
+	return lock
+
+
+async def _acquire(lock: asyncio.Lock) -> None:
+	try:
+		await asyncio.wait_for(lock.acquire(), timeout=settings.SQLITE_BUSY_TIMEOUT_MS / 1000)
+	except asyncio.TimeoutError:
+		raise RuntimeError(f"sqlite write lock not acquired within {settings.SQLITE_BUSY_TIMEOUT_MS} ms") from None
+
+
+def _release(info: Dict[str, Any]) -> None:
+	info.pop("sqlite_pending", None)
+	lock = info.pop("sqlite_lock", None)
+	if lock is not None and lock.locked():
+		lock.release()
+
+
+def pragmas() -> list[str]:
+	return [
+		"PRAGMA journal_mode=WAL",
+		f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}",
+		f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}",
+		"PRAGMA foreign_keys=ON",
+		f"PRAGMA cache_size=-{int(settings.SQLITE_CACHE_MB) * 1024}",
+		"PRAGMA temp_store=MEMORY",
+		f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_MB) * 1024 * 1024}",
+	]
+
+
+def configure(engine: Engine) -> None:
+	if settings.SQLITE_SYNCHRONOUS not in SYNCHRONOUS_MODES:
+		raise ValueError(f"SQLITE_SYNCHRONOUS must be one of {', '.join(SYNCHRONOUS_MODES)}, got {settings.SQLITE_SYNCHRONOUS!r}")
+
+	@event.listens_for(engine, "connect")
+	def _on_connect(dbapi_connection, record) -> None:
+		dbapi_connection.isolation_level = None  # autocommit: il BEGIN lo decidiamo noi
+		cur = dbapi_connection.cursor()
+		for p in pragmas():
+			cur.execute(p)
+		cur.close()
+
+	@event.listens_for(engine, "begin")
+	def _on_begin(conn) -> None:
+		conn.info["sqlite_pending"] = True
+
+	@event.listens_for(engine, "before_cursor_execute")
+	def _before(conn, cursor, statement, parameters, context, executemany) -> None:
+		info = conn.info
+		if info.get("sqlite_pending") and _WRITE.match(statement):
+			del info["sqlite_pending"]
+			lock = _write_lock()
+			await_only(_acquire(lock))
+			info["sqlite_lock"] = lock
+			try:
+				cursor.execute("BEGIN IMMEDIATE")
+			except Exception:
+				_release(info)
+				raise
+
+	@event.listens_for(engine, "commit")
+	def _on_commit(conn) -> None:
+		_release(conn.info)
+
+	@event.listens_for(engine, "rollback")
+	def _on_rollback(conn) -> None:
+		_release(conn.info)
+
+	@event.listens_for(engine, "reset")
+	def _on_reset(dbapi_connection, record, reset_state) -> None:
+		_release(record.info)  # connessione restituita al pool senza commit/rollback espliciti
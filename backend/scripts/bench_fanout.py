@@ -0,0 +1,148 @@
+"""Benchmark del fan-out WS: CPU per evento con N client connessi.
+
+Confronta il percorso storico (json.dumps per canale + await send_text socket per socket)
+con `ConnectionManager` (Event serializzato una volta, socket deduplicati, code per connessione),
+e con i tablet dei camerieri sottoscritti solo ai propri ordini (`/ws?waiter=me`): frame e byte
+ricevuti da ogni tablet cameriere.
+La CPU per evento include il lavoro dei writer task; "di cui broadcast_many()" e' la parte che
+resta sul percorso della richiesta. La variante a raffiche pubblica piu' eventi per giro del loop
+(piu' richieste servite prima che i writer girino): ogni writer svuota la raffica con un solo
+risveglio. Con --repeat si tiene il giro migliore, per ridurre il rumore della macchina.
+
+Uso (dalla cartella backend):
+    python scripts/bench_fanout.py --clients 120 --events 500
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import events  # noqa: E402
+from app.realtime import ConnectionManager  # noqa: E402
+
+CHANNELS = ["bar", "admin", "cassa", "waiter"]
+
+
+class FakeWS:
+	def __init__(self) -> None:
+		self.frames = 0
+		self.bytes = 0
+
+	async def accept(self) -> None:
+		pass
+
+	async def send_text(self, data: str) -> None:
+		# come il server ASGI: ogni frame di testo viene ricodificato in UTF-8
+		self.bytes += len(data.encode("utf-8"))
+		self.frames += 1
+
+	async def close(self, code: int = 1000) -> None:
+		pass
+
+
+WAITERS = 10  # camerieri in servizio: gli ordini sono distribuiti tra loro
+
+
+def sample_event(i: int) -> dict:
+	order = {
+		"id": i, "public_id": f"{i:05d}", "table_id": 7, "table_number": 7, "waiter_id": 1 + i % WAITERS, "waiter_name": "Emma",
+		"covers": 4, "apericena": 2, "note": "Compleanno", "status": "OPEN", "version": 1,
+		"created_at": datetime.utcnow().isoformat(), "ready_at": None,
+		"items": [
+			{"id": i * 20 + n, "line_no": n + 1, "menu_item_id": n, "name": f"Spritz {n}", "note": None, "qty": 1, "is_done": False}
+			for n in range(20)
+		],
+	}
+	return {"type": "order_created", "order": order}
+
+
+async def legacy(sockets: dict, n_events: int) -> None:
+	# copia del vecchio ConnectionManager.broadcast_many
+	for i in range(n_events):
+		ev = sample_event(i)
+		for ch in CHANNELS:
+			data = json.dumps(ev, ensure_ascii=False)
+			for ws in sockets[ch]:
+				await ws.send_text(data)
+
+
+async def current(sockets: dict, n_events: int, encode_once: bool = True, per_waiter: bool = False, burst: int = 1) -> ConnectionManager:
+	m = ConnectionManager(queue_size=n_events + 1)
+	for ch in CHANNELS:
+		for k, ws in enumerate(sockets[ch]):
+			filters = {"waiter_id": {1 + k % WAITERS}} if per_waiter and ch == "waiter" else None
+			await m.connect(ws, ch, filters)
+	expected = n_events * len(m._clients)
+	if per_waiter:
+		expected -= n_events * len(sockets["waiter"]) * (WAITERS - 1) // WAITERS
+	for i in range(n_events):
+		c0 = time.process_time()
+		if encode_once:
+			await m.broadcast_many(CHANNELS, sample_event(i))
+		else:
+			payload = sample_event(i)
+			for ch in CHANNELS:  # un Event (e quindi un encode) per canale, come prima
+				await m.broadcast_many([ch], events.Event(payload))
+		m.bench_broadcast_cpu = getattr(m, "bench_broadcast_cpu", 0.0) + time.process_time() - c0
+		if (i + 1) % burst == 0:
+			await asyncio.sleep(0)  # lascia lavorare i writer come farebbe l'event loop tra due richieste
+	while m.sent < expected:  # include il lavoro dei writer task
+		await asyncio.sleep(0)
+	return m
+
+
+def make_sockets(n_clients: int) -> dict:
+	per = max(1, n_clients // len(CHANNELS))
+	return {ch: [FakeWS() for _ in range(per)] for ch in CHANNELS}
+
+
+async def main() -> None:
+	ap = argparse.ArgumentParser()
+	ap.add_argument("--clients", type=int, default=120)
+	ap.add_argument("--events", type=int, default=500)
+	ap.add_argument("--burst", type=int, default=5, help="eventi per giro del loop nella variante a raffiche")
+	ap.add_argument("--repeat", type=int, default=1, help="giri per variante, si tiene il migliore")
+	ap.add_argument("--stdlib-json", action="store_true", help="ignora orjson anche se installato")
+	args = ap.parse_args()
+	if args.stdlib_json:
+		events.orjson = None
+
+	print(f"clients={args.clients} events={args.events} encoder={'orjson' if events.orjson else 'json'}")
+	variants = (
+		("legacy (dumps per canale, send seriale)", legacy),
+		("code per connessione, encode per canale", lambda s, n: current(s, n, encode_once=False)),
+		("code per connessione, encode-once", current),
+		("encode-once, camerieri con filtro waiter", lambda s, n: current(s, n, per_waiter=True)),
+		(f"encode-once, raffiche da {args.burst} eventi", lambda s, n: current(s, n, burst=args.burst)),
+	)
+	for name, fn in variants:
+		best = None
+		for _ in range(max(1, args.repeat)):
+			sockets = make_sockets(args.clients)
+			t0, c0 = time.perf_counter(), time.process_time()
+			m = await fn(sockets, args.events)
+			wall, cpu = time.perf_counter() - t0, time.process_time() - c0
+			if best is None or cpu < best[1]:
+				best = (wall, cpu, sockets, m)
+		wall, cpu, sockets, m = best
+		frames = sum(ws.frames for lst in sockets.values() for ws in lst)
+		waiter = sockets["waiter"]
+		per_tablet = sum(ws.bytes for ws in waiter) / len(waiter)
+		print(
+			f"{name:42s} cpu/event={cpu / args.events * 1e6:8.1f} us  wall/event={wall / args.events * 1e6:8.1f} us  "
+			f"frames={frames}  per tablet cameriere={per_tablet / 1024:8.1f} KiB"
+		)
+		if m is not None:
+			# quanto resta sul percorso della richiesta (encode + accodamento), esclusi i writer
+			print(f"{'  di cui broadcast_many()':42s} cpu/event={m.bench_broadcast_cpu / args.events * 1e6:8.1f} us")
+
+
+if __name__ == "__main__":
+	asyncio.run(main())
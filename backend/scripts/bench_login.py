@@ -0,0 +1,93 @@
+"""Benchmark: lag dell'event loop durante un "cambio turno" (N login concorrenti).
+
+Un task misura di quanto ogni `asyncio.sleep(tick)` sfora la scadenza, mentre N verifiche Argon2
+girano inline sul loop (come prima) oppure nel pool di `security` (AUTH_HASH_THREADS).
+
+Uso (dalla cartella backend):
+    python scripts/bench_login.py --logins 15
+    AUTH_HASH_THREADS=4 ARGON2_MEMORY_KIB=32768 python scripts/bench_login.py
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import security  # noqa: E402
+from app.config import settings  # noqa: E402
+
+
+async def probe(stop: asyncio.Event, tick: float, lags: list) -> None:
+	loop = asyncio.get_running_loop()
+	while not stop.is_set():
+		t0 = loop.time()
+		await asyncio.sleep(tick)
+		lags.append(max(0.0, loop.time() - t0 - tick))
+
+
+async def login_inline(password: str, h: str) -> None:
+	await asyncio.sleep(0)  # il vecchio endpoint: query async, poi verify sul loop
+	assert security.verify_password(password, h)
+
+
+async def login_pool(password: str, h: str) -> None:
+	await asyncio.sleep(0)
+	ok, _ = await security.verify_password_async(password, h)
+	assert ok
+
+
+async def storm(fn, n: int, spread: float, h: str, tick: float) -> dict:
+	lags: list = []
+	stop = asyncio.Event()
+	probe_task = asyncio.create_task(probe(stop, tick, lags))
+	await asyncio.sleep(tick * 3)
+
+	async def one(i: int) -> float:
+		await asyncio.sleep(spread * i / n)
+		t0 = time.perf_counter()
+		await fn("1234", h)
+		return time.perf_counter() - t0
+
+	t0 = time.perf_counter()
+	latencies = await asyncio.gather(*(one(i) for i in range(n)))
+	wall = time.perf_counter() - t0
+	stop.set()
+	await probe_task
+	lags.sort()
+	return {
+		"wall": wall,
+		"login_p50": statistics.median(latencies),
+		"login_max": max(latencies),
+		"lag_p50": lags[len(lags) // 2],
+		"lag_p99": lags[min(len(lags) - 1, int(len(lags) * 0.99))],
+		"lag_max": lags[-1],
+	}
+
+
+async def main() -> None:
+	ap = argparse.ArgumentParser()
+	ap.add_argument("--logins", type=int, default=15)
+	ap.add_argument("--spread", type=float, default=1.0, help="secondi in cui arrivano i login")
+	ap.add_argument("--tick", type=float, default=0.005, help="periodo del probe di lag (s)")
+	args = ap.parse_args()
+
+	h = security.hash_password("1234")
+	print(
+		f"logins={args.logins} spread={args.spread}s argon2 t={settings.ARGON2_TIME_COST} "
+		f"m={settings.ARGON2_MEMORY_KIB}KiB p={settings.ARGON2_PARALLELISM} threads={settings.AUTH_HASH_THREADS}"
+	)
+	for name, fn in (("inline (prima)", login_inline), ("pool (dopo)", login_pool)):
+		r = await storm(fn, args.logins, args.spread, h, args.tick)
+		print(
+			f"{name:16s} wall={r['wall']:6.2f}s  login p50={r['login_p50'] * 1e3:7.1f}ms max={r['login_max'] * 1e3:7.1f}ms  "
+			f"loop lag p50={r['lag_p50'] * 1e3:6.1f}ms p99={r['lag_p99'] * 1e3:6.1f}ms max={r['lag_max'] * 1e3:6.1f}ms"
+		)
+
+
+if __name__ == "__main__":
+	asyncio.run(main())
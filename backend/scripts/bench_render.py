@@ -0,0 +1,58 @@
+"""Micro-benchmark: resa del ticket testo (`_format_print`) vs ESC/POS compilato (`escpos`).
+
+Uso (dalla cartella backend):
+    python scripts/bench_render.py --items 15 --n 20000
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import timeit
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import escpos  # noqa: E402
+from app.main import _format_print  # noqa: E402
+
+
+def fake_order(n_items: int, order_id: int = 1) -> SimpleNamespace:
+	items = [
+		SimpleNamespace(name=f"Gin Tonic {i}", qty=1 + i % 3, note="senza ghiaccio" if i % 4 == 0 else None, is_done=i % 2 == 0)
+		for i in range(n_items)
+	]
+	return SimpleNamespace(
+		id=order_id, version=1, public_id="12345", covers=4, apericena=2, note="Compleanno, tavolo vicino finestra", items=items
+	)
+
+
+def main() -> None:
+	ap = argparse.ArgumentParser()
+	ap.add_argument("--items", type=int, default=15)
+	ap.add_argument("--n", type=int, default=20000)
+	args = ap.parse_args()
+
+	order = fake_order(args.items)
+	ctx, items = escpos.order_context(order, 7, "Emma")
+	# cold = contesto + render; cached = lookup per (order id, version) come in print_order
+
+	cases = {
+		"text  _format_print": lambda: _format_print(order, 7, "Emma").encode("utf-8"),
+		"escpos render (cold)": lambda: escpos.COMANDA.render(*escpos.order_context(order, 7, "Emma")),
+		"escpos render (ctx ready)": lambda: escpos.COMANDA.render(ctx, items),
+		"escpos cached + finish": lambda: escpos.finish(escpos.cache.get(escpos.COMANDA, order.id, order.version)),
+		"escpos cached x3 copies": lambda: escpos.finish(escpos.cache.get(escpos.COMANDA, order.id, order.version), copies=3),
+	}
+	escpos.render_order(order, 7, "Emma")
+	print(f"items={args.items} n={args.n}")
+	base = None
+	for name, fn in cases.items():
+		t = min(timeit.repeat(fn, number=args.n, repeat=3)) / args.n * 1e6
+		base = base or t
+		print(f"{name:28s} {t:8.2f} us/op   x{base / t:5.2f}")
+	print(f"cache hits={escpos.cache.hits} misses={escpos.cache.misses}")
+
+
+if __name__ == "__main__":
+	main()
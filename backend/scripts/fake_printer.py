@@ -0,0 +1,60 @@
+"""Finta stampante RAW/JetDirect (porta 9100) per provare SocketPrinter senza hardware.
+
+Uso:
+    python scripts/fake_printer.py --port 9100
+    # poi crea una Printer con kind="socket" e connection="127.0.0.1:9100"
+
+Opzioni utili per provare reconnect e retry:
+    --drop-after N   chiude ogni connessione dopo N job ricevuti
+    --hexdump        mostra i byte ricevuti (utile per ESC/POS)
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+
+
+async def main() -> None:
+	ap = argparse.ArgumentParser()
+	ap.add_argument("--host", default="127.0.0.1")
+	ap.add_argument("--port", type=int, default=9100)
+	ap.add_argument("--drop-after", type=int, default=0)
+	ap.add_argument("--hexdump", action="store_true")
+	args = ap.parse_args()
+
+	stats = {"connections": 0, "jobs": 0, "bytes": 0}
+
+	async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+		stats["connections"] += 1
+		peer = writer.get_extra_info("peername")
+		print(f"[conn #{stats['connections']}] {peer}")
+		received = 0
+		try:
+			while True:
+				chunk = await reader.read(65536)
+				if not chunk:
+					break
+				received += 1
+				stats["jobs"] += 1
+				stats["bytes"] += len(chunk)
+				if args.hexdump:
+					print(chunk.hex(" "))
+				else:
+					print(chunk.decode("utf-8", errors="replace"))
+				print(f"[stats] {stats}")
+				if args.drop_after and received >= args.drop_after:
+					break
+		finally:
+			writer.close()
+
+	server = await asyncio.start_server(handle, args.host, args.port)
+	print(f"fake printer listening on {args.host}:{args.port}")
+	async with server:
+		await server.serve_forever()
+
+
+if __name__ == "__main__":
+	try:
+		asyncio.run(main())
+	except KeyboardInterrupt:
+		pass
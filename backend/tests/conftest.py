@@ -0,0 +1,90 @@
+"""Fixture comuni: un DB SQLite temporaneo, migrato e con i dati demo, e il TestClient dell'app.
+
+Le impostazioni sono lette all'import di app.config, quindi l'ambiente va preparato qui, prima di
+importare l'app. Il pool e' volutamente piccolo (see test_ws_rest.py); Argon2 leggero per
+velocita' (i parametri stanno nell'hash, la verifica resta corretta).
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+from typing import Dict, Iterator
+
+import pytest
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_TMP = tempfile.mkdtemp(prefix="cassa-test-")
+DB_PATH = os.path.join(_TMP, "test.db")
+
+os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///" + DB_PATH
+os.environ.setdefault("DB_POOL_SIZE", "3")
+os.environ.setdefault("DB_MAX_OVERFLOW", "2")
+os.environ.setdefault("DB_POOL_TIMEOUT_SEC", "5")
+os.environ.setdefault("ARGON2_TIME_COST", "1")
+os.environ.setdefault("ARGON2_MEMORY_KIB", "1024")
+os.environ.setdefault("ARGON2_PARALLELISM", "1")
+os.environ.setdefault("PRINT_RETRY_BASE_SEC", "0.05")
+
+sys.path.insert(0, BACKEND)
+os.chdir(BACKEND)  # StaticFiles usa path relativi
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app import migrate, seed  # noqa: E402
+from app.db import SessionLocal, engine  # noqa: E402
+
+
+def run(coro):
+	"""Esegue una coroutine su un loop nuovo e chiude il pool (le connessioni restano legate al loop)."""
+
+	async def _run():
+		try:
+			return await coro
+		finally:
+			await engine.dispose()
+
+	return asyncio.run(_run())
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database() -> Iterator[None]:
+	async def prepare() -> None:
+		await migrate.upgrade()
+		async with SessionLocal() as db:
+			await seed.seed_if_empty(db)
+
+	run(prepare())
+	yield
+
+
+@pytest.fixture
+def client() -> Iterator[TestClient]:
+	from app.main import app
+
+	with TestClient(app) as c:
+		yield c
+	asyncio.run(engine.dispose())
+
+
+@pytest.fixture
+def login(client: TestClient):
+	def _login(username: str = "admin", password: str = "admin") -> Dict[str, str]:
+		r = client.post("/api/auth/login", json={"username": username, "password": password})
+		assert r.status_code == 200, r.text
+		return {"Authorization": "Bearer " + r.json()["access_token"]}
+
+	return _login
+
+
+@pytest.fixture
+def sql():
+	"""SQL diretto sul DB di test (sqlite3 della stdlib), per preparare casi che l'API non crea."""
+
+	def _sql(statement: str, *params):
+		with sqlite3.connect(DB_PATH, timeout=10) as conn:
+			return conn.execute(statement, params).fetchall()
+
+	return _sql
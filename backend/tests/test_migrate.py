@@ -0,0 +1,23 @@
+"""Le migrazioni (schema congelato + modifiche successive) producono lo schema di models.py."""
+from __future__ import annotations
+
+from sqlalchemy import create_engine, inspect
+
+from app import migrate
+from app.db import Base
+
+from conftest import DB_PATH, run
+
+
+def test_migrated_schema_matches_models():
+	engine = create_engine("sqlite:///" + DB_PATH)
+	try:
+		insp = inspect(engine)
+		for table in Base.metadata.sorted_tables:
+			columns = {c["name"] for c in insp.get_columns(table.name)}
+			assert columns == set(table.columns.keys()), table.name
+			indexes = {i["name"] for i in insp.get_indexes(table.name)}
+			assert {i.name for i in table.indexes} == indexes, table.name
+	finally:
+		engine.dispose()
+	assert run(migrate.current_version()) == migrate.HEAD
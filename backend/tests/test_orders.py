@@ -0,0 +1,41 @@
+"""GET /api/orders: lista completa senza limit, paginazione a cursore con limit."""
+from __future__ import annotations
+
+
+def _create(client, headers, n: int, table: int = 1) -> list:
+	menu = client.get("/api/menu", headers=headers).json()
+	ids = []
+	for _ in range(n):
+		body = {"table_number": table, "covers": 2, "items": [{"menu_item_id": menu[0]["id"], "qty": 1}]}
+		r = client.post("/api/orders", json=body, headers=headers)
+		assert r.status_code == 200, r.text
+		ids.append(r.json()["id"])
+	return ids
+
+
+def _pages(client, headers, url: str) -> list:
+	out, cursor = [], None
+	while True:
+		r = client.get(url + (f"&cursor={cursor}" if cursor else ""), headers=headers)
+		assert r.status_code == 200, r.text
+		out += [o["id"] for o in r.json()]
+		cursor = r.headers.get("X-Next-Cursor")
+		if not cursor:
+			return out
+
+
+def test_list_without_limit_is_complete(client, login):
+	h = login("emma", "1234")
+	_create(client, h, 7)
+	r = client.get("/api/orders", headers=h)
+	assert r.status_code == 200
+	assert "X-Next-Cursor" not in r.headers
+	assert len(r.json()) == len(_pages(client, h, "/api/orders?limit=1000"))
+
+
+def test_cursor_pages_cover_the_full_list(client, login):
+	h = login("emma", "1234")
+	created = _create(client, h, 7, table=5)
+	full = [o["id"] for o in client.get("/api/orders?table_number=5", headers=h).json()]
+	assert set(created) <= set(full)
+	assert _pages(client, h, "/api/orders?table_number=5&limit=3") == full
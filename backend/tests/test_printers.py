@@ -0,0 +1,223 @@
+"""Adapter di stampa contro una finta stampante RAW (porta 9100) e una finta pycups."""
+from __future__ import annotations
+
+import socket
+import struct
+import threading
+import time
+from typing import List
+
+import pytest
+
+from app.printers import CupsPrinter, PrinterRegistry, SocketPrinter
+
+
+class FakePrinter:
+	"""Listener TCP locale: accumula i byte ricevuti per connessione.
+
+	close_after: chiude la connessione dopo aver ricevuto tanti byte (stampante che non tiene
+	la connessione aperta); reset_after: reset (RST) dopo tanti byte, a meta' di un invio.
+	"""
+
+	def __init__(self, close_after: int = 0, reset_after: int = 0) -> None:
+		self.close_after = close_after
+		self.reset_after = reset_after
+		self.received: List[bytearray] = []
+		self.closed = 0
+		self._srv = socket.create_server(("127.0.0.1", 0))
+		self.port = self._srv.getsockname()[1]
+		threading.Thread(target=self._serve, daemon=True).start()
+
+	@property
+	def address(self) -> str:
+		return f"127.0.0.1:{self.port}"
+
+	def _serve(self) -> None:
+		while True:
+			try:
+				conn, _ = self._srv.accept()
+			except OSError:
+				return
+			threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+	def _handle(self, conn: socket.socket) -> None:
+		buf = bytearray()
+		self.received.append(buf)
+		with conn:
+			while True:
+				chunk = conn.recv(65536)
+				if not chunk:
+					break
+				buf += chunk
+				if self.reset_after and len(buf) >= self.reset_after:
+					conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+					break
+				if self.close_after and len(buf) >= self.close_after:
+					break
+		self.closed += 1
+
+	def wait_bytes(self, n: int, timeout: float = 5.0) -> None:
+		deadline = time.monotonic() + timeout
+		while sum(len(b) for b in self.received) < n:
+			assert time.monotonic() < deadline, "fake printer did not receive the payload"
+			time.sleep(0.01)
+
+	def close(self) -> None:
+		self._srv.close()
+
+
+@pytest.fixture
+def fake_printer():
+	printers: List[FakePrinter] = []
+
+	def make(**kw) -> FakePrinter:
+		p = FakePrinter(**kw)
+		printers.append(p)
+		return p
+
+	yield make
+	for p in printers:
+		p.close()
+
+
+def test_socket_printer_keeps_one_connection(fake_printer):
+	fp = fake_printer()
+	p = SocketPrinter(fp.address, timeout=2)
+	assert p.send("1", b"first").ok
+	assert p.send("2", b"second").ok
+	fp.wait_bytes(len(b"firstsecond"))
+	assert p.connects == 1
+	assert [bytes(b) for b in fp.received] == [b"firstsecond"]
+	p.close()
+
+
+def test_socket_printer_reconnects_after_printer_closed(fake_printer):
+	fp = fake_printer(close_after=3)
+	p = SocketPrinter(fp.address, timeout=2)
+	assert p.send("1", b"one").ok
+	deadline = time.monotonic() + 5
+	while fp.closed < 1:
+		assert time.monotonic() < deadline
+		time.sleep(0.01)
+	assert p.send("2", b"two").ok
+	fp.wait_bytes(6)
+	assert p.connects == 2
+	assert [bytes(b) for b in fp.received] == [b"one", b"two"]  # ognuno una volta sola
+	p.close()
+
+
+def test_socket_printer_does_not_resend_after_partial_write(fake_printer):
+	fp = fake_printer(reset_after=1000)
+	p = SocketPrinter(fp.address, timeout=5)
+	payload = b"x" * (64 * 1024 * 1024)  # piu' dei buffer del kernel: l'invio si interrompe a meta'
+	res = p.send("big", payload)
+	assert not res.ok
+	assert res.retry is False
+	assert p.connects == 1
+	assert len(fp.received) == 1
+
+
+def _closed_port() -> int:
+	"""Porta libera e chiusa: socket legato ma mai in ascolto, poi chiuso (connessione rifiutata)."""
+	with socket.socket() as s:
+		s.bind(("127.0.0.1", 0))
+		return s.getsockname()[1]
+
+
+def test_socket_printer_retries_when_nothing_was_sent():
+	p = SocketPrinter(f"127.0.0.1:{_closed_port()}", timeout=1)
+	res = p.send("1", b"ticket")
+	assert not res.ok
+	assert res.retry is True
+
+
+class FakeCups:
+	"""Sostituto di pycups: registra le chiamate e fallisce dove richiesto."""
+
+	CUPS_FORMAT_RAW = "application/vnd.cups-raw"
+	CUPS_FORMAT_TEXT = "text/plain"
+
+	def __init__(self, fail: dict) -> None:
+		self.fail = dict(fail)  # nome metodo -> quante volte fallire
+		self.created: List[int] = []
+		self.cancelled: List[int] = []
+		self.finished: List[int] = []
+		self.connections = 0
+		outer = self
+
+		class Connection:
+			def __init__(self) -> None:
+				outer.connections += 1
+				self.job = None
+
+			def _maybe_fail(self, name: str) -> None:
+				if outer.fail.get(name, 0) > 0:
+					outer.fail[name] -= 1
+					raise RuntimeError(f"{name} failed")
+
+			def createJob(self, printer, title, options):
+				self._maybe_fail("createJob")
+				self.job = len(outer.created) + 1
+				outer.created.append(self.job)
+				return self.job
+
+			def startDocument(self, printer, job_id, title, fmt, last):
+				self._maybe_fail("startDocument")
+
+			def writeRequestData(self, data, length):
+				self._maybe_fail("writeRequestData")
+
+			def finishDocument(self, printer):
+				self._maybe_fail("finishDocument")
+				outer.finished.append(self.job)
+
+			def cancelJob(self, job_id):
+				self._maybe_fail("cancelJob")
+				outer.cancelled.append(job_id)
+
+		self.Connection = Connection
+
+
+def _cups_printer(fail: dict):
+	p = CupsPrinter("BAR")
+	p._cups = FakeCups(fail)
+	return p, p._cups
+
+
+def test_cups_retries_connection_errors():
+	p, cups = _cups_printer({"createJob": 1})
+	assert p.send("t", b"ticket").ok
+	assert cups.finished == [1] and cups.cancelled == []
+	assert cups.connections == 2
+
+
+def test_cups_cancels_partial_job_before_retrying():
+	p, cups = _cups_printer({"writeRequestData": 1})
+	assert p.send("t", b"ticket").ok
+	assert cups.cancelled == [1]
+	assert cups.finished == [2]  # un solo job completato
+
+
+def test_cups_does_not_retry_after_finish_document():
+	p, cups = _cups_printer({"finishDocument": 1})
+	res = p.send("t", b"ticket")
+	assert not res.ok and res.retry is False
+	assert cups.created == [1] and cups.cancelled == [1]
+
+
+def test_cups_unknown_job_state_is_not_retried():
+	p, cups = _cups_printer({"writeRequestData": 1, "cancelJob": 1})
+	res = p.send("t", b"ticket")
+	assert not res.ok and res.retry is False
+	assert cups.created == [1]
+
+
+def test_registry_sync_discards_stale_adapters():
+	reg = PrinterRegistry()
+	a = reg.get(1, "dummy", "BAR")
+	b = reg.get(2, "dummy", "CASSA")
+	reg.get(3, "dummy", "OLD")
+	reg.sync({1: ("dummy", "BAR"), 2: ("dummy", "CASSA2")})  # 2 modificata, 3 cancellata
+	assert reg.get(1, "dummy", "BAR") is a
+	assert set(reg.status()) == {1}
+	assert reg.get(2, "dummy", "CASSA2") is not b
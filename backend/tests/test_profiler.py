@@ -0,0 +1,38 @@
+"""Profiler SQL sopra gli hook di metrics: header della risposta e avviso N+1."""
+from __future__ import annotations
+
+import asyncio
+import logging
+
+from sqlalchemy import text
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from app import metrics, profiler
+from app.db import engine
+
+
+async def _n_plus_one(request):
+	async with engine.connect() as conn:
+		for user_id in range(7):
+			await conn.execute(text("SELECT id FROM users WHERE id = :id"), {"id": user_id})
+	return PlainTextResponse("ok")
+
+
+def test_profiler_uses_request_db_usage(monkeypatch, caplog):
+	monkeypatch.setattr(metrics, "_statement_hooks", [])
+	profiler.enable()
+	profiler.enable()  # idempotente: un solo hook
+	assert metrics._statement_hooks == [profiler._observe]
+
+	app = metrics.MetricsMiddleware(profiler.SqlProfilerMiddleware(Starlette(routes=[Route("/n1", _n_plus_one)])))
+	with caplog.at_level(logging.WARNING, logger="cassa.sql"), TestClient(app) as c:
+		r = c.get("/n1")
+	asyncio.run(engine.dispose())
+
+	assert r.status_code == 200
+	assert r.headers["x-db-queries"] == "7"
+	assert 'desc="7 queries"' in r.headers["server-timing"]
+	assert "possible N+1" in caplog.text and "same statement ran 7 times" in caplog.text
@@ -0,0 +1,61 @@
+"""Proiezione degli ordini live: stesso insieme dalla memoria e dal DB, uscita a fine giornata."""
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+
+from app.models import OrderStatus
+from app.projection import LiveOrders, service_day_start
+from app.schemas import OrderOut
+
+from test_orders import _create, _pages
+
+
+def _ids(client, headers, url: str) -> list:
+	r = client.get(url, headers=headers)
+	assert r.status_code == 200, r.text
+	return [o["id"] for o in r.json()]
+
+
+def test_live_pages_are_one_list(client, login, sql):
+	h = login("emma", "1234")
+	ids = _create(client, h, 6, table=8)
+	closed, yesterday = ids[1], ids[3]
+	sql("UPDATE orders SET status = 'CLOSED' WHERE id = ?", closed)
+	sql("UPDATE orders SET created_at = strftime('%Y-%m-%d %H:%M:%f', created_at, '-2 days') WHERE id = ?", yesterday)
+	assert client.post("/api/admin/live-orders/rebuild", headers=login()).status_code == 200
+
+	live = _ids(client, h, "/api/orders?live=1&table_number=8")
+	assert closed not in live and yesterday not in live
+	assert set(ids) - {closed, yesterday} <= set(live)
+	# prima pagina dalla proiezione, le altre dal DB: nessun buco e nessun ordine in piu'
+	assert _pages(client, h, "/api/orders?live=1&table_number=8&limit=2") == live
+	# senza live la lista viene dal DB e comprende tutto
+	full = _ids(client, h, "/api/orders?table_number=8")
+	assert {closed, yesterday} <= set(full)
+	assert _pages(client, h, "/api/orders?table_number=8&limit=2") == full
+
+
+def _order(order_id: int, created_at: datetime, status: OrderStatus = OrderStatus.OPEN) -> OrderOut:
+	return OrderOut.model_validate({
+		"id": order_id, "public_id": f"P{order_id}", "table_id": 1, "table_number": 1, "waiter_id": 1,
+		"waiter_name": "Emma", "covers": 2, "apericena": 0, "note": None, "status": status, "version": 1,
+		"created_at": created_at, "ready_at": None, "items": [],
+	})
+
+
+def test_projection_evicts_closed_and_previous_days():
+	lo = LiveOrders()
+	start = lo.day_start
+	lo.apply(_order(1, start + timedelta(hours=1)))
+	lo.apply(_order(2, start + timedelta(hours=2)))
+	lo.apply(_order(3, start - timedelta(hours=1)))  # giornata precedente: non entra
+	assert len(lo) == 2
+
+	lo.apply(_order(2, start + timedelta(hours=2), OrderStatus.CLOSED).model_copy(update={"version": 2}))
+	assert len(lo) == 1 and lo.get_by_public_id("P2") is None
+
+	assert lo.roll(start + timedelta(hours=23)) == 0  # stessa giornata
+	assert lo.roll(start + timedelta(days=1, hours=1)) == 1
+	assert len(lo) == 0 and lo.get_by_public_id("P1") is None
+	assert lo.day_start == service_day_start(start + timedelta(days=1, hours=1)) > start
+	assert lo.list_json()[0] == b"[]"
@@ -0,0 +1,35 @@
+"""Cache dei principal: un'invalidazione durante la lettura dal DB non lascia in cache l'utente vecchio."""
+from __future__ import annotations
+
+from app import security
+from app.db import SessionLocal
+from app.security import create_access_token, invalidate_principal, principals, user_from_token
+
+from conftest import run
+
+
+class _UpdatedDuringRead:
+	"""Sessione che, chiusa la lettura e prima di put(), lascia passare un update_user concorrente."""
+
+	def __init__(self) -> None:
+		self._db = SessionLocal()
+
+	async def __aenter__(self):
+		return await self._db.__aenter__()
+
+	async def __aexit__(self, *exc) -> None:
+		await self._db.__aexit__(*exc)
+		await invalidate_principal("emma")
+
+
+def test_invalidation_during_load_is_not_overwritten(monkeypatch):
+	principals.invalidate()
+	token = create_access_token("emma")
+	monkeypatch.setattr(security, "SessionLocal", _UpdatedDuringRead)
+	user = run(user_from_token(token))
+	assert user is not None and user.username == "emma"  # la richiesta in corso passa
+	assert principals.get("emma") is None  # ma il valore letto prima dell'invalidazione non resta
+
+	monkeypatch.setattr(security, "SessionLocal", SessionLocal)
+	run(user_from_token(token))
+	assert principals.get("emma") is not None  # senza invalidazioni in mezzo si mette in cache
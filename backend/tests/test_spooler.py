@@ -0,0 +1,142 @@
+"""Spooler: un job interrotto a meta' invio (processo morto) viene ripreso quando scade il lease."""
+from __future__ import annotations
+
+import asyncio
+import threading
+from typing import List
+
+from sqlalchemy import select
+
+from app.bus import bus
+from app.db import SessionLocal
+from app.models import Order, Printer, PrintJob, Table, User
+from app.printers import PrinterAdapter, PrintResult, registry
+from app.spooler import PrintSpooler
+
+from conftest import run
+
+
+class HangingPrinter(PrinterAdapter):
+	"""Il primo invio resta appeso finche' il test non lo sblocca; gli altri riescono subito."""
+
+	def __init__(self) -> None:
+		super().__init__("test")
+		self.started = threading.Event()
+		self.release = threading.Event()
+		self.sent: List[str] = []
+
+	def send(self, title: str, text) -> PrintResult:
+		if not self.started.is_set():
+			self.started.set()
+			self.release.wait(10)
+			return PrintResult(ok=False, error="interrupted")
+		self.sent.append(title)
+		return PrintResult(ok=True)
+
+
+async def _new_job(public_id: str) -> tuple:
+	async with SessionLocal() as db:
+		printer = (await db.execute(select(Printer).where(Printer.name == "BAR_PRINTER"))).scalar_one()
+		table = (await db.execute(select(Table).where(Table.number == 12))).scalar_one()
+		waiter = (await db.execute(select(User).where(User.username == "emma"))).scalar_one()
+		order = Order(public_id=public_id, table_id=table.id, waiter_id=waiter.id)
+		db.add(order)
+		await db.flush()
+		job = PrintJob(order_id=order.id, printer_id=printer.id, payload_text="ticket")
+		db.add(job)
+		await db.commit()
+		return job.id, printer.id, printer.kind, printer.connection
+
+
+async def _status(job_id: int) -> str:
+	async with SessionLocal() as db:
+		return (await db.execute(select(PrintJob.status).where(PrintJob.id == job_id))).scalar_one()
+
+
+async def _wait_status(job_id: int, status: str, timeout: float = 5.0) -> None:
+	for _ in range(int(timeout / 0.02)):
+		if await _status(job_id) == status:
+			return
+		await asyncio.sleep(0.02)
+	raise AssertionError(f"job {job_id} is {await _status(job_id)}, expected {status}")
+
+
+def test_job_interrupted_mid_send_is_picked_up_again():
+	printer = HangingPrinter()
+
+	async def scenario() -> None:
+		job_id, printer_id, kind, connection = await _new_job("LEASE1")
+		registry._adapters[printer_id] = (kind, connection, printer)
+
+		crashed = PrintSpooler(lease=0.5)
+		await crashed.start()
+		await asyncio.get_running_loop().run_in_executor(None, printer.started.wait, 5)
+		assert await _status(job_id) == "SENDING"
+		# "crash": i task muoiono senza aggiornare il job, che resta in SENDING
+		for task in crashed._workers.values():
+			task.cancel()
+		await asyncio.gather(*crashed._workers.values(), return_exceptions=True)
+		printer.release.set()
+		crashed._executor.shutdown(wait=True)
+
+		survivor = PrintSpooler(lease=0.5)
+		await survivor.start()  # lease ancora valido: il job non si tocca
+		assert await _status(job_id) == "SENDING"
+		await asyncio.sleep(0.6)
+		for jid, pid in await survivor.requeue_expired():  # come lo sweep periodico
+			survivor.submit(jid, pid)
+		await _wait_status(job_id, "SENT")
+		assert printer.sent == ["Comanda #LEASE1"]
+		await survivor.stop()
+
+	run(scenario())
+
+
+def test_stale_sending_job_is_resumed_at_startup(sql):
+	printer = HangingPrinter()
+	printer.started.set()  # nessun invio appeso: questo adapter stampa e basta
+
+	async def scenario() -> None:
+		job_id, printer_id, kind, connection = await _new_job("LEASE2")
+		# lasciato in SENDING da un processo morto un'ora fa
+		sql("UPDATE print_jobs SET status = 'SENDING', claimed_at = datetime('now', '-1 hour') WHERE id = ?", job_id)
+		registry._adapters[printer_id] = (kind, connection, printer)
+		spooler = PrintSpooler(lease=60)
+		await spooler.start()
+		await _wait_status(job_id, "SENT")
+		assert printer.sent == ["Comanda #LEASE2"]
+		await spooler.stop()
+
+	run(scenario())
+
+
+def test_printed_bumps_order_version_and_emits_order_updated(monkeypatch):
+	printer = HangingPrinter()
+	printer.started.set()
+	published: List[dict] = []
+
+	async def publish(channels, payload):
+		published.append(payload)
+
+	monkeypatch.setattr(bus, "publish", publish)
+
+	async def scenario() -> None:
+		job_id, printer_id, kind, connection = await _new_job("PRINTED1")
+		registry._adapters[printer_id] = (kind, connection, printer)
+		async with SessionLocal() as db:
+			order_id, before = (await db.execute(select(Order.id, Order.version).where(Order.public_id == "PRINTED1"))).one()
+		spooler = PrintSpooler(lease=60)
+		await spooler.start()
+		spooler.submit(job_id, printer_id)
+		await _wait_status(job_id, "SENT")
+		await spooler.stop()
+		async with SessionLocal() as db:
+			status, version = (await db.execute(select(Order.status, Order.version).where(Order.id == order_id))).one()
+		assert status == "PRINTED" and version == before + 1
+		updated = [p for p in published if p["type"] == "order_updated"]
+		assert [(p["order"]["id"], p["order"]["status"], p["order"]["version"]) for p in updated] == [
+			(order_id, "PRINTED", version)
+		]
+		assert [p["type"] for p in published] == ["order_updated", "print_job"]
+
+	run(scenario())
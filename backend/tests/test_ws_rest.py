@@ -0,0 +1,66 @@
+"""WebSocket aperti e richieste REST: i socket non tengono connessioni del pool.
+
+Con DB_POOL_SIZE=3 e DB_MAX_OVERFLOW=2 (conftest) si aprono piu' socket di quante connessioni il
+pool possa dare: le richieste REST devono riuscire entro DB_POOL_TIMEOUT_SEC, senza timeout.
+Le letture sono quelle che vanno sempre al DB (ordini chiusi e storico CLOSED, come
+scripts/bench_ws_rest.py), non la proiezione in memoria.
+"""
+from __future__ import annotations
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from app.config import settings
+from app.db import pool_stats
+from app.projection import live_orders
+from app.security import principals
+
+from test_orders import _create
+
+
+def test_rest_works_with_more_sockets_than_pool_connections(client, login, sql):
+	sockets = settings.DB_POOL_SIZE + settings.DB_MAX_OVERFLOW + 3
+	tokens = [login(user, password)["Authorization"].split()[1] for user, password in (("bar", "1234"), ("emma", "1234"), ("admin", "admin"))]
+	headers = login("emma", "1234")
+	# ordini chiusi: fuori dalla proiezione, GET /api/orders/{id} li legge dal DB
+	closed = []
+	for order_id in _create(client, headers, 3, table=16):
+		sql("UPDATE orders SET status = 'CLOSED' WHERE id = ?", order_id)
+		closed.append(sql("SELECT public_id FROM orders WHERE id = ?", order_id)[0][0])
+	live_orders.invalidate()
+	principals.invalidate()  # anche l'autenticazione passa dal DB
+	stats = pool_stats()
+
+	with ExitStack() as stack:
+		opened = []
+		for i in range(sockets):
+			ws = stack.enter_context(client.websocket_connect(f"/ws?token={tokens[i % len(tokens)]}"))
+			assert ws.receive_json()["type"] == "hello"
+			opened.append(ws)
+
+		def get(i: int) -> float:
+			if i % 2:
+				url = f"/api/orders/{closed[i % len(closed)]}"
+			else:
+				url = "/api/orders?status=CLOSED&limit=20"
+			t0 = time.perf_counter()
+			r = client.get(url, headers=headers)
+			assert r.status_code == 200, r.text
+			return time.perf_counter() - t0
+
+		requests = sockets * 2
+		with ThreadPoolExecutor(max_workers=sockets) as pool:
+			elapsed = list(pool.map(get, range(requests)))
+		assert max(elapsed) < settings.DB_POOL_TIMEOUT_SEC
+		assert pool_stats()["checkouts"] - stats["checkouts"] >= requests
+
+		# anche le scritture, e i socket ricevono l'evento
+		order_id = _create(client, headers, 1, table=15)[0]
+		for ws in opened[:3]:
+			ev = ws.receive_json()
+			while ev["type"] != "order_created":
+				ev = ws.receive_json()
+			assert ev["order"]["id"] == order_id
+
+	assert pool_stats()["timeouts"] == stats["timeouts"]
@@ -4,6 +4,7 @@
 
 	let g_token = '';
 	let g_ws = null;
+	let g_orders = [];
 
 	function setSystem(ok){
 		$('systemText').textContent = ok ? 'ONLINE' : 'OFFLINE';
@@ -56,25 +57,55 @@
 	}
 
 	async function refreshOrders(){
-		const list = await api('/api/orders');
-		renderOrders(list);
+		g_orders = await api('/api/orders?live=1');
+		renderOrders(g_orders);
+	}
+
+	function upsertOrder(o){
+		const idx = g_orders.findIndex(x => x.id === o.id);
+		if (idx >= 0) g_orders[idx] = o; else g_orders.unshift(o);
+		renderOrders(g_orders);
+	}
+
+	// Delta "item_done"/"items_done": patch locale se la versione e' consecutiva, altrimenti resync dell'ordine.
+	async function applyItemDone(msg){
+		const o = g_orders.find(x => x.id === msg.order_id);
+		if (o && msg.version <= (o.version || 1)) return;
+		if (o && msg.version === (o.version || 1) + 1) {
+			const changes = msg.items || [{ item_id: msg.item_id, is_done: msg.is_done }];
+			for (const c of changes) {
+				const it = (o.items || []).find(i => i.id === c.item_id);
+				if (it) it.is_done = !!c.is_done;
+			}
+			o.version = msg.version;
+			o.status = msg.status;
+			o.ready_at = msg.ready_at;
+			renderOrders(g_orders);
+			return;
+		}
+		upsertOrder(await api(`/api/orders/${encodeURIComponent(msg.public_id)}`));
 	}
 
 	function wsConnect(){
 		if (g_ws) try { g_ws.close(); } catch(e) {}
 		const proto = location.protocol === 'https:' ? 'wss' : 'ws';
-		const url = `${proto}://${location.host}/ws?token=${encodeURIComponent(g_token)}&channel=admin`;
-		g_ws = new WebSocket(url);
+		const url = `${proto}://${location.host}/ws?token=${encodeURIComponent(g_token)}&channel=admin${CassaWS.query()}`;
+		g_ws = CassaWS.prepare(new WebSocket(url));
 		g_ws.onopen = () => { setSystem(true); addEvent(`[WS] connected`); };
 		g_ws.onclose = () => { setSystem(false); addEvent(`[WS] closed`); };
 		g_ws.onerror = () => { setSystem(false); addEvent(`[WS] error`); };
 		g_ws.onmessage = (ev) => {
 			let msg = null;
-			try { msg = JSON.parse(ev.data); } catch(e) { return; }
+			try { msg = CassaWS.parse(ev); } catch(e) { return; }
 			if (msg.type === 'order_created' || msg.type === 'order_updated') {
-				refreshOrders().catch(()=>{});
+				if (msg.order) upsertOrder(msg.order); else refreshOrders().catch(()=>{});
 				addEvent(`[${msg.type}] #${msg.order?.public_id || '?'}`);
 			}
+			if (msg.type === 'item_done' || msg.type === 'items_done') {
+				applyItemDone(msg).catch(()=>{});
+				const righe = msg.items ? msg.items.map(c => c.item_id).join(',') : msg.item_id;
+				addEvent(`[${msg.type}] #${msg.public_id} righe ${righe} v${msg.version}`);
+			}
 			if (msg.type === 'call_created') {
 				addEvent(`[call] ${msg.call?.call_type} id=${msg.call?.id}`);
 			}
@@ -52,7 +52,8 @@ async function apiLogin(username = "bar", password = "1234"){
 }
 
 async function apiFetchOrders(){
-	const r = await fetch(`${API.base}/api/orders`, {
+	// live: ordini non chiusi della giornata di servizio (proiezione in memoria sul server)
+	const r = await fetch(`${API.base}/api/orders?live=1`, {
 		headers: {"Authorization": `Bearer ${API.token}`}
 	});
 	if(!r.ok) throw new Error("Impossibile leggere ordini");
@@ -68,6 +69,7 @@ function apiOrderToUi(o){
 		covers: o.covers,
 		apericena: o.apericena,
 		note: o.note || "",
+		version: o.version || 1,
 		receivedAtMs: Date.parse(o.created_at),
 		completedAtMs: o.ready_at ? Date.parse(o.ready_at) : null,
 		items: (o.items || []).map(it => ({
@@ -80,6 +82,38 @@ function apiOrderToUi(o){
 	};
 }
 
+async function apiFetchOrder(orderPublicId){
+	const r = await fetch(`${API.base}/api/orders/${encodeURIComponent(orderPublicId)}`, {
+		headers: {"Authorization": `Bearer ${API.token}`}
+	});
+	if(!r.ok) throw new Error("Impossibile leggere ordine");
+	const ui = apiOrderToUi(await r.json());
+	const idx = orders.findIndex(x => x.id === ui.id);
+	if(idx >= 0) orders[idx] = ui; else orders.unshift(ui);
+}
+
+// Evento delta "item_done"/"items_done": si applica solo se e' la versione successiva a quella locale,
+// altrimenti (evento perso) si riscarica l'ordine intero.
+async function applyItemDone(msg){
+	const o = orders.find(x => x.id === msg.public_id);
+	if(o && msg.version <= o.version) return;
+	if(o && msg.version === o.version + 1){
+		// "items_done" (endpoint bulk) porta piu' righe con una sola versione
+		const changes = msg.items || [{item_id: msg.item_id, is_done: msg.is_done}];
+		for(const c of changes){
+			const it = o.items.find(i => i.id === c.item_id);
+			if(it) it.done = !!c.is_done;
+		}
+		o.version = msg.version;
+		o.completedAtMs = msg.ready_at ? Date.parse(msg.ready_at) : o.completedAtMs;
+	}else{
+		try{ await apiFetchOrder(msg.public_id); }catch(e){ console.warn(e); return; }
+	}
+	ensureSelection();
+	renderOrdersFull();
+	renderDetails();
+}
+
 async function apiSetItemDone(orderPublicId, itemId, isDone){
 	const r = await fetch(`${API.base}/api/orders/${encodeURIComponent(orderPublicId)}/items/${itemId}`, {
 		method: "PATCH",
@@ -93,7 +127,29 @@ async function apiSetItemDone(orderPublicId, itemId, isDone){
 	const j = await r.json();
 	const ui = apiOrderToUi(j);
 	const idx = orders.findIndex(x => x.id === ui.id);
-	if(idx >= 0) orders[idx] = ui; else orders.unshift(ui);
+	if(idx >= 0){
+		if(ui.version >= orders[idx].version) orders[idx] = ui;
+	}else orders.unshift(ui);
+}
+
+// Piu' righe (anche di ordini diversi) in una sola richiesta: una transazione, un evento per ordine.
+async function apiSetItemsDone(changes){
+	const r = await fetch(`${API.base}/api/orders/items`, {
+		method: "PATCH",
+		headers: {
+			"Content-Type": "application/json",
+			"Authorization": `Bearer ${API.token}`,
+		},
+		body: JSON.stringify({items: changes})
+	});
+	if(!r.ok) throw new Error("Aggiornamento fallito");
+	for(const j of await r.json()){
+		const ui = apiOrderToUi(j);
+		const idx = orders.findIndex(x => x.id === ui.id);
+		if(idx >= 0){
+			if(ui.version >= orders[idx].version) orders[idx] = ui;
+		}else orders.unshift(ui);
+	}
 }
 
 async function apiPrint(orderPublicId){
@@ -144,8 +200,9 @@ function wsConnect(){
 			if(idx>=0) orders[idx]=ui; else orders.unshift(ui);
 			ensureSelection();
 			renderOrdersFull();
-			renderDetail();
+			renderDetails();
 		}
+		if(msg.type === "item_done" || msg.type === "items_done") applyItemDone(msg);
 		if(msg.type === "call_created") toast("Chiamata ricevuta");
 		if(msg.type === "print_job"){
 			if(msg.ok) toast("Stampa inviata");
@@ -156,29 +213,46 @@ function wsConnect(){
 
 function wsConnect(){
 	if(!API.token) return;
-	if(g_ws) { try { g_ws.close(); } catch(_){} }
+	if(g_ws) { try { g_ws.onclose = null; g_ws.close(); } catch(_){} }
 	const proto = (location.protocol === "https:") ? "wss" : "ws";
-	const url = `${proto}://${location.host}/ws?channel=bar&token=${encodeURIComponent(API.token)}`;
-	g_ws = new WebSocket(url);
-	g_ws.onopen = ()=>{ $("systemText").textContent = "ONLINE"; };
-	g_ws.onclose = ()=>{ $("systemText").textContent = "OFFLINE"; };
-	g_ws.onmessage = (ev)=>{
+	// alla riconnessione chiede solo gli eventi persi (since = ultimo seq visto)
+	const since = (g_wsSeq !== null) ? `&since=${g_wsSeq}` : "";
+	const url = `${proto}://${location.host}/ws?channel=bar&token=${encodeURIComponent(API.token)}${since}${CassaWS.query()}`;
+	const ws = CassaWS.prepare(new WebSocket(url));
+	g_ws = ws;
+	ws.onopen = ()=>{ $("systemText").textContent = "ONLINE"; };
+	ws.onclose = ()=>{
+		$("systemText").textContent = "OFFLINE";
+		if(g_ws === ws) setTimeout(wsConnect, 2000);
+	};
+	ws.onmessage = async (ev)=>{
 		let msg = null;
-		try { msg = JSON.parse(ev.data); } catch(_) { return; }
+		try { msg = CassaWS.parse(ev); } catch(_) { return; }
+		// il seq di hello e' l'ultimo del log: vale solo se non segue un replay, altrimenti si avanza
+		// con gli eventi ricevuti e una caduta a meta' replay riprende dal primo mancante
+		const seqOk = msg.type !== "hello" || msg.resync || !msg.replayed;
+		if(seqOk && typeof msg.seq === "number" && (g_wsSeq === null || msg.seq > g_wsSeq)) g_wsSeq = msg.seq;
+		if(msg.type === "hello" && msg.resync){
+			// troppi eventi persi: si ricarica tutto
+			try{ await apiFetchOrders(); renderAll(); }catch(e){ console.warn(e); }
+			return;
+		}
 		if(msg.type === "order_created" || msg.type === "order_updated"){
 			const ui = apiOrderToUi(msg.order);
 			const idx = orders.findIndex(x => x.id === ui.id);
 			if(idx >= 0) orders[idx] = ui; else orders.unshift(ui);
 			ensureSelection();
 			renderOrdersFull();
-			renderDetail();
+			renderDetails();
 		}
+		if(msg.type === "item_done" || msg.type === "items_done") applyItemDone(msg);
 		if(msg.type === "call_created") toast("Chiamata ricevuta");
 		// keepalive expects client to ping
 	};
 }
 
 let g_ws;
+let g_wsSeq = null;
 
 function computeStatus(order){
 	const total = order.items.length;
@@ -483,7 +557,7 @@ $("btnPrint").addEventListener("click", async function(){
 	if(!o) return;
 	try{
 		const j = await apiPrint(o.id);
-		toast(j.ok ? "Stampato" : `Errore stampa: ${j.error||"?"}`);
+		toast(j.ok ? "In coda di stampa" : `Errore stampa: ${j.error||"?"}`);
 	}catch(e){
 		console.warn(e);
 		toast("Errore stampa");
@@ -495,11 +569,8 @@ $("btnReady").addEventListener("click", async function(){
 	if(!o) return;
 	if(!state.stationActive){ toast("Postazione in pausa"); return; }
 	try{
-		for(const i of o.items){
-			if(!i.done){
-				await apiSetItemDone(o.id, i.id, true);
-			}
-		}
+		const todo = o.items.filter(i => !i.done).map(i => ({item_id: i.id, is_done: true}));
+		if(todo.length) await apiSetItemsDone(todo);
 		toast(`Comanda #${o.id} completata`);
 		renderOrdersFull();
 		updateSelectedCard();
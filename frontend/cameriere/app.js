@@ -106,6 +106,7 @@
 
 	let g_wsPingTimer = null;
 	let g_wsReconnectTimer = null;
+	let g_wsSeq = null;
 
 	async function apiAckCall(callId){
 		const r = await fetch(`${API.base}/api/calls/${callId}/ack`, {
@@ -146,8 +147,11 @@
 		if(g_wsReconnectTimer){ clearTimeout(g_wsReconnectTimer); g_wsReconnectTimer = null; }
 
 		const proto = location.protocol === 'https:' ? 'wss' : 'ws';
-		const url = `${proto}://${location.host}/ws?channel=waiter&token=${encodeURIComponent(API.token)}`;
-		g_ws = new WebSocket(url);
+		// alla riconnessione arrivano solo gli eventi persi (since = ultimo seq visto);
+		// il tablet usa solo le chiamate: si iscrive a quelle per se' (o per tutti)
+		const since = (g_wsSeq !== null) ? `&since=${g_wsSeq}` : "";
+		const url = `${proto}://${location.host}/ws?channel=waiter&token=${encodeURIComponent(API.token)}&waiter=me&types=call_created${since}${CassaWS.query()}`;
+		g_ws = CassaWS.prepare(new WebSocket(url));
 
 		g_ws.onopen = () => {
 			console.log("WS ok");
@@ -160,7 +164,11 @@
 		};
 		g_ws.onmessage = (ev)=>{
 			let msg;
-			try{ msg = JSON.parse(ev.data); }catch(e){ return; }
+			try{ msg = CassaWS.parse(ev); }catch(e){ return; }
+			// il seq di hello e' l'ultimo del log: vale solo se non segue un replay, altrimenti si avanza
+			// con gli eventi ricevuti e una caduta a meta' replay riprende dal primo mancante
+			const seqOk = msg.type !== "hello" || msg.resync || !msg.replayed;
+			if(seqOk && typeof msg.seq === "number" && (g_wsSeq === null || msg.seq > g_wsSeq)) g_wsSeq = msg.seq;
 			if(msg.type === "call_created" || msg.event === "call.created"){
 				toast("Chiamata dal BAR");
 				if(msg.call) showCallModal(msg.call);
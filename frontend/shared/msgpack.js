@@ -0,0 +1,88 @@
+// Formato dei frame WS condiviso dalle app (bar, cameriere, admin).
+// Di default i frame sono testo JSON. Con localStorage.ws_format = "msgpack" (o ?ws_format=msgpack
+// nell'URL, che lo memorizza) il client chiede /ws?format=msgpack e riceve frame binari MessagePack:
+// piu' piccoli e senza JSON.parse. Il server risponde in JSON se non ha msgpack installato, quindi
+// parse() guarda il tipo di ogni frame e non il formato chiesto.
+(function(){
+	"use strict";
+
+	const utf8 = new TextDecoder("utf-8");
+
+	// Decoder MessagePack minimo: i tipi che produce msgpack.packb per un payload JSON
+	function decode(buf){
+		const bytes = new Uint8Array(buf);
+		const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+		let pos = 0;
+
+		function str(n){ const s = utf8.decode(bytes.subarray(pos, pos + n)); pos += n; return s; }
+		function bin(n){ const b = bytes.slice(pos, pos + n); pos += n; return b; }
+		function arr(n){ const a = new Array(n); for(let i = 0; i < n; i++) a[i] = read(); return a; }
+		function map(n){ const o = {}; for(let i = 0; i < n; i++){ const k = read(); o[k] = read(); } return o; }
+		function ext(n){ pos += 1 + n; return null; }  // nessun tipo ext negli eventi
+
+		function read(){
+			const t = bytes[pos++];
+			if(t <= 0x7f) return t;
+			if(t <= 0x8f) return map(t & 0x0f);
+			if(t <= 0x9f) return arr(t & 0x0f);
+			if(t <= 0xbf) return str(t & 0x1f);
+			if(t >= 0xe0) return t - 0x100;
+			let v;
+			switch(t){
+				case 0xc0: return null;
+				case 0xc2: return false;
+				case 0xc3: return true;
+				case 0xc4: v = view.getUint8(pos); pos += 1; return bin(v);
+				case 0xc5: v = view.getUint16(pos); pos += 2; return bin(v);
+				case 0xc6: v = view.getUint32(pos); pos += 4; return bin(v);
+				case 0xc7: v = view.getUint8(pos); pos += 1; return ext(v);
+				case 0xc8: v = view.getUint16(pos); pos += 2; return ext(v);
+				case 0xc9: v = view.getUint32(pos); pos += 4; return ext(v);
+				case 0xca: v = view.getFloat32(pos); pos += 4; return v;
+				case 0xcb: v = view.getFloat64(pos); pos += 8; return v;
+				case 0xcc: v = view.getUint8(pos); pos += 1; return v;
+				case 0xcd: v = view.getUint16(pos); pos += 2; return v;
+				case 0xce: v = view.getUint32(pos); pos += 4; return v;
+				case 0xcf: v = Number(view.getBigUint64(pos)); pos += 8; return v;
+				case 0xd0: v = view.getInt8(pos); pos += 1; return v;
+				case 0xd1: v = view.getInt16(pos); pos += 2; return v;
+				case 0xd2: v = view.getInt32(pos); pos += 4; return v;
+				case 0xd3: v = Number(view.getBigInt64(pos)); pos += 8; return v;
+				case 0xd4: return ext(1);
+				case 0xd5: return ext(2);
+				case 0xd6: return ext(4);
+				case 0xd7: return ext(8);
+				case 0xd8: return ext(16);
+				case 0xd9: v = view.getUint8(pos); pos += 1; return str(v);
+				case 0xda: v = view.getUint16(pos); pos += 2; return str(v);
+				case 0xdb: v = view.getUint32(pos); pos += 4; return str(v);
+				case 0xdc: v = view.getUint16(pos); pos += 2; return arr(v);
+				case 0xdd: v = view.getUint32(pos); pos += 4; return arr(v);
+				case 0xde: v = view.getUint16(pos); pos += 2; return map(v);
+				case 0xdf: v = view.getUint32(pos); pos += 4; return map(v);
+			}
+			throw new Error("msgpack: unsupported type 0x" + t.toString(16));
+		}
+
+		return read();
+	}
+
+	function format(){
+		try{
+			const q = new URLSearchParams(location.search).get("ws_format");
+			if(q) localStorage.setItem("ws_format", q);
+			return localStorage.getItem("ws_format") === "msgpack" ? "msgpack" : "json";
+		}catch(_){ return "json"; }
+	}
+
+	window.CassaWS = {
+		decode,
+		format,
+		// da aggiungere all'URL di /ws
+		query(){ return format() === "msgpack" ? "&format=msgpack" : ""; },
+		// da chiamare subito dopo new WebSocket(url)
+		prepare(ws){ ws.binaryType = "arraybuffer"; return ws; },
+		// MessageEvent -> oggetto, per frame di testo (JSON) o binari (MessagePack)
+		parse(ev){ return (typeof ev.data === "string") ? JSON.parse(ev.data) : decode(ev.data); },
+	};
+})();